@@ -1,5 +1,51 @@
 from django.contrib import admin
-from .models import Book, Author, Language, Subject, Bookshelf, Format
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from .models import Book, Author, Language, Subject, Bookshelf, Format, BookAuthor, BookSubject, MimeType, UrlTemplate
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that estimates the size of large unfiltered tables.
+    
+    An exact COUNT(*) scans the whole table. For an unfiltered changelist
+    on PostgreSQL, the planner's row estimate (pg_class.reltuples) is used
+    instead once it exceeds ``threshold``; filtered or small result sets
+    are still counted exactly.
+    
+    Attributes:
+        threshold (int): Estimated row count above which the estimate is used
+    """
+    threshold = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            # Ask the database the queryset reads from (e.g. a replica)
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                        [self.object_list.model._meta.db_table],
+                    )
+                    row = cursor.fetchone()
+                if row and row[0] > self.threshold:
+                    return int(row[0])
+        return super().count
+
+class BookAuthorInline(admin.TabularInline):
+    """Edit a book's authors with an autocomplete widget."""
+    model = BookAuthor
+    autocomplete_fields = ['author']
+    extra = 0
+
+class BookSubjectInline(admin.TabularInline):
+    """Edit a book's subjects with an autocomplete widget."""
+    model = BookSubject
+    autocomplete_fields = ['subject']
+    extra = 0
 
 # Register Book model with custom admin configuration
 @admin.register(Book)
@@ -18,11 +64,20 @@ class BookAdmin(admin.ModelAdmin):
             - authors__name: Search by author name (related field)
             
         list_filter (list): Fields that can be used to filter the list
-            - languages__code: Filter books by language code
+            - languages: Filter books by language (choices come from the
+              small Language table, not from a DISTINCT over all books)
+            
+        inlines (list): Authors and subjects, edited with autocomplete widgets
+        
+    Changelists skip the unfiltered COUNT(*) (show_full_result_count) and
+    estimate the size of the unfiltered table (EstimatedCountPaginator).
     """
     list_display = ['title', 'gutenberg_id', 'download_count']
     search_fields = ['title', 'authors__name']
-    list_filter = ['languages__code']
+    list_filter = ['languages']
+    inlines = [BookAuthorInline, BookSubjectInline]
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
 
 @admin.register(Author)
 class AuthorAdmin(admin.ModelAdmin):
@@ -82,6 +137,36 @@ class BookshelfAdmin(admin.ModelAdmin):
     list_display = ['name']
     search_fields = ['name']
 
+@admin.register(MimeType)
+class MimeTypeAdmin(admin.ModelAdmin):
+    """
+    Admin interface configuration for MimeType model.
+    
+    Attributes:
+        list_display (list): Fields to display in the admin list view
+            - name: MIME type (e.g., 'text/plain')
+            
+        search_fields (list): Fields that can be searched
+            - name: Search by MIME type
+    """
+    list_display = ['name']
+    search_fields = ['name']
+
+@admin.register(UrlTemplate)
+class UrlTemplateAdmin(admin.ModelAdmin):
+    """
+    Admin interface configuration for UrlTemplate model.
+    
+    Attributes:
+        list_display (list): Fields to display in the admin list view
+            - template: URL with '{id}' for the Gutenberg ID
+            
+        search_fields (list): Fields that can be searched
+            - template: Search by URL template
+    """
+    list_display = ['template']
+    search_fields = ['template']
+
 @admin.register(Format)
 class FormatAdmin(admin.ModelAdmin):
     """
@@ -94,7 +179,17 @@ class FormatAdmin(admin.ModelAdmin):
             - url: Download URL for the format
             
         list_filter (list): Fields that can be used to filter the list
-            - mime_type: Filter formats by type
+            - mime: Filter formats by type
+            
+        list_select_related (list): Books, MIME types and URL templates are
+            joined into the changelist query instead of loaded once per row
+            
+        autocomplete_fields (list): The book, MIME type and URL template are
+            picked with search widgets instead of selects listing every row
     """
     list_display = ['book', 'mime_type', 'url']
-    list_filter = ['mime_type']
+    list_filter = ['mime']
+    list_select_related = ['book', 'mime', 'url_template']
+    autocomplete_fields = ['book', 'mime', 'url_template']
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BooksConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "books"
+
+    def ready(self):
+        from . import signals  # noqa: F401  (registers signal receivers)
@@ -0,0 +1,176 @@
+"""
+Catalog version and change stamps.
+
+Both stamps are rows of the TableGeneration table of the primary database
+('catalog:version' and 'catalog:changed'), so every worker of every
+instance, and commands run from cron or other containers, see the same
+ones. A stamp is moved by the transaction making the change and rolls
+back with it; the row lock it takes is held until that transaction ends,
+so long-running writers should use batch(). Reads go through
+books.querycache.generations(), which reads the table at most once per
+request.
+
+Stamps are nanoseconds since the epoch, never going back even when hosts'
+clocks disagree.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.views.decorators.http import condition
+
+from . import querycache
+
+VERSION = 'catalog:version'
+CHANGED = 'catalog:changed'
+STAMP_SQL = (
+    f'INSERT INTO {querycache.GENERATIONS_TABLE} (name, generation) VALUES (%s, %s) '
+    f'ON CONFLICT (name) DO UPDATE SET generation = '
+    f'GREATEST({querycache.GENERATIONS_TABLE}.generation + 1, EXCLUDED.generation) '
+    'RETURNING generation'
+)
+INIT_SQL = (
+    f'INSERT INTO {querycache.GENERATIONS_TABLE} (name, generation) VALUES (%s, %s) '
+    'ON CONFLICT (name) DO NOTHING'
+)
+
+_batch = ContextVar('catalog_batch', default=None)
+
+
+def get_version():
+    """
+    Return the current catalog version.
+
+    The version changes whenever catalog data that workers hold in memory
+    is modified.
+
+    On edge read nodes, this is the version of the catalog snapshot being
+    served (see books.snapshot).
+
+    Returns:
+        int: Version stamp (0 if the catalog was never marked as changed)
+    """
+    if settings.SNAPSHOT_PATH:
+        return _snapshot_version()
+    return querycache.generations([VERSION])[0]
+
+
+def _move(names, using=None):
+    """
+    Move stamps in the current transaction (or right away outside one).
+
+    Returns:
+        int: The new value of the last stamp moved
+    """
+    value = None
+    with connections[using or DEFAULT_DB_ALIAS].cursor() as cursor:
+        # Always in this order, so concurrent transactions cannot deadlock
+        for name in (CHANGED, VERSION):
+            if name in names:
+                cursor.execute(STAMP_SQL, [name, time.time_ns()])
+                value = cursor.fetchone()[0]
+    querycache.forget_generations()
+    return value
+
+
+def bump_version(using=None):
+    """
+    Mark the catalog as changed so that workers reload in-memory copies.
+
+    Moves the version and change stamps in the current transaction. Inside
+    batch(), only the change stamp is moved and the version is bumped once
+    at the end.
+
+    Args:
+        using: Database alias of the transaction
+
+    Returns:
+        int or None: The new version stamp, or None inside batch()
+    """
+    pending = _batch.get()
+    if pending is not None:
+        pending.append(True)
+        touch(using)
+        return None
+    return _move({CHANGED, VERSION}, using)
+
+
+@contextmanager
+def batch():
+    """
+    Defer the version bumps of bump_version() to the end of the block.
+
+    For commands writing many formats or dimension rows one by one, which
+    would otherwise make every worker reload its in-memory copies after
+    each row.
+    """
+    pending = []
+    token = _batch.set(pending)
+    try:
+        yield
+    finally:
+        _batch.reset(token)
+        if pending:
+            bump_version()
+
+
+def touch(using=None):
+    """
+    Mark catalog data as changed without reloading in-memory copies.
+
+    For writes that change API responses but not the data workers hold in
+    memory (books, authors, download counts, trending scores, ...). Moves
+    the change stamp in the current transaction.
+
+    Args:
+        using: Database alias of the transaction
+
+    Returns:
+        int: The new change stamp
+    """
+    return _move({CHANGED}, using)
+
+
+def last_changed():
+    """
+    Return when the catalog last changed.
+
+    If no change was recorded yet, the current time is recorded. On edge
+    read nodes, the snapshot being served was taken at this stamp.
+
+    Returns:
+        int: Change stamp in nanoseconds since the epoch
+    """
+    if settings.SNAPSHOT_PATH:
+        return _snapshot_version()
+    changed = querycache.generations([CHANGED])[0]
+    if not changed:
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute(INIT_SQL, [CHANGED, time.time_ns()])
+        querycache.forget_generations()
+        changed = querycache.generations([CHANGED])[0]
+    return changed
+
+
+def _snapshot_version():
+    from . import snapshot  # imports this module
+    return snapshot.version()
+
+
+def etag(request, *args, **kwargs):
+    """ETag of responses built from catalog data."""
+    return f'"catalog-{last_changed()}"'
+
+
+def last_modified(request, *args, **kwargs):
+    """Last-Modified of responses built from catalog data."""
+    return datetime.fromtimestamp(last_changed() / 1e9, timezone.utc)
+
+
+# View decorator answering conditional GETs with 304 Not Modified while the
+# catalog is unchanged, before the view runs
+conditional = condition(etag_func=etag, last_modified_func=last_modified)
@@ -0,0 +1,105 @@
+"""
+Change log for incremental catalog mirroring.
+
+Model signals (see books.signals) record every write that changes what
+/api/books/ returns for a book: the book itself, its authors, languages,
+subjects, bookshelves and formats, and renamed dimensions. Download counts
+are logged by the rollup_downloads command. Each affected book gets a
+BookChange entry, read back in sequence order by /api/changes/?since=<seq>.
+
+record() stages entries as PendingBookChange rows inside the changing
+transaction, so they commit or roll back with the change itself. Once it
+commits, publish() moves all staged rows into the log in a short
+transaction holding a lock on the table, so sequence numbers are assigned
+in commit order: a mirror that has read up to ``seq`` never misses an
+entry committed later with a smaller number. If publishing fails, the
+rows stay staged and are published by the next publish() (the next write,
+or the compact_changes command); no entry of a committed write is lost.
+"""
+
+import logging
+from functools import partial
+
+from django.db import DatabaseError, connections, router, transaction
+
+from . import catalog
+from .models import BookChange, PendingBookChange
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_SQL = (
+    f'WITH staged AS (DELETE FROM {PendingBookChange._meta.db_table} RETURNING id, book_id, action, changed_at) '
+    f'INSERT INTO {BookChange._meta.db_table} (book_id, action, changed_at) '
+    'SELECT book_id, action, changed_at FROM staged ORDER BY id'
+)
+
+
+def record(book_ids, action=BookChange.UPSERT):
+    """
+    Record that books changed, as part of the current transaction.
+
+    The entries are published once the transaction commits (immediately
+    outside a transaction).
+
+    Args:
+        book_ids: Ids of the changed books
+        action: BookChange.UPSERT or BookChange.DELETE
+    """
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    using = router.db_for_write(BookChange)
+    PendingBookChange.objects.using(using).bulk_create(
+        [PendingBookChange(book_id=book_id, action=action) for book_id in sorted(book_ids)]
+    )
+    transaction.on_commit(partial(publish, using), using=using)
+
+
+def publish(using=None):
+    """
+    Move committed staged entries into the log, numbering them in commit order.
+
+    Args:
+        using: Database alias (defaults to where BookChange is written)
+
+    Returns:
+        int: Number of entries published (0 if publishing failed; the
+        entries stay staged for the next call)
+    """
+    using = using or router.db_for_write(BookChange)
+    try:
+        if not PendingBookChange.objects.using(using).exists():
+            return 0
+        with transaction.atomic(using=using):
+            with connections[using].cursor() as cursor:
+                # Writers queue here; readers are not blocked
+                cursor.execute(f'LOCK TABLE {BookChange._meta.db_table} IN SHARE ROW EXCLUSIVE MODE')
+                cursor.execute(PUBLISH_SQL)
+                published = cursor.rowcount
+    except DatabaseError:
+        logger.exception('Failed to publish staged change log entries; they are retried on the next publish')
+        return 0
+    # Entries are visible now; a response validated before this point
+    # must not be revalidated as current
+    catalog.touch()
+    return published
+
+
+def compact():
+    """
+    Delete entries superseded by a later entry for the same book.
+
+    Mirrors lose nothing: the latest entry of every book is kept, and it
+    has a higher sequence number than the ones removed.
+
+    Returns:
+        int: Number of entries deleted
+    """
+    table = BookChange._meta.db_table
+    using = router.db_for_write(BookChange)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} c WHERE EXISTS '
+            f'(SELECT 1 FROM {table} n WHERE n.book_id = c.book_id AND n.seq > c.seq)'
+        )
+        return cursor.rowcount
@@ -0,0 +1,186 @@
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+from . import compression
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Only these types are worth storing a gzip variant for
+COMPRESSIBLE_TYPES = ('text/', 'application/xml', 'application/xhtml', 'application/json', 'application/rdf')
+
+
+def object_path(digest):
+    """Path of the stored file with the given SHA-256 hex digest."""
+    return os.path.join(settings.CONTENT_STORE_ROOT, 'objects', digest[:2], digest[2:4], digest)
+
+
+def store_file(source, mime_type=''):
+    """
+    Copy a file into the content-addressed store.
+
+    The file is hashed while it is copied and moved into place atomically.
+    For compressible MIME types a .gz variant is stored next to it when it
+    is smaller than the original.
+
+    Args:
+        source: Path of the file to import
+        mime_type: MIME type of the file
+
+    Returns:
+        tuple: (sha256 hex digest, size, gzip size or None)
+    """
+    objects = os.path.join(settings.CONTENT_STORE_ROOT, 'objects')
+    os.makedirs(objects, exist_ok=True)
+    digest = hashlib.sha256()
+    with open(source, 'rb') as src, tempfile.NamedTemporaryFile(dir=objects, delete=False) as tmp:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            tmp.write(chunk)
+    digest = digest.hexdigest()
+    path = object_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp.name, path)
+    size = os.path.getsize(path)
+
+    gzip_size = None
+    if mime_type.startswith(COMPRESSIBLE_TYPES):
+        if not os.path.exists(f'{path}.gz'):
+            with open(path, 'rb') as src, tempfile.NamedTemporaryFile(dir=objects, delete=False) as tmp:
+                with gzip.GzipFile(fileobj=tmp, mode='wb', compresslevel=9, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, CHUNK_SIZE)
+            os.replace(tmp.name, f'{path}.gz')
+        gzip_size = os.path.getsize(f'{path}.gz')
+        if gzip_size >= size:
+            os.remove(f'{path}.gz')
+            gzip_size = None
+    return digest, size, gzip_size
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range ``Range`` header.
+
+    Args:
+        header: Value of the Range header
+        size: Size of the resource in bytes
+
+    Returns:
+        tuple or None or False: (start, end) inclusive for a satisfiable
+        range, None if the header is absent, invalid (e.g. bytes=500-100)
+        or not a single byte range (the full resource is served), False if
+        the range is valid but lies outside the resource
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        if end and int(end) < start:
+            return None
+        end = min(int(end), size - 1) if end else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def if_range_matches(if_range, etag, last_modified):
+    """
+    Evaluate an ``If-Range`` header.
+
+    Args:
+        if_range: Value of the If-Range header
+        etag: Strong ETag of the stored file
+        last_modified: Modification time of the stored file (seconds since
+            the epoch, whole seconds)
+
+    Returns:
+        bool: True if the range may be served: the header is the ETag, or
+        an HTTP-date equal to the Last-Modified sent with the file
+    """
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag  # strong comparison: weak tags never match
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _mapped_chunks(path, start, end):
+    """Yield bytes ``start``..``end`` (inclusive) of ``path`` from a memory map."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for offset in range(start, end + 1, CHUNK_SIZE):
+            yield mapped[offset:min(offset + CHUNK_SIZE, end + 1)]
+
+
+def serve(request, content, content_type, filename=''):
+    """
+    Serve a locally stored file.
+
+    Supports conditional requests (strong ETag from the content hash,
+    Last-Modified from the stored file, If-Range with either), single byte
+    ranges (206, read through a memory map; invalid ranges are ignored) and the
+    precompressed gzip variant for clients that accept it. Full responses
+    use FileResponse, which lets the WSGI server use sendfile().
+
+    Args:
+        request: HTTP request
+        content: FormatContent of the file
+        content_type: MIME type to send
+        filename: File name suggested to the client
+
+    Returns:
+        HttpResponse
+    """
+    path = object_path(content.sha256)
+    etag = f'"{content.sha256}"'
+    gzip_etag = f'"{content.sha256}.gz"'
+
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if '*' in if_none_match or etag in if_none_match or gzip_etag in if_none_match:
+        response = HttpResponseNotModified()
+        response['ETag'] = gzip_etag if gzip_etag in if_none_match else etag
+        return response
+
+    last_modified = int(os.stat(path).st_mtime)
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), content.size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and not if_range_matches(if_range.strip(), etag, last_modified):
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{content.size}'
+    elif byte_range and content.size:
+        start, end = byte_range
+        response = StreamingHttpResponse(_mapped_chunks(path, start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{content.size}'
+        response['Content-Length'] = end - start + 1
+    elif (content.gzip_size is not None
+          and compression.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''), offered=('gzip',))):
+        response = FileResponse(open(f'{path}.gz', 'rb'), content_type=content_type, filename=filename)
+        response['Content-Encoding'] = 'gzip'
+        response['Content-Length'] = content.gzip_size
+        etag = gzip_etag
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=content_type, filename=filename)
+        response['Content-Length'] = content.size
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = 'public, max-age=86400'
+    if content.gzip_size is not None:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
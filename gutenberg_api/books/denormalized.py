@@ -0,0 +1,97 @@
+"""
+Language and bookshelf id arrays denormalized on Book.
+
+Book.language_ids and Book.bookshelf_ids copy the books_book_languages and
+books_book_bookshelves through tables, so language and bookshelf filters
+are GIN-indexed array lookups and list pages serialize both without a
+prefetch query. ORM writes to the through tables resync the affected books
+(see books.signals); after bulk or raw SQL imports, run the
+check_book_arrays management command with --fix.
+
+Catalog snapshots (SQLite, see books.snapshot) store the arrays as JSON
+text without an index; overlap() filters through the through tables there.
+"""
+
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db import connection, connections
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Book, BookBookshelf, BookLanguage
+
+# Array column -> (through model, dimension id column)
+ARRAYS = {
+    'language_ids': (BookLanguage, 'language_id'),
+    'bookshelf_ids': (BookBookshelf, 'bookshelf_id'),
+}
+
+
+def _expected(column):
+    """SQL for the value an array column should have for book b."""
+    through, id_column = ARRAYS[column]
+    return (
+        f'COALESCE((SELECT array_agg(t.{id_column} ORDER BY t.{id_column}) '
+        f'FROM {through._meta.db_table} t WHERE t.book_id = b.id), \'{{}}\')'
+    )
+
+
+def overlap(column, dimensions, using):
+    """
+    Condition on books sharing at least one id with a dimension queryset.
+
+    Args:
+        column: 'language_ids' or 'bookshelf_ids'
+        dimensions: Queryset of the matching Language or Bookshelf rows
+        using: Database alias the books are read from
+
+    Returns:
+        Q: Filter condition for a Book queryset
+    """
+    if connections[using].vendor == 'postgresql':
+        return Q(**{f'{column}__overlap': ArraySubquery(dimensions.values('id'))})
+    through, id_column = ARRAYS[column]
+    return Q(Exists(through.objects.filter(book=OuterRef('pk'), **{f'{id_column}__in': dimensions.values('id')})))
+
+
+def _stale_condition():
+    return ' OR '.join(f'b.{column} IS DISTINCT FROM {_expected(column)}' for column in ARRAYS)
+
+
+def mismatches(book_ids=None):
+    """
+    Find books whose arrays differ from their through-table rows.
+
+    Args:
+        book_ids: Only check these books (defaults to all books)
+
+    Returns:
+        list: Ids of the out-of-sync books
+    """
+    sql = f'SELECT b.id FROM {Book._meta.db_table} b WHERE ({_stale_condition()})'
+    params = []
+    if book_ids is not None:
+        sql += ' AND b.id = ANY(%s)'
+        params.append(list(book_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(sql + ' ORDER BY b.id', params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def sync(book_ids=None):
+    """
+    Rewrite the arrays of out-of-sync books from their through-table rows.
+
+    Args:
+        book_ids: Only sync these books (defaults to all books)
+
+    Returns:
+        int: Number of books updated
+    """
+    assignments = ', '.join(f'{column} = {_expected(column)}' for column in ARRAYS)
+    sql = f'UPDATE {Book._meta.db_table} b SET {assignments} WHERE ({_stale_condition()})'
+    params = []
+    if book_ids is not None:
+        sql += ' AND b.id = ANY(%s)'
+        params.append(list(book_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
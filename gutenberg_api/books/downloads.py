@@ -0,0 +1,153 @@
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import catalog, metrics
+from .models import Book, DownloadBucket
+
+logger = logging.getLogger(__name__)
+
+UPSERT_BUCKET_SQL = (
+    'INSERT INTO books_download_bucket (book_id, granularity, bucket_start, count) '
+    'VALUES (%s, %s, %s, %s) '
+    'ON CONFLICT (book_id, granularity, bucket_start) '
+    'DO UPDATE SET count = books_download_bucket.count + EXCLUDED.count'
+)
+
+
+def add_to_buckets(counts, granularity):
+    """
+    Add download counts to buckets, creating missing buckets.
+
+    Args:
+        counts: Mapping of (book_id, bucket_start) to downloads
+        granularity: DownloadBucket.HOUR or DownloadBucket.DAY
+    """
+    with connection.cursor() as cursor:
+        cursor.executemany(UPSERT_BUCKET_SQL, [
+            (book_id, granularity, bucket_start, count)
+            for (book_id, bucket_start), count in counts.items()
+        ])
+
+
+class DownloadRecorder:
+    """
+    Buffer download clicks in process and write them in aggregated batches.
+
+    Recording a click is an in-memory counter increment. Once
+    ``flush_size`` clicks are pending, or at the latest ``flush_interval``
+    seconds after the first pending click (a timer thread flushes idle
+    workers too), the buffer is flushed: one upsert per (book, hour) bucket
+    and one ``download_count`` update per book, regardless of the number of
+    clicks. ``download_count`` therefore lags by at most ``flush_interval``
+    seconds. A worker flushes what is left when it exits.
+
+    Attributes:
+        flush_size (int): Pending clicks that trigger a flush
+        flush_interval (float): Seconds after which pending clicks are flushed
+    """
+
+    def __init__(self, flush_size=None, flush_interval=None):
+        self.flush_size = flush_size or settings.DOWNLOAD_FLUSH_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else settings.DOWNLOAD_FLUSH_INTERVAL
+        self._lock = threading.Lock()
+        self._pending = Counter()  # (book_id, hour) -> clicks
+        self._clicks = 0
+        self._timer = None
+
+    def record(self, book_id):
+        """
+        Count one download of a book, flushing the buffer when due.
+
+        Args:
+            book_id: ID of the downloaded book
+        """
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        with self._lock:
+            self._pending[(book_id, hour)] += 1
+            self._clicks += 1
+            due = self._clicks >= self.flush_size
+            self._schedule()
+        if due:
+            self.flush()
+
+    def _schedule(self):
+        """Start the flush timer unless it is running (call with the lock held)."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            connections.close_all()  # the timer thread's own connections
+
+    def flush(self):
+        """
+        Write all pending clicks to the database.
+
+        If the write fails, the clicks are put back into the buffer and
+        retried by the next flush, except those of books that no longer
+        exist (deleted since the click), which are dropped.
+
+        Returns:
+            int: Number of clicks written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._clicks = 0
+        if not pending:
+            return 0
+
+        per_book = Counter()
+        for (book_id, _), clicks in pending.items():
+            per_book[book_id] += clicks
+        try:
+            with transaction.atomic():
+                add_to_buckets(pending, DownloadBucket.HOUR)
+                for book_id, clicks in per_book.items():
+                    Book.objects.filter(id=book_id).update(
+                        download_count=Coalesce(F('download_count'), 0) + clicks
+                    )
+        except DatabaseError:
+            logger.exception('Failed to flush %d download clicks', sum(pending.values()))
+            self._requeue(self._existing(pending))
+            return 0
+        catalog.touch()
+        metrics.DOWNLOAD_FLUSH_CLICKS.observe(sum(pending.values()))
+        return sum(pending.values())
+
+    def _existing(self, pending):
+        """Drop the clicks of deleted books from a failed batch."""
+        try:
+            existing = set(Book.objects.filter(id__in={book_id for book_id, _ in pending}).values_list('id', flat=True))
+        except DatabaseError:
+            return pending  # database unavailable: keep everything
+        kept = Counter({key: clicks for key, clicks in pending.items() if key[0] in existing})
+        if len(kept) < len(pending):
+            logger.warning('Dropped %d download clicks of deleted books', sum(pending.values()) - sum(kept.values()))
+        return kept
+
+    def _requeue(self, pending):
+        """Put clicks back into the buffer."""
+        if not pending:
+            return
+        with self._lock:
+            self._pending.update(pending)
+            self._clicks += sum(pending.values())
+            self._schedule()
+
+
+recorder = DownloadRecorder()
+atexit.register(recorder.flush)
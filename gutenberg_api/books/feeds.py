@@ -0,0 +1,324 @@
+"""
+Sitemaps and OPDS catalog feeds, written as static precompressed files.
+
+Crawlers and e-reader clients get complete listings without paging
+through the API. Books are split into chunks by id (FEEDS_CHUNK_SIZE ids
+per chunk), and every chunk is written to two files below FEEDS_ROOT:
+
+    sitemaps/<chunk>.xml  sitemap of the books' home page URLs
+    opds/<chunk>.xml      OPDS acquisition feed: title, authors, languages,
+                          subjects and a download link per format
+
+Two index files list the chunks: sitemap.xml (a sitemap index) and
+opds.xml (an OPDS navigation feed). Every file has .gz and .br variants.
+
+The build_feeds management command keeps them current. It reads the
+change log (see books.changes) from the sequence number of its last run,
+and rewrites only the chunks of the books that changed, and the index
+files. Book rows are read with server-side cursors, a batch at a time, and
+streamed into the files, so memory use does not grow with the catalog.
+
+FeedFilesMiddleware serves the files at FEEDS_URL with WhiteNoise.
+"""
+
+import gzip
+import json
+import os
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.db.models import F, Max
+from django.urls import reverse
+from whitenoise.base import WhiteNoise
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import lookups
+from .models import Book, BookChange
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; only the .gz variant is written
+    brotli = None
+
+BATCH_SIZE = 2000
+STATE_FILE = 'state.json'
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+OPDS_ACQUISITION = 'application/atom+xml;profile=opds-catalog;kind=acquisition'
+OPDS_NAVIGATION = 'application/atom+xml;profile=opds-catalog;kind=navigation'
+FEED_HEADER = (
+    '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/"'
+    ' xmlns:opds="http://opds-spec.org/2010/catalog">\n'
+)
+
+
+@contextmanager
+def _open(path):
+    """
+    Write a text file and its compressed variants.
+
+    Yields a function taking str. All variants are written to temporary
+    files and replaced on success, the compressed ones first.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp{os.getpid()}'
+    variants = [tmp + '.gz', tmp]
+    with ExitStack() as stack:
+        sinks = [
+            stack.enter_context(open(tmp, 'wb')).write,
+            stack.enter_context(gzip.GzipFile(tmp + '.gz', 'wb', 9, mtime=0)).write,
+        ]
+        if brotli is not None:
+            compressor = brotli.Compressor()
+            out = stack.enter_context(open(tmp + '.br', 'wb'))
+            sinks.append(lambda data: out.write(compressor.process(data)))
+            stack.callback(lambda: out.write(compressor.finish()))
+            variants.insert(0, tmp + '.br')
+
+        def write(text):
+            data = text.encode()
+            for sink in sinks:
+                sink(data)
+
+        try:
+            yield write
+        except BaseException:
+            stack.close()
+            for variant in variants:
+                os.unlink(variant)
+            raise
+    for variant in variants:
+        os.replace(variant, path + variant[len(tmp):])
+
+
+def _remove(path):
+    """Remove a feed file and its compressed variants."""
+    for suffix in ('', '.gz', '.br'):
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _timestamp(moment):
+    return moment.astimezone(timezone.utc).isoformat(timespec='seconds')
+
+
+def _paths(chunk):
+    root = settings.FEEDS_ROOT
+    return os.path.join(root, 'sitemaps', f'{chunk}.xml'), os.path.join(root, 'opds', f'{chunk}.xml')
+
+
+def write_chunk(chunk, base_url, now):
+    """
+    Rewrite the sitemap and OPDS feed of one chunk.
+
+    Args:
+        chunk: Chunk number (book ids chunk * FEEDS_CHUNK_SIZE and up)
+        base_url: Absolute URL of the site, without trailing slash
+        now: Time of this build, for books without a logged change
+
+    Returns:
+        tuple: (number of books, last change of any of them); the files are
+        removed if the chunk has no books
+    """
+    size = settings.FEEDS_CHUNK_SIZE
+    first, last = chunk * size, (chunk + 1) * size
+    changed = dict(
+        BookChange.objects.filter(book_id__gte=first, book_id__lt=last).order_by()
+        .values('book_id').annotate(changed_at=Max('changed_at')).values_list('book_id', 'changed_at')
+    )
+    books = (
+        Book.objects.filter(pk__gte=first, pk__lt=last).order_by('pk')
+        .prefetch_related('authors', 'subjects', 'formats')
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    # Deletions count too: they change the chunk
+    lastmod = max(changed.values(), default=None) or now
+    sitemap_path, opds_path = _paths(chunk)
+    feeds = base_url + settings.FEEDS_URL
+    tables = lookups.get()
+    count = 0
+    with _open(sitemap_path) as sitemap, _open(opds_path) as opds:
+        sitemap(f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_NS}">\n')
+        opds(
+            '<?xml version="1.0" encoding="UTF-8"?>\n' + FEED_HEADER
+            + f'<id>{escape(feeds)}opds/{chunk}.xml</id><title>Books {first} to {last - 1}</title>'
+            f'<updated>{_timestamp(lastmod)}</updated>\n'
+            f'<link rel="self" type="{OPDS_ACQUISITION}" href={quoteattr(f"{feeds}opds/{chunk}.xml")}/>\n'
+            f'<link rel="start" type="{OPDS_NAVIGATION}" href={quoteattr(feeds + "opds.xml")}/>\n'
+            f'<link rel="up" type="{OPDS_NAVIGATION}" href={quoteattr(feeds + "opds.xml")}/>\n'
+        )
+        for book in books:
+            count += 1
+            updated = changed.get(book.pk)
+            page = escape(f'{base_url}{reverse("home")}?book_ids={book.gutenberg_id}')
+            sitemap(f'<url><loc>{page}</loc>')
+            sitemap(f'<lastmod>{_timestamp(updated)}</lastmod></url>\n' if updated else '</url>\n')
+
+            entry = [
+                f'<entry><id>urn:gutenberg:book:{book.gutenberg_id}</id>',
+                f'<title>{escape(book.title or "")}</title>',
+                f'<updated>{_timestamp(updated or now)}</updated>',
+            ]
+            entry += [f'<author><name>{escape(author.name)}</name></author>' for author in book.authors.all()]
+            entry += [
+                f'<dc:language>{escape(code)}</dc:language>'
+                for code in (lookups.lookup('languages', pk, tables) for pk in book.language_ids) if code
+            ]
+            entry += [f'<category term={quoteattr(subject.name)}/>' for subject in book.subjects.all()]
+            entry.append(
+                f'<link rel="alternate" type="application/json"'
+                f' href={quoteattr(base_url + reverse("book-detail", args=[book.pk]))}/>'
+            )
+            entry += [
+                f'<link rel="http://opds-spec.org/acquisition" type={quoteattr(book_format.mime_type)}'
+                f' href={quoteattr(base_url + reverse("download_book", args=[book.pk, book_format.pk]))}/>'
+                for book_format in book.formats.all()
+            ]
+            entry.append('</entry>\n')
+            opds(''.join(entry))
+        opds('</feed>\n')
+        sitemap('</urlset>\n')
+    if not count:
+        _remove(sitemap_path)
+        _remove(opds_path)
+    return count, lastmod
+
+
+def write_indexes(chunks, base_url, now):
+    """
+    Rewrite sitemap.xml and opds.xml.
+
+    Args:
+        chunks: Mapping of chunk number to {'books': count, 'lastmod': ISO timestamp}
+        base_url: Absolute URL of the site, without trailing slash
+        now: Time of this build
+    """
+    root = settings.FEEDS_ROOT
+    feeds = base_url + settings.FEEDS_URL
+    size = settings.FEEDS_CHUNK_SIZE
+    ordered = sorted(chunks.items(), key=lambda item: int(item[0]))
+    with _open(os.path.join(root, 'sitemap.xml')) as sitemap:
+        sitemap(f'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{SITEMAP_NS}">\n')
+        for chunk, info in ordered:
+            sitemap(
+                f'<sitemap><loc>{escape(feeds)}sitemaps/{chunk}.xml</loc>'
+                f'<lastmod>{info["lastmod"]}</lastmod></sitemap>\n'
+            )
+        sitemap('</sitemapindex>\n')
+    with _open(os.path.join(root, 'opds.xml')) as opds:
+        opds(
+            '<?xml version="1.0" encoding="UTF-8"?>\n' + FEED_HEADER
+            + f'<id>{escape(feeds)}opds.xml</id><title>Gutenberg API catalog</title>'
+            f'<updated>{_timestamp(now)}</updated>\n'
+            f'<link rel="self" type="{OPDS_NAVIGATION}" href={quoteattr(feeds + "opds.xml")}/>\n'
+            f'<link rel="start" type="{OPDS_NAVIGATION}" href={quoteattr(feeds + "opds.xml")}/>\n'
+        )
+        for chunk, info in ordered:
+            first = int(chunk) * size
+            opds(
+                f'<entry><id>{escape(feeds)}opds/{chunk}.xml</id>'
+                f'<title>Books {first} to {first + size - 1}</title><updated>{info["lastmod"]}</updated>'
+                f'<content type="text">{info["books"]} books</content>'
+                f'<link rel="subsection" type="{OPDS_ACQUISITION}" href={quoteattr(f"{feeds}opds/{chunk}.xml")}/>'
+                '</entry>\n'
+            )
+        opds('</feed>\n')
+
+
+def read_state():
+    """Return the state of the last build, or None if there was none."""
+    try:
+        with open(os.path.join(settings.FEEDS_ROOT, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def build(full=False, base_url=None):
+    """
+    Bring the feed files up to date with the catalog.
+
+    Chunks of books logged as changed since the last build are rewritten;
+    all chunks are when ``full`` is set, on the first build, or when the
+    base URL or chunk size changed.
+
+    Args:
+        full: Rewrite every chunk
+        base_url: Absolute URL of the site (default: FEEDS_BASE_URL)
+
+    Returns:
+        dict: 'chunks' (number rewritten), 'books' (number written) and
+        'seq' (last change log entry included)
+    """
+    base_url = (base_url or settings.FEEDS_BASE_URL).rstrip('/')
+    size = settings.FEEDS_CHUNK_SIZE
+    now = datetime.now(timezone.utc)
+    # Read first: changes logged later are rewritten by the next build
+    head = BookChange.objects.aggregate(seq=Max('seq'))['seq'] or 0
+    state = read_state()
+    if full or state is None or (state['base_url'], state['chunk_size']) != (base_url, size):
+        dirty = set(
+            Book.objects.order_by().annotate(chunk=F('pk') / size).values_list('chunk', flat=True).distinct()
+        )
+        stale = set(state['chunks']) if state else set()
+        state = {'base_url': base_url, 'chunk_size': size, 'seq': 0, 'chunks': {}}
+    else:
+        changed = BookChange.objects.filter(seq__gt=state['seq']).values_list('book_id', flat=True).distinct()
+        dirty = {book_id // size for book_id in changed}
+        stale = set()
+
+    written = 0
+    for chunk in sorted(dirty):
+        count, lastmod = write_chunk(chunk, base_url, now)
+        written += count
+        if count:
+            state['chunks'][str(chunk)] = {'books': count, 'lastmod': _timestamp(lastmod)}
+        else:
+            state['chunks'].pop(str(chunk), None)
+    for chunk in stale - set(state['chunks']):
+        for path in _paths(chunk):
+            _remove(path)
+    write_indexes(state['chunks'], base_url, now)
+
+    state['seq'] = head
+    path = os.path.join(settings.FEEDS_ROOT, STATE_FILE)
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+    return {'chunks': len(dirty), 'books': written, 'seq': head}
+
+
+def _content_type(headers, path, url):
+    """Give the OPDS files their catalog media types."""
+    if url == settings.FEEDS_URL + 'opds.xml':
+        headers['Content-Type'] = OPDS_NAVIGATION
+    elif url.startswith(settings.FEEDS_URL + 'opds/'):
+        headers['Content-Type'] = OPDS_ACQUISITION
+
+
+class FeedFilesMiddleware:
+    """
+    Serve the feed files at FEEDS_URL with WhiteNoise.
+
+    The files are rewritten while the workers run, so they are looked up
+    on each request (WhiteNoise's autorefresh mode, for this directory
+    only) instead of being indexed at startup. Other URLs pass through.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.files = WhiteNoise(
+            None, autorefresh=True, max_age=settings.FEEDS_MAX_AGE, add_headers_function=_content_type,
+        )
+        self.files.add_files(settings.FEEDS_ROOT, prefix=settings.FEEDS_URL)
+
+    def __call__(self, request):
+        if request.path_info.startswith(settings.FEEDS_URL):
+            static_file = self.files.find_file(request.path_info)
+            if static_file is not None:
+                return WhiteNoiseMiddleware.serve(static_file, request)
+        return self.get_response(request)
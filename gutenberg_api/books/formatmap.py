@@ -0,0 +1,187 @@
+"""
+In-process map of format ids to download URLs.
+
+download_book resolves (book_id, format_id) here instead of querying the
+Book and Format tables. The map is array-backed: format ids, book ids,
+Gutenberg IDs and URL template and MIME type ids, so hundreds of thousands
+of formats take a few dozen bytes each instead of a model instance apiece. It is rebuilt
+when the catalog version changes (see books.catalog and books.signals),
+checked at most every LOOKUP_TABLES_CHECK_INTERVAL seconds like the
+lookup tables.
+"""
+
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from . import catalog, metrics, routers
+from .models import Format, FormatContent, MimeType, UrlTemplate
+
+logger = logging.getLogger(__name__)
+
+FormatEntry = namedtuple('FormatEntry', ['url', 'mime_type', 'content'])
+FormatEntry.__doc__ = """
+Download target of a format.
+
+Attributes:
+    url (str): Format URL
+    mime_type (str): MIME type of the format
+    content (FormatContent): Local copy (unsaved instance), or None
+"""
+
+
+class FormatMap:
+    """
+    Immutable array-backed map of format id -> (book id, URL, MIME type).
+
+    URLs are not stored: like the Format table, the map keeps each format's
+    URL template and the book's Gutenberg ID, and expands them on lookup.
+
+    Attributes:
+        version (int): Catalog version the map was built at
+    """
+
+    def __init__(self, rows, templates, mime_types, contents, version):
+        """
+        Args:
+            rows: (format_id, book_id, gutenberg_id, url_template_id, mime_id)
+                ordered by format_id
+            templates: Mapping of UrlTemplate id to template
+            mime_types: Mapping of MimeType id to name
+            contents: Mapping of format_id to (sha256, size, gzip_size)
+            version: Catalog version
+        """
+        self.format_ids = array('q')
+        self.book_ids = array('q')
+        self.gutenberg_ids = array('q')
+        self.template_ids = array('q')
+        self.mime_ids = array('q')
+        for format_id, book_id, gutenberg_id, template_id, mime_id in rows:
+            self.format_ids.append(format_id)
+            self.book_ids.append(book_id)
+            self.gutenberg_ids.append(gutenberg_id)
+            self.template_ids.append(template_id)
+            self.mime_ids.append(mime_id)
+        self.templates = templates
+        self.mime_types = mime_types
+        self.contents = contents
+        self.version = version
+
+    def __len__(self):
+        return len(self.format_ids)
+
+    @property
+    def max_id(self):
+        """Largest format id in the map (0 when empty)."""
+        return self.format_ids[-1] if self.format_ids else 0
+
+    def get(self, book_id, format_id):
+        """
+        Return the download target of a book's format.
+
+        Returns:
+            FormatEntry or None: None if the format does not exist or
+            belongs to another book
+        """
+        i = bisect_left(self.format_ids, format_id)
+        if i == len(self.format_ids) or self.format_ids[i] != format_id or self.book_ids[i] != book_id:
+            return None
+        content = self.contents.get(format_id)
+        if content is not None:
+            sha256, size, gzip_size = content
+            content = FormatContent(format_id=format_id, sha256=sha256, size=size, gzip_size=gzip_size)
+        return FormatEntry(
+            UrlTemplate.expand(self.templates[self.template_ids[i]], self.gutenberg_ids[i]),
+            self.mime_types[self.mime_ids[i]],
+            content,
+        )
+
+
+_map = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+@routers.on_primary()
+def load():
+    """
+    Build the map from the primary database.
+
+    Returns:
+        FormatMap: Fresh map
+    """
+    version = catalog.get_version()
+    rows = Format.objects.order_by('id').values_list(
+        'id', 'book_id', 'book__gutenberg_id', 'url_template_id', 'mime_id',
+    )
+    templates = dict(UrlTemplate.objects.values_list('id', 'template'))
+    mime_types = dict(MimeType.objects.values_list('id', 'name'))
+    contents = {
+        format_id: (sha256, size, gzip_size)
+        for format_id, sha256, size, gzip_size
+        in FormatContent.objects.values_list('format_id', 'sha256', 'size', 'gzip_size')
+    }
+    return FormatMap(rows.iterator(chunk_size=10000), templates, mime_types, contents, version)
+
+
+def get():
+    """
+    Return the current map, building or rebuilding it when needed.
+
+    Returns:
+        FormatMap: Current map
+    """
+    global _map, _checked_at
+    now = time.monotonic()
+    if _map is not None and now - _checked_at < settings.LOOKUP_TABLES_CHECK_INTERVAL:
+        return _map
+    with _lock:
+        if _map is None or catalog.get_version() != _map.version:
+            _map = load()
+        _checked_at = now
+    return _map
+
+
+def lookup(book_id, format_id):
+    """
+    Resolve a book's format to its download target.
+
+    The map is trusted: an unknown format or a mismatched pair is a miss
+    without a query. Only ids above the map's largest one (formats created
+    within the version check interval) are looked up in the database.
+
+    Returns:
+        FormatEntry or None: None if the format does not exist or belongs
+        to another book
+    """
+    current = get()
+    entry = current.get(book_id, format_id)
+    metrics.record_cache('formats', entry is not None)
+    if entry is None and format_id > current.max_id:
+        row = Format.objects.filter(pk=format_id, book_id=book_id).values_list(
+            'url_template__template', 'book__gutenberg_id', 'mime__name',
+        ).first()
+        if row is not None:
+            template, gutenberg_id, mime_type = row
+            content = FormatContent.objects.filter(format_id=format_id).first()
+            entry = FormatEntry(UrlTemplate.expand(template, gutenberg_id), mime_type, content)
+    return entry
+
+
+def preload():
+    """
+    Build the map before gunicorn forks its workers (see lookups.preload,
+    which closes the connections afterwards).
+    """
+    global _map, _checked_at
+    try:
+        _map = load()
+        _checked_at = time.monotonic()
+    except DatabaseError:
+        logger.warning('Could not preload the format map; it will be built on first use', exc_info=True)
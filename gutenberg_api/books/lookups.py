@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.models import Count
+
+from . import catalog, metrics, routers
+from .models import Bookshelf, Language, MimeType, Subject, UrlTemplate
+
+logger = logging.getLogger(__name__)
+
+LookupTables = namedtuple(
+    'LookupTables', ['languages', 'bookshelves', 'subjects', 'mime_types', 'url_templates', 'version'],
+)
+LookupTables.__doc__ = """
+Immutable in-process copy of the small dimension tables.
+
+Attributes:
+    languages (MappingProxyType): Language id -> code (whole table)
+    bookshelves (MappingProxyType): Bookshelf id -> name (whole table)
+    subjects (MappingProxyType): Subject id -> name for the most used subjects
+    mime_types (MappingProxyType): MimeType id -> name (whole table)
+    url_templates (MappingProxyType): UrlTemplate id -> template (whole table)
+    version (int): Catalog version the tables were loaded at
+"""
+
+# Tables holding every row; a miss there means the row is newer than the copy
+COMPLETE_TABLES = {
+    'languages': Language, 'bookshelves': Bookshelf, 'mime_types': MimeType, 'url_templates': UrlTemplate,
+}
+MODELS = {**COMPLETE_TABLES, 'subjects': Subject}
+NAME_FIELDS = {
+    'languages': 'code', 'bookshelves': 'name', 'subjects': 'name', 'mime_types': 'name', 'url_templates': 'template',
+}
+
+_tables = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+@routers.on_primary()
+def load():
+    """
+    Load the dimension tables from the primary database.
+
+    Returns:
+        LookupTables: Fresh immutable tables
+    """
+    version = catalog.get_version()
+    subjects = Subject.objects.annotate(book_count=Count('books')).order_by('-book_count')
+    return LookupTables(
+        languages=MappingProxyType(dict(Language.objects.values_list('id', 'code'))),
+        bookshelves=MappingProxyType(dict(Bookshelf.objects.values_list('id', 'name'))),
+        subjects=MappingProxyType(dict(
+            subjects.values_list('id', 'name')[:settings.LOOKUP_POPULAR_SUBJECTS]
+        )),
+        mime_types=MappingProxyType(dict(MimeType.objects.values_list('id', 'name'))),
+        url_templates=MappingProxyType(dict(UrlTemplate.objects.values_list('id', 'template'))),
+        version=version,
+    )
+
+
+def get():
+    """
+    Return the current lookup tables, loading or reloading them when needed.
+
+    The catalog version is checked at most every
+    LOOKUP_TABLES_CHECK_INTERVAL seconds; the tables are reloaded when it
+    changed since they were loaded.
+
+    Returns:
+        LookupTables: Current tables
+    """
+    global _tables, _checked_at
+    now = time.monotonic()
+    if _tables is not None and now - _checked_at < settings.LOOKUP_TABLES_CHECK_INTERVAL:
+        return _tables
+    with _lock:
+        if _tables is None or catalog.get_version() != _tables.version:
+            _tables = load()
+        _checked_at = now
+    return _tables
+
+
+def _reload():
+    """Reload the tables in this process."""
+    global _tables, _checked_at
+    with _lock:
+        _tables = load()
+        _checked_at = time.monotonic()
+    return _tables
+
+
+def refresh():
+    """
+    Reload the tables in this process and tell other workers to reload theirs.
+
+    Call after importing catalog data; model signals call it for ORM writes.
+    """
+    catalog.bump_version()
+    _reload()
+
+
+def lookup(table, pk, tables=None):
+    """
+    Resolve a dimension row id to its code/name.
+
+    Args:
+        table: 'languages', 'bookshelves', 'subjects', 'mime_types' or 'url_templates'
+        pk: Row id
+        tables: LookupTables to use (defaults to get())
+
+    Returns:
+        str or None: The code/name, or None if the row does not exist
+    """
+    tables = tables or get()
+    value = getattr(tables, table).get(pk)
+    metrics.record_cache('lookups', value is not None)
+    if value is None:
+        if table in COMPLETE_TABLES:
+            # The row is newer than our copy: reload this process's tables
+            return getattr(_reload(), table).get(pk)
+        value = MODELS[table].objects.filter(pk=pk).values_list(NAME_FIELDS[table], flat=True).first()
+    return value
+
+
+def resolve(table, pks, tables=None):
+    """
+    Resolve many dimension row ids to their codes/names.
+
+    Ids missing from the lookup tables cost one reload (tables holding
+    every row) or one query for all of them (subjects), not one each.
+
+    Args:
+        table: 'languages', 'bookshelves', 'subjects', 'mime_types' or 'url_templates'
+        pks: Row ids
+        tables: LookupTables to use (defaults to get())
+
+    Returns:
+        dict: Row id -> code/name, without ids of rows that do not exist
+    """
+    known = getattr(tables or get(), table)
+    names = {}
+    missing = []
+    for pk in pks:
+        value = known.get(pk)
+        metrics.record_cache('lookups', value is not None)
+        if value is None:
+            missing.append(pk)
+        else:
+            names[pk] = value
+    if missing:
+        if table in COMPLETE_TABLES:
+            known = getattr(_reload(), table)
+            names.update((pk, known[pk]) for pk in missing if pk in known)
+        else:
+            names.update(MODELS[table].objects.filter(pk__in=missing).values_list('pk', NAME_FIELDS[table]))
+    return names
+
+
+def preload():
+    """
+    Load the tables before gunicorn forks its workers.
+
+    With ``gunicorn --preload`` the tables are loaded once in the master
+    process and shared copy-on-write by all workers. Database connections
+    (and connection pools) opened for loading are closed so that no socket
+    is shared across the fork.
+    """
+    global _tables, _checked_at
+    try:
+        _tables = load()
+        _checked_at = time.monotonic()
+    except DatabaseError:
+        logger.warning('Could not preload lookup tables; they will be loaded on first use', exc_info=True)
+    for connection in connections.all(initialized_only=True):
+        connection.close()
+        if hasattr(connection, 'close_pool'):
+            connection.close_pool()
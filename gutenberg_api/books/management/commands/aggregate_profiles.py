@@ -0,0 +1,68 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from books.profiling import load_profiles
+
+
+class Command(BaseCommand):
+    """
+    Summarize the request profiles written by ProfilingMiddleware.
+
+    Prints the functions with the most samples (self and inclusive) and the
+    SQL statements with the most total time across the profiles, and writes
+    the merged collapsed stacks to --output, ready for flamegraph.pl or
+    speedscope.
+    """
+    help = 'Aggregate slow-request profiles into a flame-graph-ready summary'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.PROFILE_DIR,
+                            help='Profile directory (default: PROFILE_DIR)')
+        parser.add_argument('--view', help='Only aggregate profiles of this view name, e.g. book-list')
+        parser.add_argument('--output', help='Write the merged collapsed stacks to this file')
+        parser.add_argument('--top', type=int, default=20,
+                            help='Number of functions and SQL statements to list')
+
+    def handle(self, *args, **options):
+        if not options['dir']:
+            raise CommandError('Set PROFILE_DIR or pass --dir')
+        requests, stacks = load_profiles(options['dir'], options['view'])
+        if not requests:
+            self.stdout.write('No profiles found.')
+            return
+
+        total = sum(stacks.values())
+        self.stdout.write(
+            f"{len(requests)} requests, {sum(r['duration'] for r in requests):.2f}s, {total} samples"
+        )
+
+        leaf = Counter()
+        inclusive = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            leaf[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        for title, counter in (('Self', leaf), ('Inclusive', inclusive)):
+            self.stdout.write(f'\n{title} samples:')
+            for frame, count in counter.most_common(options['top']):
+                self.stdout.write(f'  {count / total:6.1%} {count:7d}  {frame}')
+
+        sql_time = Counter()
+        sql_calls = Counter()
+        for request in requests:
+            for query in request['queries']:
+                sql_time[query['sql']] += query['duration']
+                sql_calls[query['sql']] += 1
+        self.stdout.write('\nSQL by total time:')
+        for sql, seconds in sql_time.most_common(options['top']):
+            self.stdout.write(f'  {seconds * 1000:9.1f} ms {sql_calls[sql]:6d}x  {sql}')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            self.stdout.write(self.style.SUCCESS(f"\nMerged stacks written to {options['output']}."))
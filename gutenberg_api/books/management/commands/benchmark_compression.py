@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from books import compression
+
+
+class Command(BaseCommand):
+    """
+    Compare compression settings on a real response.
+
+    Fetches a page uncompressed, then reports for each encoding and level
+    the compressed size, the CPU time per compression and the CPU time of
+    serving it from the compressed-bytes cache instead.
+    """
+    help = 'Benchmark CPU time against bytes saved for response compression'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='/api/books/?page_size=100',
+                            help='Path to fetch (default: /api/books/?page_size=100)')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Compressions timed per setting')
+
+    def handle(self, *args, **options):
+        response = Client(HTTP_ACCEPT_ENCODING='identity').get(options['path'], HTTP_HOST='localhost')
+        if response.status_code != 200:
+            raise CommandError(f"{options['path']} returned {response.status_code}")
+        body = response.content
+        self.stdout.write(f"{options['path']}: {len(body)} bytes uncompressed\n")
+        self.stdout.write(f"{'encoding':<10}{'level':>6}{'bytes':>10}{'saved':>8}{'ms/call':>10}{'MB/s':>8}")
+
+        candidates = [('gzip', level) for level in (1, 6, 9)]
+        if compression.brotli is not None:
+            candidates += [('br', quality) for quality in (1, 5, 11)]
+        for encoding, level in candidates:
+            start = time.process_time()
+            for _ in range(options['repeat']):
+                compressed = compression.compress(body, encoding, level)
+            seconds = (time.process_time() - start) / options['repeat']
+            self.stdout.write(
+                f'{encoding:<10}{level:>6}{len(compressed):>10}{1 - len(compressed) / len(body):>8.1%}'
+                f'{seconds * 1000:>10.2f}{len(body) / max(seconds, 1e-9) / 1e6:>8.0f}'
+            )
+
+        encoding = compression.negotiate('br, gzip')
+        compression.cached_compress(body, encoding)
+        start = time.process_time()
+        for _ in range(options['repeat']):
+            compression.cached_compress(body, encoding)
+        seconds = (time.process_time() - start) / options['repeat']
+        self.stdout.write(f'\nCached {encoding} (configured level): {seconds * 1000:.3f} ms/call')
@@ -0,0 +1,49 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+
+from books import formatmap
+from books.models import Book, Format
+
+
+class Command(BaseCommand):
+    """
+    Measure how many download redirects per second a worker can resolve.
+
+    Compares resolving random (book, format) pairs through the in-process
+    format map with the previous two database lookups per click. Only the
+    lookup and redirect are timed; no download is counted.
+    """
+    help = 'Benchmark download redirect resolution: format map vs database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='Number of redirects resolved per method')
+
+    def handle(self, *args, **options):
+        pairs = list(Format.objects.values_list('book_id', 'id')[:10000])
+        if not pairs:
+            self.stdout.write('No formats to benchmark.')
+            return
+        sample = [random.choice(pairs) for _ in range(options['requests'])]
+
+        start = time.perf_counter()
+        table = formatmap.get()
+        self.stdout.write(f'Format map: {len(table)} formats, built in {time.perf_counter() - start:.2f}s')
+
+        def with_map(book_id, format_id):
+            return HttpResponseRedirect(formatmap.lookup(book_id, format_id).url)
+
+        def with_database(book_id, format_id):
+            get_object_or_404(Book, id=book_id)
+            return HttpResponseRedirect(get_object_or_404(Format.objects.select_related('book'), id=format_id).url)
+
+        for name, resolve in (('format map', with_map), ('database', with_database)):
+            start = time.perf_counter()
+            for book_id, format_id in sample:
+                resolve(book_id, format_id)
+            seconds = time.perf_counter() - start
+            self.stdout.write(f'{name:<12}{len(sample) / seconds:>12.0f} redirects/s')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from books import feeds
+
+
+class Command(BaseCommand):
+    """
+    Write the sitemaps and OPDS feeds, or bring them up to date.
+
+    Only the chunks of books in the change log since the last run are
+    rewritten, so the command is cheap to run often (e.g. from cron). The
+    first run, --full, and a changed base URL or chunk size rewrite
+    everything. Imports that bypass the ORM must log their changes (see
+    refresh_catalog --log-changes) to be picked up.
+    """
+    help = 'Write the sitemap and OPDS feed files into FEEDS_ROOT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Rewrite every chunk, not just the changed ones')
+        parser.add_argument('--base-url', default=None,
+                            help='Public URL of the site (default: FEEDS_BASE_URL)')
+
+    def handle(self, *args, **options):
+        result = feeds.build(full=options['full'], base_url=options['base_url'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Rewrote {result['chunks']} chunks ({result['books']} books), up to change {result['seq']}."
+        ))
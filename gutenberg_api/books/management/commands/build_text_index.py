@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from books import catalog, textindex
+from books.models import FormatContent
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the full-text index over the locally mirrored plain-text files.
+
+    One text per book is indexed (UTF-8 preferred). Tokenizing runs in a
+    process pool; the new index replaces the live one atomically, and
+    running workers pick it up on their next search.
+    """
+    help = 'Build the full-text search index from mirrored book texts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of tokenizer processes (default: CPU count)')
+        parser.add_argument('--chunksize', type=int, default=4,
+                            help='Books handed to a tokenizer process at a time')
+        parser.add_argument('--run-bytes', type=int, default=None,
+                            help='Postings buffered in memory before a sorted run is written '
+                                 '(default: TEXT_INDEX_RUN_BYTES)')
+
+    def handle(self, *args, **options):
+        texts = (
+            FormatContent.objects
+            .filter(format__mime__name__startswith='text/plain')
+            .order_by('format__book_id', '-format__mime__name')
+            .values_list('format__book_id', 'sha256')
+        )
+        documents = {}
+        for book_id, sha256 in texts:
+            documents.setdefault(book_id, sha256)
+
+        path = textindex.build(
+            list(documents.items()), options['workers'], options['chunksize'], options['run_bytes'],
+        )
+        catalog.touch()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {len(documents)} books into {path}.'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from books import denormalized
+
+
+class Command(BaseCommand):
+    """
+    Check that Book.language_ids and Book.bookshelf_ids match the through
+    tables.
+
+    ORM writes keep them in sync; bulk_create and raw SQL imports do not.
+    Exits with an error if books are out of sync, unless --fix is given,
+    which rewrites their arrays.
+    """
+    help = 'Check (and optionally fix) the denormalized language and bookshelf arrays'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Rewrite the arrays of out-of-sync books')
+
+    def handle(self, *args, **options):
+        if options['fix']:
+            updated = denormalized.sync()
+            self.stdout.write(self.style.SUCCESS(f'Resynced {updated} books.'))
+            return
+        stale = denormalized.mismatches()
+        if stale:
+            sample = ', '.join(str(pk) for pk in stale[:20])
+            raise CommandError(
+                f'{len(stale)} books are out of sync (e.g. {sample}); run with --fix.'
+            )
+        self.stdout.write(self.style.SUCCESS('All books are in sync.'))
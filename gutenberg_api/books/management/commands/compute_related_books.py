@@ -0,0 +1,117 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.functions import Coalesce
+
+from books import catalog
+from books.models import Book, BookAuthor, BookBookshelf, BookSubject, RelatedBook
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the precomputed related-books table.
+
+    Every book is described by a sparse vector of its subjects, bookshelves
+    and authors (IDF-weighted, L2-normalized). Book-to-book cosine similarity
+    is computed in batches with sparse matrix products, multiplied by the
+    candidate's popularity (1 + log(1 + download_count)), and the top-K
+    candidates per book are stored in RelatedBook, one batch at a time.
+    """
+    help = 'Compute top-K related books from shared subjects, bookshelves and authors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=10,
+                            help='Number of related books stored per book')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of books whose similarities are computed at once')
+        parser.add_argument('--subject-weight', type=float, default=1.0)
+        parser.add_argument('--bookshelf-weight', type=float, default=1.0)
+        parser.add_argument('--author-weight', type=float, default=2.0)
+
+    def handle(self, *args, **options):
+        try:
+            import numpy as np
+            from scipy import sparse
+        except ImportError as exc:
+            raise CommandError('compute_related_books requires numpy and scipy') from exc
+
+        # The books and their links are read in one snapshot, so links to
+        # books added or deleted meanwhile cannot be mismatched
+        connection = connections[DEFAULT_DB_ALIAS]
+        outermost = not connection.in_atomic_block
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            if connection.vendor == 'postgresql' and outermost:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            books = np.array(
+                Book.objects.using(DEFAULT_DB_ALIAS).order_by('id')
+                .values_list('id', Coalesce('download_count', 0)),
+                dtype=np.int64,
+            ).reshape(-1, 2)
+            links = [
+                np.array(model.objects.using(DEFAULT_DB_ALIAS).values_list('book_id', column), dtype=np.int64)
+                .reshape(-1, 2)
+                for model, column in ((BookSubject, 'subject_id'), (BookBookshelf, 'bookshelf_id'),
+                                      (BookAuthor, 'author_id'))
+            ]
+        if not len(books):
+            self.stdout.write('No books to process.')
+            return
+        book_ids = books[:, 0]
+        popularity = (1 + np.log1p(np.maximum(books[:, 1], 0))).astype(np.float32)
+
+        def incidence(pairs, weight):
+            """Build an IDF-weighted book x feature matrix from (book id, feature id) pairs."""
+            rows = np.minimum(np.searchsorted(book_ids, pairs[:, 0]), len(book_ids) - 1)
+            found = book_ids[rows] == pairs[:, 0]
+            rows, pairs = rows[found], pairs[found]
+            _, cols = np.unique(pairs[:, 1], return_inverse=True)
+            matrix = sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                shape=(len(book_ids), cols.max() + 1 if len(cols) else 0),
+            )
+            matrix.data[:] = 1  # collapse duplicate links
+            document_frequency = np.asarray((matrix > 0).sum(axis=0)).ravel()
+            idf = np.log(len(book_ids) / np.maximum(document_frequency, 1)).astype(np.float32)
+            return matrix @ sparse.diags(idf * weight)
+
+        features = sparse.hstack([
+            incidence(pairs, options[weight])
+            for pairs, weight in zip(links, ('subject_weight', 'bookshelf_weight', 'author_weight'))
+        ]).tocsr()
+        norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1)).ravel())
+        features = (sparse.diags(1 / np.where(norms > 0, norms, 1)) @ features).tocsr()
+        candidates = (features.T @ sparse.diags(popularity)).tocsc()
+
+        top_k = options['top_k']
+        stored = 0
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            RelatedBook.objects.using(DEFAULT_DB_ALIAS).all().delete()
+            for start in range(0, len(book_ids), options['batch_size']):
+                scores = (features[start:start + options['batch_size']] @ candidates).tocsr()
+                related = []
+                for offset in range(scores.shape[0]):
+                    row = start + offset
+                    lo, hi = scores.indptr[offset], scores.indptr[offset + 1]
+                    columns, values = scores.indices[lo:hi], scores.data[lo:hi]
+                    keep = (columns != row) & (values > 0)
+                    columns, values = columns[keep], values[keep]
+                    if len(values) > top_k:
+                        best = np.argpartition(-values, top_k)[:top_k]
+                        columns, values = columns[best], values[best]
+                    order = np.argsort(-values, kind='stable')
+                    related.extend(
+                        RelatedBook(
+                            book_id=int(book_ids[row]),
+                            related_id=int(book_ids[columns[i]]),
+                            rank=rank,
+                            score=float(values[i]),
+                        )
+                        for rank, i in enumerate(order, start=1)
+                    )
+                RelatedBook.objects.using(DEFAULT_DB_ALIAS).bulk_create(related, batch_size=5000)
+                stored += len(related)
+            catalog.touch(DEFAULT_DB_ALIAS)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {stored} related books for {len(book_ids)} books.'
+        ))
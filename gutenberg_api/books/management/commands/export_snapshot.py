@@ -0,0 +1,36 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from books import snapshot
+
+
+class Command(BaseCommand):
+    """
+    Export the catalog into a read-only SQLite snapshot for edge read nodes.
+
+    All catalog tables, the denormalized arrays, their indexes and the
+    full-text index are read in one transaction and written to a new file,
+    which then replaces ``path`` atomically. Ship the file to the edge
+    nodes and rename it over their SNAPSHOT_PATH; running workers switch
+    to it on their next request.
+    """
+    help = 'Export the catalog into a read-only SQLite snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Snapshot file to write (replaced atomically)')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='Database to export from (default: "default")')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        counts = snapshot.export(options['path'], using=options['database'])
+        seconds = time.perf_counter() - start
+        for table, count in counts.items():
+            self.stdout.write(f'{table:<32}{count:>12,}')
+        size = os.path.getsize(options['path'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {options['path']} ({size:,} bytes) in {seconds:.1f} s."
+        ))
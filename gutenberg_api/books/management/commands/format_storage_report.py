@@ -0,0 +1,125 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from books import lookups
+from books.models import Book, Format, MimeType, UrlTemplate
+
+TABLES = [Format._meta.db_table, MimeType._meta.db_table, UrlTemplate._meta.db_table]
+# Temporary copy of the formats in the previous layout (strings inline)
+INLINE_TABLE = 'format_inline_layout'
+CREATE_INLINE_SQL = f'''
+    CREATE TEMPORARY TABLE {INLINE_TABLE} AS
+    SELECT f.id, m.name::varchar(32) AS mime_type,
+           replace(t.template, %s, b.gutenberg_id::text)::varchar(256) AS url,
+           f.book_id
+    FROM {Format._meta.db_table} f
+    JOIN {MimeType._meta.db_table} m ON m.id = f.mime_id
+    JOIN {UrlTemplate._meta.db_table} t ON t.id = f.url_template_id
+    JOIN {Book._meta.db_table} b ON b.id = f.book_id
+'''
+SIZE_SQL = 'SELECT pg_relation_size(%s), pg_indexes_size(%s), pg_total_relation_size(%s)'
+
+
+class Command(BaseCommand):
+    """
+    Report the on-disk size of format storage and the cost of loading it.
+
+    On PostgreSQL, the formats are also copied to a temporary table in the
+    previous layout, where every row stored its full MIME type and URL
+    strings, with the same primary key and book index. The sizes of both
+    layouts are measured and the formats of a page of books are fetched
+    from each of them, so the report shows the measured size reduction and
+    the prefetch time before and after. The prefetch as the API does it
+    (through the ORM) is timed on every database.
+    """
+    help = 'Report format table sizes and prefetch timing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=100,
+                            help='Number of books whose formats are prefetched')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Number of timed prefetches')
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{Format.objects.count()} formats, {MimeType.objects.count()} MIME types, '
+            f'{UrlTemplate.objects.count()} URL templates'
+        )
+        ids = list(Book.objects.order_by('id').values_list('id', flat=True)[:options['books']])
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                try:
+                    self.compare_layouts(cursor, ids, options['repeat'])
+                finally:
+                    cursor.execute(f'DROP TABLE IF EXISTS {INLINE_TABLE}')
+        else:
+            self.stdout.write('Table sizes are only reported on PostgreSQL.')
+
+        if not ids:
+            self.stdout.write('No books to prefetch.')
+            return
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            urls = [
+                (book_format.mime_type, book_format.url)
+                for book in Book.objects.filter(id__in=ids).prefetch_related('formats')
+                for book_format in book.formats.all()
+            ]
+        seconds = (time.perf_counter() - start) / options['repeat']
+        self.stdout.write(f'Prefetching {len(urls)} formats of {len(ids)} books: {seconds * 1000:.1f} ms')
+
+    def compare_layouts(self, cursor, ids, repeat):
+        """
+        Print the sizes of both layouts and the time to fetch formats from each.
+
+        Args:
+            cursor: PostgreSQL cursor
+            ids: Ids of the books whose formats are fetched
+            repeat: Number of timed fetches per layout
+        """
+        cursor.execute(CREATE_INLINE_SQL, [UrlTemplate.PLACEHOLDER])
+        cursor.execute(f'ALTER TABLE {INLINE_TABLE} ADD PRIMARY KEY (id)')
+        cursor.execute(f'CREATE INDEX ON {INLINE_TABLE} (book_id)')
+        cursor.execute(f'ANALYZE {INLINE_TABLE}')
+
+        self.stdout.write(f"{'table':<24}{'heap':>12}{'indexes':>12}{'total':>12}")
+        before = after = 0
+        for table in [INLINE_TABLE, *TABLES]:
+            cursor.execute(SIZE_SQL, [table] * 3)
+            heap, indexes, total = cursor.fetchone()
+            self.stdout.write(f'{table:<24}{heap:>12,}{indexes:>12,}{total:>12,}')
+            if table == INLINE_TABLE:
+                before = total
+            else:
+                after += total
+        self.stdout.write(f'Previous layout: {before:,} bytes')
+        self.stdout.write(f'Current layout:  {after:,} bytes ({before - after:+,} bytes saved)')
+
+        if not ids:
+            return
+        start = time.perf_counter()
+        for _ in range(repeat):
+            cursor.execute(
+                f'SELECT id, book_id, mime_type, url FROM {INLINE_TABLE} WHERE book_id = ANY(%s)', [ids],
+            )
+            rows = cursor.fetchall()
+        inline = (time.perf_counter() - start) / repeat
+        gutenberg_ids = dict(Book.objects.filter(id__in=ids).values_list('id', 'gutenberg_id'))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            cursor.execute(
+                f'SELECT id, book_id, mime_id, url_template_id FROM {Format._meta.db_table} '
+                'WHERE book_id = ANY(%s)', [ids],
+            )
+            rows = [
+                (format_id, book_id, lookups.lookup('mime_types', mime_id),
+                 UrlTemplate.expand(lookups.lookup('url_templates', template_id), gutenberg_ids[book_id]))
+                for format_id, book_id, mime_id, template_id in cursor.fetchall()
+            ]
+        referenced = (time.perf_counter() - start) / repeat
+        self.stdout.write(
+            f'Fetching {len(rows)} formats of {len(ids)} books: '
+            f'{inline * 1000:.2f} ms before, {referenced * 1000:.2f} ms after'
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from books.schema import read_fingerprint, generate_schema, schema_dir, schema_fingerprint
+
+
+class Command(BaseCommand):
+    """
+    Generate the persisted OpenAPI document.
+
+    Run at deploy time after collectstatic: the document is written with
+    precompressed variants to STATIC_ROOT/schema/, where WhiteNoise serves it
+    and the /swagger/ and /redoc/ views read it. Generation is skipped when
+    the schema fingerprint is unchanged.
+    """
+    help = 'Generate the OpenAPI schema into STATIC_ROOT/schema/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate even if the fingerprint is unchanged')
+
+    def handle(self, *args, **options):
+        fingerprint = schema_fingerprint()
+        if not options['force'] and read_fingerprint() == fingerprint:
+            self.stdout.write(f'Schema {fingerprint[:12]} is up to date.')
+            return
+        generate_schema(fingerprint)
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated schema {fingerprint[:12]} in {schema_dir()}.'
+        ))
@@ -0,0 +1,58 @@
+import os
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books import catalog
+from books.content import store_file
+from books.models import Format, FormatContent, UrlTemplate
+
+
+def url_filename(url):
+    """Last path component of a format URL, e.g. 'pg1342.epub'."""
+    return os.path.basename(urlparse(url).path)
+
+
+class Command(BaseCommand):
+    """
+    Mirror book files from a local directory into the content store.
+
+    Files are matched to formats by the file name of the format URL, e.g.
+    https://www.gutenberg.org/cache/epub/1342/pg1342.epub matches any file
+    named pg1342.epub below the directory. When several books share a file
+    name, a file under a directory named after the book's Gutenberg ID
+    (e.g. 1342/pg1342.epub) takes precedence. Workers reload their format
+    map once, after the import.
+    """
+    help = 'Import book files from a directory into the local content store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory containing book files')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f'{directory} is not a directory')
+
+        by_name = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                by_name.setdefault(name, []).append(path)
+
+        imported = 0
+        with catalog.batch():
+            formats = Format.objects.values_list('id', 'url_template__template', 'mime__name', 'book__gutenberg_id')
+            for format_id, template, mime_type, gutenberg_id in formats.iterator():
+                candidates = by_name.get(url_filename(UrlTemplate.expand(template, gutenberg_id)))
+                if not candidates:
+                    continue
+                preferred = [p for p in candidates if os.path.basename(os.path.dirname(p)) == str(gutenberg_id)]
+                sha256, size, gzip_size = store_file((preferred or candidates)[0], mime_type)
+                FormatContent.objects.update_or_create(
+                    format_id=format_id,
+                    defaults={'sha256': sha256, 'size': size, 'gzip_size': gzip_size},
+                )
+                imported += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} files.'))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from gutenberg_api.startup import measure_boot
+
+
+class Command(BaseCommand):
+    """
+    Report how long a fresh gunicorn worker takes to boot.
+
+    Boots the application in a new interpreter with ``-X importtime`` and
+    prints the boot phase timings and the slowest imports. With --budget it
+    fails when the boot exceeds the given number of seconds, so it can be
+    used as a startup benchmark in CI.
+    """
+    help = 'Profile worker startup: boot phases and per-module import times'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=25,
+                            help='Number of slowest imports to list')
+        parser.add_argument('--budget', type=float,
+                            help='Fail if booting takes longer than this many seconds')
+
+    def handle(self, *args, **options):
+        report = measure_boot()
+
+        self.stdout.write(f"Interpreter start to ready: {report['wall'] * 1000:.0f} ms")
+        for phase, seconds in report['phases'].items():
+            self.stdout.write(f'  {phase:<12} {seconds * 1000:8.1f} ms')
+
+        self.stdout.write(f"\nSlowest imports (cumulative, self) of {len(report['imports'])}:")
+        for module, self_time, cumulative in sorted(
+            report['imports'], key=lambda item: item[2], reverse=True
+        )[:options['top']]:
+            self.stdout.write(f'  {cumulative * 1000:8.1f} ms {self_time * 1000:8.1f} ms  {module}')
+
+        if report['lazy']:
+            self.stdout.write(self.style.WARNING(
+                f"\nLoaded at boot although meant to be lazy: {', '.join(report['lazy'])}"
+            ))
+        if options['budget'] is not None and report['phases']['total'] > options['budget']:
+            raise CommandError(
+                f"Boot took {report['phases']['total']:.2f}s, over the {options['budget']:.2f}s budget"
+            )
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from books import catalog, changes
+from books.models import Book
+
+
+class Command(BaseCommand):
+    """
+    Tell running workers that the catalog changed.
+
+    Run after importing catalog data outside the ORM (e.g. pg_restore or raw
+    SQL), which bypasses the model signals that normally do this. Workers
+    reload their in-memory copies on their next version check. Follow with
+    ``check_book_arrays --fix`` if book languages or bookshelves changed.
+    With --log-changes every book is also logged in the change feed, so
+    mirrors pick up the import.
+    """
+    help = 'Bump the catalog version so workers reload in-memory catalog data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log-changes', action='store_true',
+                            help='Log every book in the change feed (/api/changes/)')
+
+    def handle(self, *args, **options):
+        if options['log_changes']:
+            book_ids = list(Book.objects.values_list('id', flat=True))
+            changes.record(book_ids)
+            self.stdout.write(f'Logged {len(book_ids)} books in the change feed.')
+        version = catalog.bump_version()
+        self.stdout.write(self.style.SUCCESS(f'Catalog version is now {version}.'))
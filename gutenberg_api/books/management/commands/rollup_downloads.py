@@ -0,0 +1,101 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+
+from books import catalog, changes
+from books.downloads import add_to_buckets
+from books.models import Book, DownloadBucket
+
+
+class Command(BaseCommand):
+    """
+    Roll up download buckets and recompute trending scores.
+
+    1. Hourly buckets older than --hourly-retention hours are summed into
+       daily buckets and deleted.
+    2. Daily buckets older than --daily-retention days are deleted.
+    3. Book.trending_score is recomputed from the buckets of the last
+       --window days, each download decaying with a half-life of
+       --half-life hours.
+    4. Books downloaded in the last --changes-hours hours are logged in
+       the change feed, so mirrors pick up their download counts once per
+       rollup rather than on every flush.
+
+    Intended to run periodically (e.g. hourly from cron). Clicks still
+    buffered by the web workers (see books.downloads) are not flushed by
+    this process; they land in the buckets within DOWNLOAD_FLUSH_INTERVAL
+    and are counted by the next rollup.
+    """
+    help = 'Fold hourly download buckets into daily ones and recompute trending scores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hourly-retention', type=int, default=48,
+                            help='Hours of hourly buckets to keep')
+        parser.add_argument('--daily-retention', type=int, default=90,
+                            help='Days of daily buckets to keep')
+        parser.add_argument('--window', type=int, default=7,
+                            help='Days of downloads contributing to trending scores')
+        parser.add_argument('--half-life', type=float, default=24,
+                            help='Hours after which a download counts half')
+        parser.add_argument('--changes-hours', type=int, default=2,
+                            help='Hours of downloads logged in the change feed (cover the interval between runs)')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        folded = self.fold_hourly(now - timedelta(hours=options['hourly_retention']))
+        expired, _ = DownloadBucket.objects.filter(
+            granularity=DownloadBucket.DAY,
+            bucket_start__lt=now - timedelta(days=options['daily_retention']),
+        ).delete()
+        scored = self.update_trending(now, options['window'], options['half_life'])
+        downloaded = DownloadBucket.objects.filter(
+            granularity=DownloadBucket.HOUR,
+            bucket_start__gte=now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=options['changes_hours']),
+        ).values_list('book_id', flat=True).distinct()
+        changes.record(downloaded)
+        catalog.touch()
+        self.stdout.write(self.style.SUCCESS(
+            f'Folded {folded} hourly buckets, expired {expired} daily buckets, '
+            f'scored {scored} trending books.'
+        ))
+
+    def fold_hourly(self, cutoff):
+        """Sum hourly buckets of whole days before ``cutoff`` into daily buckets."""
+        cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+        old = DownloadBucket.objects.filter(granularity=DownloadBucket.HOUR, bucket_start__lt=cutoff)
+        with transaction.atomic():
+            daily = {
+                (row['book_id'], row['day']): row['total']
+                for row in old.annotate(day=TruncDay('bucket_start'))
+                .values('book_id', 'day')
+                .annotate(total=Sum('count'))
+            }
+            if daily:
+                add_to_buckets(daily, DownloadBucket.DAY)
+            folded, _ = old.delete()
+        return folded
+
+    def update_trending(self, now, window, half_life):
+        """Recompute Book.trending_score from recent buckets."""
+        scores = Counter()
+        buckets = DownloadBucket.objects.filter(bucket_start__gte=now - timedelta(days=window))
+        midpoint = {DownloadBucket.HOUR: timedelta(minutes=30), DownloadBucket.DAY: timedelta(hours=12)}
+        for book_id, granularity, bucket_start, count in buckets.values_list(
+            'book_id', 'granularity', 'bucket_start', 'count'
+        ).iterator():
+            age = max((now - bucket_start - midpoint[granularity]).total_seconds() / 3600, 0)
+            scores[book_id] += count * 0.5 ** (age / half_life)
+
+        with transaction.atomic():
+            Book.objects.filter(trending_score__gt=0).exclude(id__in=list(scores)).update(trending_score=0)
+            Book.objects.bulk_update(
+                [Book(id=book_id, trending_score=score) for book_id, score in scores.items()],
+                ['trending_score'],
+                batch_size=1000,
+            )
+        return len(scores)
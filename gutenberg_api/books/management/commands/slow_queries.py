@@ -0,0 +1,53 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from books.slowqueries import get_log
+
+
+class Command(BaseCommand):
+    """
+    Rank filter shapes by the time their slow queries took.
+
+    Reads the slow query log (SLOW_QUERY_LOG and its rotated files), groups
+    the entries by view and filter shape (which filters were used, not their
+    values) and lists the worst shapes with their slowest normalized SQL and,
+    when one was captured, its plan.
+    """
+    help = 'Summarize the slow query log by view and filter shape'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of filter shapes to list')
+        parser.add_argument('--view', help='Only include queries of this view name, e.g. book-list')
+        parser.add_argument('--plans', action='store_true',
+                            help='Print the captured plan of each shape')
+
+    def handle(self, *args, **options):
+        if not settings.SLOW_QUERY_LOG:
+            raise CommandError('SLOW_QUERY_LOG is not set')
+
+        shapes = defaultdict(list)
+        for entry in get_log().entries():
+            if options['view'] and entry['view'] != options['view']:
+                continue
+            shapes[(entry['view'], entry['shape'])].append(entry)
+        if not shapes:
+            self.stdout.write('No slow queries logged.')
+            return
+
+        ranked = sorted(shapes.items(), key=lambda item: sum(e['duration'] for e in item[1]), reverse=True)
+        for (view, shape), entries in ranked[:options['top']]:
+            durations = sorted(e['duration'] for e in entries)
+            worst = max(entries, key=lambda e: e['duration'])
+            self.stdout.write(
+                f"{view} {shape}: {len(entries)} slow queries, total {sum(durations):.2f}s, "
+                f"median {durations[len(durations) // 2] * 1000:.0f} ms, max {durations[-1] * 1000:.0f} ms"
+            )
+            self.stdout.write(f"  e.g. ?{'&'.join(f'{k}={v}' for k, v in worst['params'].items())}")
+            self.stdout.write(f"  {worst['sql']}")
+            plan = next((e['plan'] for e in sorted(entries, key=lambda e: -e['duration']) if e['plan']), None)
+            if options['plans'] and plan:
+                for line in plan.splitlines():
+                    self.stdout.write(f'    {line}')
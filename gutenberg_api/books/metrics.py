@@ -0,0 +1,172 @@
+"""
+Prometheus metrics.
+
+Under gunicorn, every worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and /metrics
+aggregates the files of all workers. Without that variable (runserver,
+management commands) the samples stay in process.
+
+/metrics is only served to the addresses in METRICS_ALLOWED_IPS, or to
+scrapers presenting METRICS_TOKEN as a bearer token.
+"""
+
+import ipaddress
+import os
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from rest_framework.throttling import BaseThrottle
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Request latency by view',
+    ['view', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries per request by view',
+    ['view'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Database query time by connection alias',
+    ['alias'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+CACHE_REQUESTS = Counter(
+    'cache_requests', 'Cache lookups by cache and result (hit or miss)',
+    ['cache', 'result'],
+)
+DOWNLOAD_FLUSH_CLICKS = Histogram(
+    'download_flush_clicks', 'Download clicks written per flush',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+PAGE_DEPTH = Histogram(
+    'pagination_page_number', 'Requested page number of paginated lists',
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 500, 1000),
+)
+
+# Methods recorded as such; any other method is labeled 'other'
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+_local = threading.local()
+
+
+def observe_query(execute, sql, params, many, context):
+    """Database execute wrapper timing each query (see install_query_metrics)."""
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_DURATION.labels(context['connection'].alias).observe(time.perf_counter() - start)
+        _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def install_query_metrics(sender, connection, **kwargs):
+    """``connection_created`` receiver adding observe_query to the connection."""
+    if observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(observe_query)
+
+
+def record_cache(cache, hit):
+    """Count a cache lookup."""
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+class MetricsMiddleware:
+    """
+    Record latency and database queries of every request, labeled by view.
+
+    The view label is the URL pattern name (e.g. 'book-list') and the method
+    label is one of METHODS or 'other', so the number of label values is
+    bounded by the URLconf.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.queries = 0
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        method = request.method if request.method in METHODS else 'other'
+        REQUEST_LATENCY.labels(view, method, response.status_code).observe(time.perf_counter() - start)
+        REQUEST_QUERIES.labels(view).observe(_local.queries)
+        return response
+
+
+class _MeteredCache:
+    """Cache backend mixin counting hits and misses of get()."""
+
+    _missing = object()
+
+    def __init__(self, location, params):
+        super().__init__(location, params)
+        self.metrics_name = params.get('OPTIONS', {}).get('METRICS_NAME', type(self).__name__)
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, self._missing, version)
+        record_cache(self.metrics_name, value is not self._missing)
+        return default if value is self._missing else value
+
+
+class MeteredLocMemCache(_MeteredCache, LocMemCache):
+    """LocMemCache counting hits and misses."""
+
+
+class MeteredFileBasedCache(_MeteredCache, FileBasedCache):
+    """FileBasedCache counting hits and misses."""
+
+
+def render_metrics(multiprocess_dir=None):
+    """
+    Render the metrics in the Prometheus text format.
+
+    Args:
+        multiprocess_dir: Directory of multiprocess sample files to
+                          aggregate (defaults to PROMETHEUS_MULTIPROC_DIR;
+                          if neither is set, this process's metrics)
+
+    Returns:
+        bytes: The exposition text
+    """
+    multiprocess_dir = multiprocess_dir or os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not multiprocess_dir:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry, path=multiprocess_dir)
+    return generate_latest(registry)
+
+
+def allowed(request):
+    """
+    Return whether a request may read the metrics.
+
+    Args:
+        request: HTTP request
+
+    Returns:
+        bool: True for clients in METRICS_ALLOWED_IPS or presenting METRICS_TOKEN
+    """
+    if settings.METRICS_TOKEN:
+        scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() == 'bearer' and secrets.compare_digest(token.strip(), settings.METRICS_TOKEN):
+            return True
+    try:
+        # The client address as throttling sees it (see NUM_PROXIES)
+        address = ipaddress.ip_address(BaseThrottle().get_ident(request))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in settings.METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """Expose the metrics of all workers for Prometheus to scrape."""
+    if not allowed(request):
+        return HttpResponseForbidden('Metrics are not available to this client.')
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
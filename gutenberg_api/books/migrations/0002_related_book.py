@@ -0,0 +1,56 @@
+# Generated by Django 5.1.5 on 2026-10-19 08:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RelatedBook",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("rank", models.SmallIntegerField()),
+                ("score", models.FloatField()),
+                (
+                    "book",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="related_books",
+                        to="books.book",
+                    ),
+                ),
+                (
+                    "related",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="books.book",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "books_related_book",
+                "ordering": ["rank"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("book", "rank"), name="books_related_book_rank_uniq"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.1.5 on 2026-10-19 08:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0002_related_book"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DownloadBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "granularity",
+                    models.CharField(
+                        choices=[("h", "Hour"), ("d", "Day")], max_length=1
+                    ),
+                ),
+                ("bucket_start", models.DateTimeField()),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "db_table": "books_download_bucket",
+            },
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="trending_score",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["-trending_score", "-download_count"],
+                name="books_book_trending_idx",
+            ),
+        ),
+        migrations.AddField(
+            model_name="downloadbucket",
+            name="book",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="download_buckets",
+                to="books.book",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="downloadbucket",
+            index=models.Index(
+                fields=["granularity", "bucket_start"],
+                name="books_download_bucket_time_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="downloadbucket",
+            constraint=models.UniqueConstraint(
+                fields=("book", "granularity", "bucket_start"),
+                name="books_download_bucket_uniq",
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-19 08:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0003_download_buckets"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FormatContent",
+            fields=[
+                (
+                    "format",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="content",
+                        serialize=False,
+                        to="books.format",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64)),
+                ("size", models.BigIntegerField()),
+                ("gzip_size", models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "books_format_content",
+            },
+        ),
+    ]
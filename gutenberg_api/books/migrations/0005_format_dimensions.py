@@ -0,0 +1,147 @@
+# Generated by Django 5.1.5 on 2026-10-19 08:35
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 5000
+
+
+def template_for(url, gutenberg_id):
+    # Same as UrlTemplate.template_for (historical models have no methods)
+    scheme_end = url.find("//")
+    start = url.find("/", scheme_end + 2) if scheme_end >= 0 else 0
+    if start < 0:
+        return url
+    path = re.sub(
+        rf"(?<=/)(pg)?{gutenberg_id}(?=[/.-]|$)",
+        lambda match: (match.group(1) or "") + "{id}",
+        url[start:],
+    )
+    return url[:start] + path
+
+
+def split_formats(apps, schema_editor):
+    Format = apps.get_model("books", "Format")
+    MimeType = apps.get_model("books", "MimeType")
+    UrlTemplate = apps.get_model("books", "UrlTemplate")
+    mime_ids = {}
+    template_ids = {}
+    batch = []
+    rows = Format.objects.order_by("id").values_list(
+        "id", "mime_type", "url", "book__gutenberg_id"
+    )
+    for format_id, mime_type, url, gutenberg_id in rows.iterator(chunk_size=BATCH_SIZE):
+        template = template_for(url, gutenberg_id)
+        if mime_type not in mime_ids:
+            mime_ids[mime_type] = MimeType.objects.get_or_create(name=mime_type)[0].id
+        if template not in template_ids:
+            template_ids[template] = UrlTemplate.objects.get_or_create(
+                template=template
+            )[0].id
+        batch.append(
+            Format(
+                id=format_id,
+                mime_id=mime_ids[mime_type],
+                url_template_id=template_ids[template],
+            )
+        )
+        if len(batch) == BATCH_SIZE:
+            Format.objects.bulk_update(batch, ["mime", "url_template"])
+            batch = []
+    Format.objects.bulk_update(batch, ["mime", "url_template"])
+
+
+def join_formats(apps, schema_editor):
+    Format = apps.get_model("books", "Format")
+    batch = []
+    rows = Format.objects.order_by("id").values_list(
+        "id", "mime__name", "url_template__template", "book__gutenberg_id"
+    )
+    for format_id, mime_type, template, gutenberg_id in rows.iterator(
+        chunk_size=BATCH_SIZE
+    ):
+        url = template.replace("{id}", str(gutenberg_id))
+        batch.append(Format(id=format_id, mime_type=mime_type, url=url))
+        if len(batch) == BATCH_SIZE:
+            Format.objects.bulk_update(batch, ["mime_type", "url"])
+            batch = []
+    Format.objects.bulk_update(batch, ["mime_type", "url"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0004_format_content"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MimeType",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=32, unique=True)),
+            ],
+            options={
+                "db_table": "books_mime_type",
+            },
+        ),
+        migrations.CreateModel(
+            name="UrlTemplate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("template", models.CharField(max_length=256, unique=True)),
+            ],
+            options={
+                "db_table": "books_url_template",
+            },
+        ),
+        migrations.AlterField(
+            model_name="format",
+            name="mime_type",
+            field=models.CharField(max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name="format",
+            name="url",
+            field=models.CharField(max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name="format",
+            name="mime",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="formats",
+                to="books.mimetype",
+            ),
+        ),
+        migrations.AddField(
+            model_name="format",
+            name="url_template",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="formats",
+                to="books.urltemplate",
+            ),
+        ),
+        migrations.RunPython(split_formats, join_formats),
+    ]
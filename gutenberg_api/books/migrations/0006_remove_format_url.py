@@ -0,0 +1,42 @@
+# Generated by Django 5.1.5 on 2026-10-19 08:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Separate from 0005: PostgreSQL cannot alter the table in the
+    # transaction that updated its rows.
+
+    dependencies = [
+        ("books", "0005_format_dimensions"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="format",
+            name="mime",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="formats",
+                to="books.mimetype",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="format",
+            name="url_template",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="formats",
+                to="books.urltemplate",
+            ),
+        ),
+        migrations.RemoveField(
+            model_name="format",
+            name="mime_type",
+        ),
+        migrations.RemoveField(
+            model_name="format",
+            name="url",
+        ),
+    ]
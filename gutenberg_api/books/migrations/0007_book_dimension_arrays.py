@@ -0,0 +1,63 @@
+# Generated by Django 5.1.5 on 2026-10-19 09:01
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0006_remove_format_url"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="bookshelf_ids",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.BigIntegerField(),
+                default=list,
+                editable=False,
+                size=None,
+            ),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="language_ids",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.BigIntegerField(),
+                default=list,
+                editable=False,
+                size=None,
+            ),
+        ),
+        # Fill the arrays before indexing them (same query as
+        # books.denormalized.sync)
+        migrations.RunSQL(
+            """
+            UPDATE books_book b SET
+                language_ids = COALESCE((
+                    SELECT array_agg(t.language_id ORDER BY t.language_id)
+                    FROM books_book_languages t WHERE t.book_id = b.id
+                ), '{}'),
+                bookshelf_ids = COALESCE((
+                    SELECT array_agg(t.bookshelf_id ORDER BY t.bookshelf_id)
+                    FROM books_book_bookshelves t WHERE t.book_id = b.id
+                ), '{}')
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["language_ids"], name="books_book_language_ids_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["bookshelf_ids"], name="books_book_bookshelf_ids_gin"
+            ),
+        ),
+    ]
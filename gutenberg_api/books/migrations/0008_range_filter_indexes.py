@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-19 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0007_book_dimension_arrays"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="author",
+            index=models.Index(
+                condition=models.Q(("birth_year__isnull", False)),
+                fields=["birth_year", "death_year"],
+                name="books_author_lifespan_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="author",
+            index=models.Index(
+                condition=models.Q(("death_year__isnull", False)),
+                fields=["death_year"],
+                name="books_author_death_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["-download_count"], name="books_book_downloads_idx"
+            ),
+        ),
+    ]
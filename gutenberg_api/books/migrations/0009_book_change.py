@@ -0,0 +1,43 @@
+# Generated by Django 5.1.5 on 2026-10-19 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0008_range_filter_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookChange",
+            fields=[
+                ("seq", models.BigAutoField(primary_key=True, serialize=False)),
+                ("book_id", models.BigIntegerField()),
+                (
+                    "action",
+                    models.CharField(
+                        choices=[("u", "upsert"), ("d", "delete")], max_length=1
+                    ),
+                ),
+                ("changed_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "db_table": "books_book_change",
+                "indexes": [
+                    models.Index(
+                        fields=["book_id", "seq"], name="books_book_change_book_idx"
+                    )
+                ],
+            },
+        ),
+        # Mirrors starting from since=0 get every existing book
+        migrations.RunSQL(
+            """
+            INSERT INTO books_book_change (book_id, action, changed_at)
+            SELECT id, 'u', now() FROM books_book ORDER BY id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
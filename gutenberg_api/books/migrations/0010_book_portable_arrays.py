@@ -0,0 +1,34 @@
+# Generated by Django 5.1.5 on 2026-10-19 09:12
+
+import books.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0009_book_change"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="book",
+            name="bookshelf_ids",
+            field=books.models.IdArrayField(
+                base_field=models.BigIntegerField(),
+                default=list,
+                editable=False,
+                size=None,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="book",
+            name="language_ids",
+            field=books.models.IdArrayField(
+                base_field=models.BigIntegerField(),
+                default=list,
+                editable=False,
+                size=None,
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.5 on 2026-10-19 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0010_book_portable_arrays"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingBookChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("book_id", models.BigIntegerField()),
+                (
+                    "action",
+                    models.CharField(
+                        choices=[("u", "upsert"), ("d", "delete")], max_length=1
+                    ),
+                ),
+                ("changed_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "db_table": "books_book_change_pending",
+            },
+        ),
+    ]
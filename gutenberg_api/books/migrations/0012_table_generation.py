@@ -0,0 +1,26 @@
+# Generated by Django 5.1.5 on 2026-10-19 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0011_pending_book_change"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TableGeneration",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("generation", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "db_table": "books_table_generation",
+            },
+        ),
+    ]
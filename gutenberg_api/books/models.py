@@ -1,5 +1,36 @@
+import json
+import re
+
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 
+from .querycache import CachedQuerySet
+
+class IdArrayField(ArrayField):
+    """
+    ArrayField of ids that can also be stored in SQLite.
+
+    PostgreSQL gets a native array column. SQLite (read-only catalog
+    snapshots, see books.snapshot) has no array type, so the ids are stored
+    there as a JSON list in a text column.
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == 'sqlite':
+            return 'text'
+        return super().db_type(connection)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if connection.vendor == 'sqlite' and value is not None:
+            return json.dumps(list(value))
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def from_db_value(self, value, expression, connection):
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
 class Author(models.Model):
     """
     Model representing an author of a book.
@@ -13,8 +44,21 @@ class Author(models.Model):
     death_year = models.SmallIntegerField(null=True, blank=True)
     name = models.CharField(max_length=128)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_author'
+        indexes = [
+            # Authors with unknown years never match a year filter
+            models.Index(
+                fields=['birth_year', 'death_year'], name='books_author_lifespan_idx',
+                condition=models.Q(birth_year__isnull=False),
+            ),
+            models.Index(
+                fields=['death_year'], name='books_author_death_idx',
+                condition=models.Q(death_year__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         """String representation of the Author object."""
@@ -30,6 +74,8 @@ class Language(models.Model):
     """
     code = models.CharField(max_length=4, unique=True)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_language'
 
@@ -46,6 +92,8 @@ class Subject(models.Model):
     """
     name = models.CharField(max_length=256)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_subject'
 
@@ -62,6 +110,8 @@ class Bookshelf(models.Model):
     """
     name = models.CharField(max_length=64, unique=True)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_bookshelf'
 
@@ -82,6 +132,12 @@ class Book(models.Model):
         languages (ManyToManyField): Related Language objects through BookLanguage
         subjects (ManyToManyField): Related Subject objects through BookSubject
         bookshelves (ManyToManyField): Related Bookshelf objects through BookBookshelf
+        trending_score (FloatField): Recent-download score, recomputed by the
+                                     rollup_downloads management command
+        language_ids (IdArrayField): Ids of the book's languages, a copy of
+                                   BookLanguage kept in sync by books.denormalized
+        bookshelf_ids (IdArrayField): Ids of the book's bookshelves, a copy of
+                                    BookBookshelf kept in sync by books.denormalized
     """
     gutenberg_id = models.IntegerField(unique=True)
     download_count = models.IntegerField(null=True, blank=True)
@@ -91,28 +147,123 @@ class Book(models.Model):
     languages = models.ManyToManyField(Language, related_name='books', through='BookLanguage')
     subjects = models.ManyToManyField(Subject, related_name='books', through='BookSubject')
     bookshelves = models.ManyToManyField(Bookshelf, related_name='books', through='BookBookshelf')
+    trending_score = models.FloatField(default=0)
+    language_ids = IdArrayField(models.BigIntegerField(), default=list, editable=False)
+    bookshelf_ids = IdArrayField(models.BigIntegerField(), default=list, editable=False)
+
+    objects = CachedQuerySet.as_manager()
 
     class Meta:
         db_table = 'books_book'
         ordering = ['-download_count']  # Order by download count in descending order
+        indexes = [
+            models.Index(fields=['-trending_score', '-download_count'], name='books_book_trending_idx'),
+            models.Index(fields=['-download_count'], name='books_book_downloads_idx'),
+            GinIndex(fields=['language_ids'], name='books_book_language_ids_gin'),
+            GinIndex(fields=['bookshelf_ids'], name='books_book_bookshelf_ids_gin'),
+        ]
 
     def __str__(self):
         """String representation of the Book object."""
         return self.title or f"Book {self.gutenberg_id}"
 
+    @property
+    def subject_ids(self):
+        """Ids of the book's subjects, read from the BookSubject rows (prefetch ``booksubject_set``)."""
+        return [link.subject_id for link in self.booksubject_set.all()]
+
+class MimeType(models.Model):
+    """
+    Model representing a MIME type of book formats.
+    
+    Attributes:
+        name (CharField): MIME type (e.g., 'text/plain'), max length 32 characters
+    """
+    name = models.CharField(max_length=32, unique=True)
+
+    objects = CachedQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'books_mime_type'
+
+    def __str__(self):
+        """String representation of the MimeType object."""
+        return self.name
+
+class UrlTemplate(models.Model):
+    """
+    Model representing a format URL with the book's Gutenberg ID factored out.
+    
+    Every occurrence of the Gutenberg ID (as a whole number) in a URL is
+    replaced by PLACEHOLDER, so 'https://www.gutenberg.org/ebooks/1342.epub.images'
+    becomes 'https://www.gutenberg.org/ebooks/{id}.epub.images', shared by
+    the same format of every book. Expanding with the ID gives back the
+    exact URL.
+    
+    Attributes:
+        template (CharField): URL template, max length 256 characters
+    """
+    PLACEHOLDER = '{id}'
+
+    template = models.CharField(max_length=256, unique=True)
+
+    objects = CachedQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'books_url_template'
+
+    def __str__(self):
+        """String representation of the UrlTemplate object."""
+        return self.template
+
+    @classmethod
+    def template_for(cls, url, gutenberg_id):
+        """
+        Return the template of a book's URL.
+
+        Only path segments that are the ID, or start with it (optionally
+        after 'pg') followed by '.' or '-', are templated: numbers elsewhere,
+        like the 8 of 'utf-8', are kept.
+        """
+        scheme_end = url.find('//')
+        start = url.find('/', scheme_end + 2) if scheme_end >= 0 else 0
+        if start < 0:
+            return url
+        path = re.sub(
+            rf'(?<=/)(pg)?{gutenberg_id}(?=[/.-]|$)',
+            lambda match: (match.group(1) or '') + cls.PLACEHOLDER,
+            url[start:],
+        )
+        return url[:start] + path
+
+    @classmethod
+    def expand(cls, template, gutenberg_id):
+        """Return the URL of a template for a book."""
+        return template.replace(cls.PLACEHOLDER, str(gutenberg_id))
+
 class Format(models.Model):
     """
     Model representing a format of a book (e.g., PDF, TXT).
     
+    The MIME type and URL are stored as references to the small MimeType
+    and UrlTemplate tables; the ``mime_type`` and ``url`` properties give
+    the values (and can be passed to the constructor as before). Values set
+    through them are resolved to MimeType and UrlTemplate rows on save(),
+    so an unsaved Format writes nothing; bulk_create() callers call
+    resolve_references() first.
+    
     Attributes:
-        mime_type (CharField): MIME type of the format, max length 32 characters
-        url (CharField): URL to download the book in this format, max length 256 characters
+        mime (ForeignKey): MIME type of the format
+        url_template (ForeignKey): URL to download the book in this format,
+            without the book's Gutenberg ID
         book (ForeignKey): Related Book object
     """
-    mime_type = models.CharField(max_length=32)
-    url = models.CharField(max_length=256)
+    mime = models.ForeignKey(MimeType, related_name='formats', on_delete=models.PROTECT)
+    url_template = models.ForeignKey(UrlTemplate, related_name='formats', on_delete=models.PROTECT)
     book = models.ForeignKey(Book, related_name='formats', on_delete=models.CASCADE)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_format'
     
@@ -120,6 +271,49 @@ class Format(models.Model):
         """String representation of the Format object."""
         return f"{self.book.title} - {self.mime_type}"
 
+    def save(self, *args, **kwargs):
+        """Save the format, resolving the MIME type and URL set since the last save."""
+        self.resolve_references()
+        super().save(*args, **kwargs)
+
+    def resolve_references(self):
+        """Point ``mime`` and ``url_template`` at the rows of the values set, creating them if needed."""
+        if (value := self.__dict__.pop('_mime_type', None)) is not None:
+            self.mime = MimeType.objects.get_or_create(name=value)[0]
+        if (value := self.__dict__.pop('_url', None)) is not None:
+            template = UrlTemplate.template_for(value, self.book.gutenberg_id)
+            self.url_template = UrlTemplate.objects.get_or_create(template=template)[0]
+
+    @property
+    def mime_type(self):
+        """MIME type of the format (e.g., 'text/plain')."""
+        if (value := self.__dict__.get('_mime_type')) is not None:
+            return value
+        if Format.mime.is_cached(self):
+            return self.mime.name
+        from . import lookups
+        return lookups.lookup('mime_types', self.mime_id)
+
+    @mime_type.setter
+    def mime_type(self, value):
+        self._mime_type = value
+
+    @property
+    def url(self):
+        """URL to download the book in this format."""
+        if (value := self.__dict__.get('_url')) is not None:
+            return value
+        if Format.url_template.is_cached(self):
+            template = self.url_template.template
+        else:
+            from . import lookups
+            template = lookups.lookup('url_templates', self.url_template_id)
+        return UrlTemplate.expand(template, self.book.gutenberg_id)
+
+    @url.setter
+    def url(self, value):
+        self._url = value
+
 # Through Models for Many-to-Many Relationships
 
 class BookAuthor(models.Model):
@@ -133,6 +327,8 @@ class BookAuthor(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     author = models.ForeignKey(Author, on_delete=models.CASCADE)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_book_authors'
 
@@ -147,6 +343,8 @@ class BookLanguage(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     language = models.ForeignKey(Language, on_delete=models.CASCADE)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_book_languages'
 
@@ -161,6 +359,8 @@ class BookSubject(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_book_subjects'
 
@@ -175,5 +375,167 @@ class BookBookshelf(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     bookshelf = models.ForeignKey(Bookshelf, on_delete=models.CASCADE)
 
+    objects = CachedQuerySet.as_manager()
+
     class Meta:
         db_table = 'books_book_bookshelves'
+
+class RelatedBook(models.Model):
+    """
+    Precomputed "more like this" entry for a book.
+    
+    Rows are rebuilt offline by the compute_related_books management command
+    and read back with a single indexed lookup on (book, rank).
+    
+    Attributes:
+        book (ForeignKey): Book the recommendation is for
+        related (ForeignKey): Recommended book
+        rank (SmallIntegerField): Position in the book's list, starting at 1
+        score (FloatField): Similarity score weighted by popularity
+    """
+    book = models.ForeignKey(Book, related_name='related_books', on_delete=models.CASCADE, db_index=False)
+    related = models.ForeignKey(Book, related_name='+', on_delete=models.CASCADE)
+    rank = models.SmallIntegerField()
+    score = models.FloatField()
+
+    objects = CachedQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'books_related_book'
+        ordering = ['rank']
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'rank'], name='books_related_book_rank_uniq'),
+        ]
+
+class DownloadBucket(models.Model):
+    """
+    Aggregated download count of a book over one hour or one day.
+    
+    Clicks are buffered per worker and added to the current hourly bucket in
+    batches (see books.downloads). The rollup_downloads management command
+    folds old hourly buckets into daily ones.
+    
+    Attributes:
+        book (ForeignKey): Downloaded book
+        granularity (CharField): HOUR ('h') or DAY ('d')
+        bucket_start (DateTimeField): Start of the hour or day (UTC)
+        count (PositiveIntegerField): Downloads within the bucket
+    """
+    HOUR = 'h'
+    DAY = 'd'
+    GRANULARITY_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+
+    book = models.ForeignKey(Book, related_name='download_buckets', on_delete=models.CASCADE, db_index=False)
+    granularity = models.CharField(max_length=1, choices=GRANULARITY_CHOICES)
+    bucket_start = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'books_download_bucket'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['book', 'granularity', 'bucket_start'],
+                name='books_download_bucket_uniq',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket_start'], name='books_download_bucket_time_idx'),
+        ]
+
+class FormatContent(models.Model):
+    """
+    Locally mirrored file of a book format.
+    
+    Files live in a content-addressed store (see books.content), so
+    identical files are stored once. Rows are created by the import_content
+    management command.
+    
+    Attributes:
+        format (OneToOneField): Mirrored Format (primary key)
+        sha256 (CharField): Hex SHA-256 of the file, its address in the store
+        size (BigIntegerField): File size in bytes
+        gzip_size (BigIntegerField): Size of the precompressed .gz variant,
+                                     or null if none is stored
+    """
+    format = models.OneToOneField(Format, related_name='content', on_delete=models.CASCADE, primary_key=True)
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    gzip_size = models.BigIntegerField(null=True, blank=True)
+
+    objects = CachedQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'books_format_content'
+
+class BookChange(models.Model):
+    """
+    Entry of the change log that catalog mirrors sync from.
+    
+    A book was created or changed (UPSERT) or deleted (DELETE). Entries are
+    staged as PendingBookChange rows by the changing transaction and moved
+    here after it commits, in commit order (see books.changes), so ``seq``
+    only grows. The compact_changes management
+    command deletes entries superseded by a later one for the same book.
+    
+    Attributes:
+        seq (BigAutoField): Sequence number
+        book_id (BigIntegerField): Id of the book (not a foreign key, so
+                                   deletions can be recorded)
+        action (CharField): UPSERT ('u') or DELETE ('d')
+        changed_at (DateTimeField): When the entry was written
+    """
+    UPSERT = 'u'
+    DELETE = 'd'
+    ACTION_CHOICES = [(UPSERT, 'upsert'), (DELETE, 'delete')]
+
+    seq = models.BigAutoField(primary_key=True)
+    book_id = models.BigIntegerField()
+    action = models.CharField(max_length=1, choices=ACTION_CHOICES)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'books_book_change'
+        indexes = [
+            models.Index(fields=['book_id', 'seq'], name='books_book_change_book_idx'),
+        ]
+
+
+class PendingBookChange(models.Model):
+    """
+    Change log entry staged by the changing transaction, not yet numbered.
+
+    Staged rows commit or roll back together with the change. They are
+    moved to BookChange, which numbers them, once the transaction
+    commits (see books.changes).
+
+    Attributes:
+        book_id (BigIntegerField): Id of the book
+        action (CharField): BookChange.UPSERT or BookChange.DELETE
+        changed_at (DateTimeField): When the entry was staged
+    """
+    book_id = models.BigIntegerField()
+    action = models.CharField(max_length=1, choices=BookChange.ACTION_CHOICES)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'books_book_change_pending'
+
+
+class TableGeneration(models.Model):
+    """
+    Generation counter of a books table, for the query result cache.
+
+    Incremented whenever the table is written, which invalidates the
+    cached results of queries reading it (see books.querycache). The
+    catalog version and change stamps are rows too (see books.catalog).
+
+    Attributes:
+        name (CharField): Table name, or 'catalog:version'/'catalog:changed'
+        generation (BigIntegerField): Number of committed writes (a stamp
+            in nanoseconds for the catalog rows)
+    """
+    name = models.CharField(max_length=64, primary_key=True)
+    generation = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'books_table_generation'
@@ -0,0 +1,4 @@
+"""Query parameters of the book list shared by the request-handling modules."""
+
+# Filters whose comma-separated values are order-insensitive
+LIST_PARAMS = ('book_ids', 'language', 'topic')
@@ -0,0 +1,220 @@
+"""
+Opt-in sampling profiler for slow requests.
+
+When PROFILE_DIR is set, a background thread samples the stack of every
+in-flight request every PROFILE_INTERVAL seconds, and the SQL each request
+runs is recorded. Requests slower than PROFILE_THRESHOLD seconds (plus a
+random PROFILE_SAMPLE_RATE fraction of all requests) are written to
+PROFILE_DIR as:
+
+    <id>.json             request, timing and the SQL executed
+    <id>.collapsed        collapsed stacks ("outer;inner;leaf count"), for
+                          flamegraph.pl or the aggregate_profiles command
+    <id>.speedscope.json  the same samples for https://www.speedscope.app
+
+Other requests' samples are discarded.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+def frame_key(frame):
+    """Identify a frame's function as (name, file, first line)."""
+    code = frame.f_code
+    return (f"{frame.f_globals.get('__name__', '?')}.{code.co_qualname}", code.co_filename, code.co_firstlineno)
+
+
+def stack_of(frame):
+    """Return the frame keys of a stack, outermost first."""
+    stack = []
+    while frame is not None:
+        stack.append(frame_key(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+class Sampler:
+    """
+    Samples the stacks of registered threads from one background thread.
+
+    Attributes:
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._samples = {}  # thread id -> list of stacks
+        self._thread = None
+
+    def start(self, thread_id):
+        """Begin sampling a thread."""
+        with self._lock:
+            self._samples[thread_id] = []
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        """Stop sampling a thread and return its stacks."""
+        with self._lock:
+            return self._samples.pop(thread_id, [])
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples.append(stack_of(frame))
+
+
+def collapse(stacks):
+    """
+    Render stacks in the collapsed format.
+
+    Returns:
+        str: One "frame;frame;frame count" line per distinct stack
+    """
+    counts = Counter(';'.join(name for name, _, _ in stack) for stack in stacks)
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+
+
+def speedscope(stacks, name, interval, duration):
+    """
+    Build a speedscope sampled profile.
+
+    Returns:
+        dict: Document in the speedscope file format
+    """
+    frames = {}
+    samples = [[frames.setdefault(key, len(frames)) for key in stack] for stack in stacks]
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': [{'name': n, 'file': f, 'line': line} for n, f, line in frames]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': duration,
+            'samples': samples,
+            'weights': [interval] * len(samples),
+        }],
+        'name': name,
+        'exporter': 'gutenberg_api',
+    }
+
+
+class ProfilingMiddleware:
+    """
+    Profile slow requests (see the module docstring).
+
+    Disabled (removed from the middleware chain) unless PROFILE_DIR is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILE_DIR:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sampler = Sampler(settings.PROFILE_INTERVAL)
+
+    def __call__(self, request):
+        queries = []
+
+        def record_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append({
+                    'alias': context['connection'].alias,
+                    'sql': sql,
+                    'duration': time.perf_counter() - start,
+                })
+
+        thread_id = threading.get_ident()
+        self.sampler.start(thread_id)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(record_query))
+                response = self.get_response(request)
+        finally:
+            stacks = self.sampler.stop(thread_id)
+        duration = time.perf_counter() - start
+
+        if duration >= settings.PROFILE_THRESHOLD or random.random() < settings.PROFILE_SAMPLE_RATE:
+            self.write(request, response, duration, stacks, queries)
+        return response
+
+    def write(self, request, response, duration, stacks, queries):
+        """Write the profile files of one request."""
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{view.replace(':', '.')}-{uuid.uuid4().hex[:8]}"
+        base = os.path.join(settings.PROFILE_DIR, profile_id)
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+
+        with open(f'{base}.json', 'w') as f:
+            json.dump({
+                'id': profile_id,
+                'view': view,
+                'method': request.method,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'duration': duration,
+                'interval': self.sampler.interval,
+                'samples': len(stacks),
+                'queries': queries,
+            }, f, indent=2)
+        with open(f'{base}.collapsed', 'w') as f:
+            f.write(collapse(stacks))
+        with open(f'{base}.speedscope.json', 'w') as f:
+            json.dump(speedscope(stacks, f'{request.method} {request.path}', self.sampler.interval, duration), f)
+
+
+def load_profiles(directory, view=None):
+    """
+    Read the profiles written to a directory.
+
+    Args:
+        directory: Profile directory (PROFILE_DIR)
+        view: Only include profiles of this view name
+
+    Returns:
+        tuple: (list of request metadata dicts, Counter of collapsed stack
+        strings to sample counts summed over the profiles)
+    """
+    requests = []
+    stacks = Counter()
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json') or name.endswith('.speedscope.json'):
+            continue
+        base = os.path.join(directory, name[:-len('.json')])
+        with open(f'{base}.json') as f:
+            meta = json.load(f)
+        if view and meta['view'] != view:
+            continue
+        requests.append(meta)
+        with open(f'{base}.collapsed') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+    return requests, stacks
@@ -0,0 +1,268 @@
+"""
+Query result cache for read querysets of the books models.
+
+The catalog models use CachedQuerySet, so their lists, related managers
+and prefetches all go through cached(): the result of evaluating a
+queryset (or of count()) is stored in the QUERY_CACHE cache, local to the
+worker, under a digest of the database alias, the compiled SQL and its
+parameters, and the generation of every books table the SQL mentions.
+
+Generations are counters in the TableGeneration table of the primary
+database, so every worker of every instance sees the same ones.
+invalidate_writes(), an execute wrapper installed on every database
+connection, increments the generations of the books tables written by each
+INSERT, UPDATE, DELETE or TRUNCATE once the write is committed (once per
+table and transaction). That covers model saves and deletes as well as
+update(), bulk_create(), bulk_update() and raw SQL, none of which send
+post_save. Entries of older generations are never read again and expire
+after QUERY_CACHE_TIMEOUT.
+
+Generations are read with one query, at most once per request (again after
+a write in the request); outside requests, on every cached read.
+
+Nothing is cached inside transactions (they may see their own uncommitted
+writes), for querysets locking rows or bound to a model instance, or for
+results over QUERY_CACHE_MAX_ROWS rows. A replica may not have applied a
+write yet when its generation has already moved, so reads routed to a
+replica are only cached for QUERY_CACHE_REPLICA_TIMEOUT seconds (not at
+all by default); set it no longer than the replication lag you accept.
+Views whose queries rarely repeat opt out with the uncached decorator.
+"""
+
+import functools
+import hashlib
+import re
+import threading
+from contextvars import ContextVar
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+
+GENERATIONS_TABLE = 'books_table_generation'
+BUMP_SQL = (
+    f'INSERT INTO {GENERATIONS_TABLE} (name, generation) VALUES (%s, 1) '
+    f'ON CONFLICT (name) DO UPDATE SET generation = {GENERATIONS_TABLE}.generation + 1'
+)
+WRITE_RE = re.compile(r'\s*(INSERT|UPDATE|DELETE|TRUNCATE)\b', re.IGNORECASE)
+
+_missing = object()
+_disabled = ContextVar('querycache_disabled', default=False)
+_local = threading.local()  # generations read by the current request
+_table_exists = False
+
+
+@functools.cache
+def _tables_re():
+    """Regex matching the table names of the books models (but not the generations)."""
+    tables = sorted(
+        (model._meta.db_table for model in apps.get_app_config('books').get_models()
+         if model._meta.db_table != GENERATIONS_TABLE),
+        key=len, reverse=True,
+    )
+    return re.compile(r'\b({})\b'.format('|'.join(map(re.escape, tables))))
+
+
+def tables_in(sql):
+    """
+    Return the books tables mentioned in an SQL statement.
+
+    Args:
+        sql: SQL text (table names may be quoted)
+
+    Returns:
+        list: Sorted table names
+    """
+    return sorted(set(_tables_re().findall(sql)))
+
+
+def generations(tables):
+    """
+    Return the current generation of each table.
+
+    Within a request, the generations are read once and reused.
+
+    Args:
+        tables: Table names
+
+    Returns:
+        list: Generations in the order of ``tables`` (0 for tables never
+        written)
+    """
+    current = getattr(_local, 'generations', None)
+    if current is None:
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute(f'SELECT name, generation FROM {GENERATIONS_TABLE}')
+            current = dict(cursor.fetchall())
+        if getattr(_local, 'in_request', False):
+            _local.generations = current
+    return [current.get(table, 0) for table in tables]
+
+
+def forget_generations():
+    """Read the generations again on next use (after writing them)."""
+    _local.generations = None
+
+
+def start_request(**kwargs):
+    """``request_started`` receiver: generations are read again by the new request."""
+    _local.in_request = True
+    _local.generations = None
+
+
+def finish_request(**kwargs):
+    """``request_finished`` receiver."""
+    _local.in_request = False
+    _local.generations = None
+
+
+def invalidate(tables, using=DEFAULT_DB_ALIAS):
+    """
+    Drop the cached results of queries reading any of ``tables``.
+
+    Args:
+        tables: Table names
+        using: Database alias of the primary
+    """
+    global _table_exists
+    connection = connections[using]
+    if not _table_exists:
+        # Data migrations write books tables before this one is created
+        with connection.cursor() as cursor:
+            _table_exists = GENERATIONS_TABLE in connection.introspection.table_names(cursor)
+        if not _table_exists:
+            return
+    with connection.cursor() as cursor:
+        # One table per statement: row locks are held only briefly and
+        # concurrent invalidations never wait on each other in a cycle
+        for table in sorted(tables):
+            cursor.execute(BUMP_SQL, [table])
+    forget_generations()
+
+
+def invalidate_writes(execute, sql, params, many, context):
+    """Database execute wrapper invalidating the tables a statement writes (see install)."""
+    result = execute(sql, params, many, context)
+    if WRITE_RE.match(sql) and (tables := tables_in(sql)):
+        connection = context['connection']
+        if connection.alias != DEFAULT_DB_ALIAS or connections[DEFAULT_DB_ALIAS] is not connection:
+            # Only writes to the primary are tracked, not e.g. the SQLite
+            # file written by books.snapshot.export
+            return result
+        if not connection.in_atomic_block:
+            invalidate(tables, connection.alias)
+            return result
+        # Entries cached before the commit would hold the old rows. One
+        # callback per transaction; a rolled back savepoint may have
+        # discarded it, so it is looked up among the pending callbacks
+        callback = getattr(connection, 'querycache_pending', None)
+        if callback is None or all(func is not callback for _, func, _ in connection.run_on_commit):
+            pending = set()
+
+            def invalidate_pending():
+                invalidate(pending, connection.alias)
+
+            invalidate_pending.tables = pending
+            callback = connection.querycache_pending = invalidate_pending
+            transaction.on_commit(callback, using=connection.alias, robust=True)
+        callback.tables.update(tables)
+    return result
+
+
+def install(sender, connection, **kwargs):
+    """``connection_created`` receiver adding invalidate_writes to the connection."""
+    if invalidate_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(invalidate_writes)
+
+
+def uncached(view):
+    """
+    Decorate a view so that its queries bypass the query result cache.
+
+    Use ``method_decorator(querycache.uncached, name='dispatch')`` on
+    class-based views.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = _disabled.set(True)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _disabled.reset(token)
+    return wrapper
+
+
+def _timeout(db):
+    """Return how long results read from ``db`` may be cached."""
+    if db in settings.DATABASE_REPLICAS:
+        return settings.QUERY_CACHE_REPLICA_TIMEOUT
+    return settings.QUERY_CACHE_TIMEOUT
+
+
+def _key(queryset, kind):
+    """Return the cache key of a queryset's result, or None if it must not be cached."""
+    if not settings.QUERY_CACHE_ENABLED or _disabled.get():
+        return None
+    if queryset.query.select_for_update or queryset._known_related_objects:
+        return None
+    db = queryset.db
+    connection = connections[db]
+    if connection.in_atomic_block or connections[DEFAULT_DB_ALIAS].in_atomic_block or not _timeout(db):
+        return None
+    try:
+        sql, params = queryset.query.get_compiler(using=db).as_sql()
+    except EmptyResultSet:
+        return None
+    tables = tables_in(sql)
+    if not tables:
+        return None
+    # Snapshots are never written: the file identity tells them apart (see books.snapshot)
+    identity = getattr(connection, 'snapshot_identity', None)
+    versions = generations(tables) if identity is None else None
+    source = repr((db, identity, queryset.model._meta.label, kind, sql, params, versions))
+    return 'querycache:' + hashlib.sha256(source.encode()).hexdigest()
+
+
+def cached(queryset, kind, compute):
+    """
+    Return a queryset's result from the cache, computing and storing it on a miss.
+
+    Hits and misses are counted under the cache name in /metrics.
+
+    Args:
+        queryset: Queryset being evaluated
+        kind: What is computed, e.g. the iterable class or 'count'
+        compute: Function computing the result from the database
+
+    Returns:
+        The result of ``compute`` (a copy when served from the cache)
+    """
+    key = _key(queryset, kind)
+    if key is None:
+        return compute()
+    cache = caches[settings.QUERY_CACHE]
+    result = cache.get(key, _missing)
+    if result is _missing:
+        result = compute()
+        if not isinstance(result, list) or len(result) <= settings.QUERY_CACHE_MAX_ROWS:
+            cache.set(key, result, _timeout(queryset.db))
+    return result
+
+
+class CachedQuerySet(models.QuerySet):
+    """QuerySet whose results and counts go through the query result cache."""
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            self._result_cache = cached(
+                self, self._iterable_class.__name__, lambda: list(self._iterable_class(self)),
+            )
+        if self._prefetch_related_lookups and not self._prefetch_done:
+            self._prefetch_related_objects()
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return cached(self, 'count', super().count)
@@ -0,0 +1,152 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """
+    Route the ORM reads of the block to replicas (or, disabled, to the primary).
+
+    Args:
+        enabled: False to read from the primary within a replica block, e.g.
+            when loading data stamped with the primary's catalog version
+    """
+    token = _replica_reads.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def on_primary():
+    """Context manager (or decorator) reading from the primary within a replica block."""
+    return replica_reads(enabled=False)
+
+
+def replica_view(view):
+    """
+    View decorator routing the reads of safe-method requests to replicas.
+
+    Args:
+        view: View function
+
+    Returns:
+        function: The decorated view
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return view(request, *args, **kwargs)
+        with replica_reads():
+            return view(request, *args, **kwargs)
+    return wrapped
+
+
+class ReplicaRouter:
+    """
+    Database router sending reads to read replicas and writes to the primary.
+
+    Only reads of safe-method requests to views decorated with
+    replica_view() (or inside a replica_reads() block) go to a replica.
+    Everything else reads from the primary: other views, the admin, signal
+    handlers, the loading of in-memory catalog copies and management
+    commands. Replica aliases are taken from
+    ``settings.DATABASE_REPLICAS`` and are used round-robin. Each replica is
+    health-checked at most once every
+    ``settings.DATABASE_REPLICA_HEALTH_CHECK_INTERVAL`` seconds; unhealthy
+    replicas are skipped until their next successful check. When no replica is
+    configured or healthy, reads fall back to the primary.
+
+    Reads issued inside a transaction on the primary stay on the primary and
+    see its writes. A read after a committed write may still hit a replica
+    that has not applied it; code that must see its own writes reads inside
+    ``transaction.atomic()`` or with ``.using('default')``.
+
+    On edge read nodes (``settings.SNAPSHOT_PATH`` set), catalog reads go
+    to the read-only SQLite snapshot instead (see books.snapshot).
+    """
+
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'DATABASE_REPLICAS', []))
+        self.health_check_interval = getattr(
+            settings, 'DATABASE_REPLICA_HEALTH_CHECK_INTERVAL', 30
+        )
+        self._cycle = itertools.cycle(self.replicas)
+        self._health = {}  # alias -> (healthy, checked_at)
+        self._lock = threading.Lock()
+
+    def db_for_read(self, model, **hints):
+        """
+        Pick the next healthy replica for a read query.
+
+        Args:
+            model: Model class being queried
+            **hints: Router hints (e.g. 'instance')
+
+        Returns:
+            str or None: Database alias, or None to let Django use the
+            database the hinted instance was loaded from
+        """
+        # Imported here: routers are loaded with the settings, before the models
+        from . import snapshot
+        if snapshot.serves(model):
+            return snapshot.ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return None
+        if (not self.replicas or not _replica_reads.get()
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                alias = next(self._cycle)
+            if self.is_healthy(alias):
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        """All writes go to the primary."""
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Replicas hold the same data as the primary, so relations are always allowed."""
+        return True
+
+    def is_healthy(self, alias):
+        """
+        Return the cached health of a replica, re-checking it when stale.
+
+        Args:
+            alias: Database alias of the replica
+
+        Returns:
+            bool: True if the replica accepted a connection at its last check
+        """
+        healthy, checked_at = self._health.get(alias, (True, None))
+        now = time.monotonic()
+        if checked_at is None or now - checked_at >= self.health_check_interval:
+            healthy = self.check(alias)
+            self._health[alias] = (healthy, now)
+        return healthy
+
+    def check(self, alias):
+        """Open (or reuse) a connection to ``alias`` and verify it is usable."""
+        connection = connections[alias]
+        try:
+            connection.ensure_connection()
+            return connection.is_usable()
+        except DatabaseError:
+            connection.close()
+            return False
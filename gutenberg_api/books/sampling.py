@@ -0,0 +1,136 @@
+"""
+Uniform random sampling of books.
+
+``ORDER BY random()`` sorts the whole book table for every sample. Instead,
+each worker keeps the ids of all books in a sorted array, rebuilt when books
+were added or deleted, checked at most every LOOKUP_TABLES_CHECK_INTERVAL
+seconds like the lookup tables. The check compares the count and the largest
+id of the books (one index-only aggregate): updates, such as download count
+flushes, leave both unchanged, while any insert or delete moves at least one
+of them since ids are never reused. A sample draws
+random positions from the array and keeps the drawn ids that match the
+(filtered) queryset, checked with one primary-key lookup per round.
+
+Positions are drawn without replacement, in random order, so the first
+``count`` matches are a uniform sample of the matching books in random
+order. When the drawn ids match too rarely for the next round to complete
+the sample, the list of matching ids, short in that case, is sampled
+instead.
+"""
+
+import random
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Book
+
+FIRST_ROUND = 64  # minimum ids drawn in the first round
+ROUNDS = 3  # rounds before falling back; each draws 4 times as many ids
+
+
+class BookIds:
+    """
+    Sorted array of all book ids.
+
+    Attributes:
+        ids (array): Book ids in ascending order
+        stamp (tuple): Number of books and largest id when the array was built
+    """
+
+    def __init__(self, ids, stamp):
+        self.ids = array('q', ids)
+        self.stamp = stamp
+
+    def __len__(self):
+        return len(self.ids)
+
+
+_book_ids = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def stamp():
+    """
+    Return what changes when books are added or deleted.
+
+    Returns:
+        tuple: Number of books and largest book id
+    """
+    result = Book.objects.order_by().aggregate(count=Count('pk'), last=Max('pk'))
+    return result['count'], result['last']
+
+
+def load():
+    """
+    Read the book ids from the database.
+
+    Returns:
+        BookIds: Fresh array
+    """
+    built = stamp()
+    return BookIds(Book.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=10000), built)
+
+
+def get():
+    """
+    Return the current id array, building or rebuilding it when needed.
+
+    Returns:
+        BookIds: Current array
+    """
+    global _book_ids, _checked_at
+    now = time.monotonic()
+    if _book_ids is not None and now - _checked_at < settings.LOOKUP_TABLES_CHECK_INTERVAL:
+        return _book_ids
+    with _lock:
+        if _book_ids is None or stamp() != _book_ids.stamp:
+            _book_ids = load()
+        _checked_at = now
+    return _book_ids
+
+
+def sample(queryset, count):
+    """
+    Pick up to ``count`` random books matching a queryset.
+
+    Books created since the id array was built are only found by the
+    fallback; deleted ones never match.
+
+    Args:
+        queryset: Book queryset, e.g. filtered by BookFilter
+        count: Number of books wanted
+
+    Returns:
+        list: Ids of the picked books in random order (fewer than
+        ``count`` if fewer books match)
+    """
+    ids = get().ids
+    queryset = queryset.order_by()
+    drawn = set()
+    picked = []
+    batch = max(count * 4, FIRST_ROUND)
+    for _ in range(ROUNDS):
+        if len(drawn) == len(ids):
+            break
+        positions = [
+            position for position in random.sample(range(len(ids)), min(batch, len(ids)))
+            if position not in drawn
+        ]
+        drawn.update(positions)
+        candidates = [ids[position] for position in positions]
+        matching = set(queryset.filter(pk__in=candidates).values_list('pk', flat=True))
+        picked += [pk for pk in candidates if pk in matching]
+        if len(picked) >= count:
+            return picked[:count]
+        batch *= 4
+        if len(picked) * batch < (count - len(picked)) * len(drawn):
+            break  # at this match rate, the next round would fall short too
+
+    # Selective filters: few books match, so list them
+    matching = list(queryset.values_list('pk', flat=True).distinct())
+    return random.sample(matching, min(count, len(matching)))
@@ -0,0 +1,218 @@
+import gzip
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import django
+import drf_yasg
+import rest_framework
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import condition
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+from drf_yasg.generators import OpenAPISchemaGenerator
+from drf_yasg.renderers import _SpecRenderer
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+from rest_framework.response import Response
+
+from . import compression
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; only the .gz variant is written
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+API_INFO = openapi.Info(
+    title="Gutenberg API",
+    default_version='v1',
+    description="API for Project Gutenberg books",
+)
+
+# Modules whose source defines the schema; a change to any of them changes the fingerprint
+SCHEMA_MODULES = ['books.models', 'books.serializers', 'books.views', settings.ROOT_URLCONF]
+
+SCHEMA_FILES = ['openapi.json', 'openapi.yaml']
+
+
+def schema_dir():
+    """Directory of the persisted schema inside STATIC_ROOT (served by WhiteNoise)."""
+    return os.path.join(settings.STATIC_ROOT, 'schema')
+
+
+def schema_fingerprint():
+    """
+    Hash everything the generated schema depends on.
+
+    Returns:
+        str: SHA-256 of the schema modules' source, the relevant settings and
+        library versions
+    """
+    digest = hashlib.sha256()
+    for version in (django.__version__, rest_framework.VERSION, drf_yasg.__version__):
+        digest.update(version.encode())
+    digest.update(repr((settings.REST_FRAMEWORK, settings.SWAGGER_SETTINGS)).encode())
+    for name in SCHEMA_MODULES:
+        __import__(name)
+        with open(sys.modules[name].__file__, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def _write(path, content):
+    """Atomically replace ``path`` with ``content``."""
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def render_schema():
+    """
+    Introspect the API and encode the OpenAPI document.
+
+    Returns:
+        dict: Mapping of file name to bytes: openapi.json and openapi.yaml,
+        each with a .gz variant (and .br when brotli is installed)
+    """
+    schema = OpenAPISchemaGenerator(API_INFO).get_schema(request=None, public=True)
+    files = {}
+    for name, codec in zip(SCHEMA_FILES, (OpenAPICodecJson([]), OpenAPICodecYaml([]))):
+        content = files[name] = codec.encode(schema)
+        files[f'{name}.gz'] = gzip.compress(content, 9, mtime=0)
+        if brotli is not None:
+            files[f'{name}.br'] = brotli.compress(content)
+    return files
+
+
+def generate_schema(fingerprint=None):
+    """
+    Generate the OpenAPI document and persist it with precompressed variants.
+
+    Writes the files of render_schema() plus the fingerprint they were
+    generated from.
+
+    Args:
+        fingerprint: Precomputed schema_fingerprint(), if available
+
+    Returns:
+        str: Fingerprint of the generated schema
+    """
+    fingerprint = fingerprint or schema_fingerprint()
+    directory = schema_dir()
+    os.makedirs(directory, exist_ok=True)
+    for name, content in render_schema().items():
+        _write(os.path.join(directory, name), content)
+    _write(os.path.join(directory, 'fingerprint'), fingerprint.encode())
+    return fingerprint
+
+
+def read_fingerprint():
+    """Return the fingerprint of the persisted schema, or None if there is none."""
+    try:
+        with open(os.path.join(schema_dir(), 'fingerprint')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+_artifacts = {}
+_artifacts_lock = threading.Lock()
+
+
+def load_schema():
+    """
+    Return the schema files, read once per process.
+
+    The persisted files are used when their fingerprint matches the
+    sources. Otherwise the schema is generated in memory and served by the
+    schema views only: nothing is written at runtime, since WhiteNoise only
+    indexes STATIC_ROOT at startup. Run the generate_schema command to
+    persist it.
+
+    Returns:
+        dict: Mapping of file name (e.g. 'openapi.json.gz', or 'fingerprint')
+        to bytes, and 'generated_at' to the generation time
+    """
+    with _artifacts_lock:
+        if _artifacts:
+            return _artifacts
+
+        fingerprint = schema_fingerprint()
+        directory = schema_dir()
+        if read_fingerprint() == fingerprint:
+            for name in SCHEMA_FILES:
+                for suffix in ('', '.gz', '.br'):
+                    path = os.path.join(directory, name + suffix)
+                    if os.path.exists(path):
+                        with open(path, 'rb') as f:
+                            _artifacts[name + suffix] = f.read()
+            generated_at = os.path.getmtime(os.path.join(directory, 'fingerprint'))
+        else:
+            logger.warning('The persisted schema is missing or stale; run manage.py generate_schema')
+            _artifacts.update(render_schema())
+            generated_at = time.time()
+        _artifacts['fingerprint'] = fingerprint.encode()
+        _artifacts['generated_at'] = datetime.fromtimestamp(generated_at, timezone.utc)
+        return _artifacts
+
+
+class SchemaView(get_schema_view(API_INFO, public=True, permission_classes=(permissions.AllowAny,))):
+    """
+    Swagger/ReDoc views backed by the persisted schema.
+
+    The UI pages are rendered without introspecting the API, and the
+    document itself (``?format=openapi``, ``.json`` or ``.yaml``) is served from
+    the artifact written by the generate_schema management command (or
+    generated in memory when it is stale), precompressed when the client
+    accepts it.
+    """
+
+    def get(self, request, version='', format=None):
+        renderer = request.accepted_renderer
+        if not isinstance(renderer, _SpecRenderer):
+            # The UI templates only need the API title and version
+            return Response(openapi.Swagger(info=API_INFO, _prefix='/', paths=openapi.Paths(paths={})))
+
+        artifacts = load_schema()
+        name = 'openapi.yaml' if renderer.format == '.yaml' else 'openapi.json'
+        content_type = renderer.media_type
+        encoding = compression.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+        if suffix and name + suffix in artifacts:
+            response = HttpResponse(artifacts[name + suffix], content_type=content_type)
+            response['Content-Encoding'] = encoding
+        else:
+            response = HttpResponse(artifacts[name], content_type=content_type)
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+
+def schema_etag(request, *args, **kwargs):
+    """
+    ETag of the schema views: the persisted schema's fingerprint.
+
+    Weak, since the document is served in several content encodings.
+    """
+    return f'W/"schema-{load_schema()["fingerprint"].decode()[:32]}"'
+
+
+def schema_last_modified(request, *args, **kwargs):
+    """Last-Modified of the schema views: when the schema was generated."""
+    return load_schema()['generated_at']
+
+
+# The documents and UI pages only change when the schema does; conditional
+# GETs are answered with 304 Not Modified without rendering anything
+schema_conditional = condition(etag_func=schema_etag, last_modified_func=schema_last_modified)
+
+swagger_ui_view = schema_conditional(SchemaView.with_ui('swagger', cache_timeout=0))
+redoc_view = schema_conditional(SchemaView.with_ui('redoc', cache_timeout=0))
@@ -1,7 +1,8 @@
 # books/serializers.py
 
 from rest_framework import serializers
-from .models import Book, Author, Format, Language, Subject, Bookshelf
+from . import lookups
+from .models import Book, Author, BookChange, Format, RelatedBook
 
 class FormatSerializer(serializers.ModelSerializer):
     """
@@ -28,38 +29,42 @@ class AuthorSerializer(serializers.ModelSerializer):
         model = Author
         fields = ['name', 'birth_year', 'death_year']
 
-class LanguageSerializer(serializers.ModelSerializer):
+class LookupListField(serializers.Field):
     """
-    Serializer for the Language model.
+    Read-only list of dimension rows resolved from the in-process lookup tables.
     
-    Serializes language information including:
-    - code: The language code (e.g., 'en' for English)
-    """
-    class Meta:
-        model = Language
-        fields = ['code']
-
-class SubjectSerializer(serializers.ModelSerializer):
-    """
-    Serializer for the Subject model.
+    Reads the ids of the book's rows (an id array denormalized on the book,
+    see books.denormalized, or prefetched through table rows) and maps them
+    with books.lookups, so the dimension table is not joined. Ids missing
+    from the lookup tables are resolved once for every book being
+    serialized, in one query.
+    Renders the same shape as nested dimension serializers,
+    e.g. [{'code': 'en'}].
     
-    Serializes subject information including:
-    - name: The subject/category name
+    Args:
+        table: Lookup table name ('languages', 'bookshelves' or 'subjects')
+        ids_attr: Id list attribute of Book (e.g. 'language_ids')
     """
-    class Meta:
-        model = Subject
-        fields = ['name']
+    def __init__(self, table, ids_attr, **kwargs):
+        self.table = table
+        self.ids_attr = ids_attr
+        self._names = {}
+        kwargs.update(source='*', read_only=True)
+        super().__init__(**kwargs)
 
-class BookshelfSerializer(serializers.ModelSerializer):
-    """
-    Serializer for the Bookshelf model.
-    
-    Serializes bookshelf information including:
-    - name: The bookshelf category name
-    """
-    class Meta:
-        model = Bookshelf
-        fields = ['name']
+    def to_representation(self, book):
+        ids = getattr(book, self.ids_attr)
+        if not self._names.keys() >= set(ids):
+            self._names = lookups.resolve(self.table, self._serialized_ids(book))
+        key = lookups.NAME_FIELDS[self.table]
+        return [{key: self._names.get(pk)} for pk in ids]
+
+    def _serialized_ids(self, book):
+        """Ids of every book being serialized along with ``book``."""
+        books = self.root.instance
+        if not isinstance(books, (list, tuple)) or book not in books:
+            books = [book]
+        return {pk for item in books for pk in getattr(item, self.ids_attr)}
 
 class BookSerializer(serializers.ModelSerializer):
     """
@@ -80,6 +85,10 @@ class BookSerializer(serializers.ModelSerializer):
     Note:
     - All nested serializers are read-only
     - Uses nested serialization for related fields
+    - Languages and bookshelves are resolved from the book's id arrays
+      and the in-process lookup tables, without a prefetch
+    - Subjects are resolved from the prefetched BookSubject rows
+      (``booksubject_set``) and the lookup table of popular subjects
     - Provides complete book information in a single response
     """
     # Nested serializers for related fields
@@ -88,19 +97,16 @@ class BookSerializer(serializers.ModelSerializer):
         read_only=True,
         help_text="List of authors associated with the book"
     )
-    languages = LanguageSerializer(
-        many=True, 
-        read_only=True,
+    languages = LookupListField(
+        'languages', 'language_ids',
         help_text="List of languages the book is available in"
     )
-    subjects = SubjectSerializer(
-        many=True, 
-        read_only=True,
+    subjects = LookupListField(
+        'subjects', 'subject_ids',
         help_text="List of subjects/categories for the book"
     )
-    bookshelves = BookshelfSerializer(
-        many=True, 
-        read_only=True,
+    bookshelves = LookupListField(
+        'bookshelves', 'bookshelf_ids',
         help_text="List of bookshelves the book belongs to"
     )
     formats = FormatSerializer(
@@ -146,3 +152,59 @@ class BookSerializer(serializers.ModelSerializer):
             )
             
         return data
+
+class RelatedBookSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a precomputed related book.
+    
+    Serializes a compact summary of the recommended book including:
+    - id: Internal database ID of the related book
+    - gutenberg_id: Project Gutenberg ID of the related book
+    - title: Title of the related book
+    - download_count: Number of downloads of the related book
+    - score: Similarity score (higher is more similar)
+    """
+    id = serializers.IntegerField(source='related.id', read_only=True)
+    gutenberg_id = serializers.IntegerField(source='related.gutenberg_id', read_only=True)
+    title = serializers.CharField(source='related.title', read_only=True)
+    download_count = serializers.IntegerField(source='related.download_count', read_only=True)
+
+    class Meta:
+        model = RelatedBook
+        fields = ['id', 'gutenberg_id', 'title', 'download_count', 'score']
+
+class SearchResultSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a full-text search hit.
+    
+    Serializes the matching book including:
+    - id: Internal database ID
+    - gutenberg_id: Project Gutenberg ID
+    - title: Book title
+    - authors: List of authors (nested serialization)
+    - download_count: Number of downloads
+    - score: Relevance score (higher is more relevant)
+    - snippet: Text around the first match
+    """
+    authors = AuthorSerializer(many=True, read_only=True)
+    score = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Book
+        fields = ['id', 'gutenberg_id', 'title', 'authors', 'download_count', 'score', 'snippet']
+
+class BookChangeSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a change feed entry.
+    
+    Serializes the entry including:
+    - seq: Sequence number (resume the feed after it)
+    - book_id: Internal database ID of the book
+    - action: 'upsert' (fetch /api/books/<book_id>/) or 'delete'
+    """
+    action = serializers.CharField(source='get_action_display', read_only=True)
+
+    class Meta:
+        model = BookChange
+        fields = ['seq', 'book_id', 'action']
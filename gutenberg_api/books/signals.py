@@ -0,0 +1,115 @@
+from django.core.signals import request_finished, request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import catalog, changes, denormalized, metrics, querycache, snapshot
+from .models import (
+    Author, Book, BookAuthor, BookBookshelf, BookChange, BookLanguage, Bookshelf, BookSubject, Format, FormatContent,
+    Language, MimeType, Subject, UrlTemplate,
+)
+
+
+@receiver([post_save, post_delete], sender=Language)
+@receiver([post_save, post_delete], sender=Bookshelf)
+@receiver([post_save, post_delete], sender=Subject)
+@receiver([post_save, post_delete], sender=MimeType)
+@receiver([post_save, post_delete], sender=UrlTemplate)
+@receiver([post_save, post_delete], sender=Format)
+@receiver([post_save, post_delete], sender=FormatContent)
+def dimension_changed(sender, **kwargs):
+    """Bump the catalog version so workers reload their lookup tables and format map."""
+    catalog.bump_version(kwargs.get('using'))
+
+
+@receiver([post_save, post_delete], sender=Book)
+@receiver([post_save, post_delete], sender=Author)
+@receiver([post_save, post_delete], sender=BookAuthor)
+@receiver([post_save, post_delete], sender=BookSubject)
+@receiver(m2m_changed, sender=BookAuthor)
+@receiver(m2m_changed, sender=BookSubject)
+def catalog_changed(sender, **kwargs):
+    """Record the change so conditional GETs stop answering 304 Not Modified."""
+    catalog.touch()
+
+
+@receiver([post_save, post_delete], sender=BookLanguage)
+@receiver([post_save, post_delete], sender=BookBookshelf)
+def book_link_changed(sender, instance, **kwargs):
+    """Resync the book's language and bookshelf id arrays."""
+    denormalized.sync([instance.book_id])
+    catalog.touch()
+
+
+@receiver(m2m_changed, sender=BookLanguage)
+@receiver(m2m_changed, sender=BookBookshelf)
+def book_links_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Resync the arrays after add(), remove(), set() or clear() on the relations."""
+    if not action.startswith('post_'):
+        return
+    catalog.touch()
+    if not reverse:
+        denormalized.sync([instance.pk])
+    elif pk_set is not None:
+        denormalized.sync(pk_set)
+    else:
+        # language.books.clear(): the affected books are no longer known
+        denormalized.sync()
+
+
+
+@receiver([post_save, post_delete], sender=Book)
+def book_changed(sender, instance, signal, **kwargs):
+    """Log the book in the change feed."""
+    changes.record([instance.pk], BookChange.DELETE if signal is post_delete else BookChange.UPSERT)
+
+
+@receiver([post_save, post_delete], sender=BookAuthor)
+@receiver([post_save, post_delete], sender=BookLanguage)
+@receiver([post_save, post_delete], sender=BookSubject)
+@receiver([post_save, post_delete], sender=BookBookshelf)
+@receiver([post_save, post_delete], sender=Format)
+def book_relation_changed(sender, instance, **kwargs):
+    """Log the book whose relation or format changed."""
+    changes.record([instance.book_id])
+
+
+@receiver(m2m_changed, sender=BookAuthor)
+@receiver(m2m_changed, sender=BookLanguage)
+@receiver(m2m_changed, sender=BookSubject)
+@receiver(m2m_changed, sender=BookBookshelf)
+def book_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Log the books of add(), remove(), set() or clear() on the relations."""
+    if not reverse:
+        if action.startswith('post_'):
+            changes.record([instance.pk])
+    elif action == 'pre_clear':
+        # e.g. language.books.clear(): the books are only known beforehand
+        changes.record(instance.books.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        changes.record(pk_set)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Language)
+@receiver(post_save, sender=Subject)
+@receiver(post_save, sender=Bookshelf)
+def dimension_renamed(sender, instance, created, **kwargs):
+    """Log the books showing a changed author, language, subject or bookshelf."""
+    if not created:
+        changes.record(instance.books.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=MimeType)
+@receiver(post_save, sender=UrlTemplate)
+def format_dimension_changed(sender, instance, created, **kwargs):
+    """Log the books with formats of a changed MIME type or URL template."""
+    if not created:
+        changes.record(instance.formats.values_list('book_id', flat=True))
+
+
+connection_created.connect(metrics.install_query_metrics)
+connection_created.connect(querycache.install)
+request_started.connect(snapshot.check)
+request_started.connect(querycache.start_request)
+request_finished.connect(querycache.finish_request)
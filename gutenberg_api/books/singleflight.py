@@ -0,0 +1,158 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .params import LIST_PARAMS
+
+
+def request_key(request):
+    """
+    Build a normalized key identifying a list request.
+
+    Empty parameters are dropped, parameters are sorted, and the values of
+    comma-separated filters are stripped and sorted, so that equivalent
+    requests share one key.
+
+    Args:
+        request: HTTP request
+
+    Returns:
+        str: Key for the request
+    """
+    params = []
+    for name in sorted(request.GET):
+        value = request.GET.get(name, '').strip()
+        if not value:
+            continue
+        if name in LIST_PARAMS:
+            value = ','.join(sorted(v.strip() for v in value.split(',') if v.strip()))
+        params.append(f'{name}={value}')
+    return f"{request.get_host()}{request.path}?{'&'.join(params)}"
+
+
+class _Call:
+    """A computation in flight for one key."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into a single computation.
+
+    When ``lock_dir`` is set, callers in different processes serialize on a
+    lock file of their own key (named by its digest, so unrelated keys never
+    wait on each other) and hand their result over through the
+    ``cache_alias`` cache. The file is removed by the caller releasing it.
+    A result is only taken by callers that were already waiting when it was
+    computed, never by later requests, so this is not a response cache;
+    stored results expire after ``result_ttl`` seconds.
+
+    Within a process, the first caller for a key (the leader) runs the
+    function while later callers wait for and share its result. This only
+    helps threaded workers (gthread); sync workers handle one request at a
+    time, so there the lock files do all the coalescing.
+
+    Attributes:
+        lock_dir (str): Directory for the lock files, or None for
+                        per-process (per-thread) coalescing only
+        result_ttl (int): Seconds a finished result is kept for leaders of
+                          other processes still waiting for the lock
+        cache_alias (str): Cache shared between processes
+    """
+
+    def __init__(self, lock_dir=None, result_ttl=None, cache_alias=None):
+        self.lock_dir = lock_dir if lock_dir is not None else settings.SINGLE_FLIGHT_LOCK_DIR
+        self.result_ttl = result_ttl if result_ttl is not None else settings.SINGLE_FLIGHT_RESULT_TTL
+        self.cache_alias = cache_alias or settings.SINGLE_FLIGHT_CACHE
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Return ``fn()``, sharing one execution among concurrent callers of ``key``.
+
+        Args:
+            key: Key identifying the computation
+            fn: Zero-argument callable producing the result
+
+        Returns:
+            The result of ``fn()``, possibly computed by another caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, fn)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def _run(self, key, fn):
+        """Run ``fn`` for the process leader, coordinating with other processes if configured."""
+        if not self.lock_dir:
+            return fn()
+
+        arrived = time.time()
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        cache = caches[self.cache_alias]
+        cache_key = f'singleflight:{digest}'
+        os.makedirs(self.lock_dir, exist_ok=True)
+        path = os.path.join(self.lock_dir, f'{digest}.lock')
+        lock_file = _lock(path)
+        try:
+            finished = cache.get(cache_key)
+            # Only a computation that finished while this one waited is shared
+            if finished is not None and finished[0] >= arrived:
+                return finished[1]
+            result = fn()
+            cache.set(cache_key, (time.time(), result), self.result_ttl)
+            return result
+        finally:
+            # Removed while still locked: callers waiting on this file see it
+            # is gone once they get the lock and open the current one
+            os.unlink(path)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+def _lock(path):
+    """
+    Open and exclusively lock the file at ``path``, creating it if needed.
+
+    Returns:
+        file: The locked file, which is still the one at ``path``
+    """
+    while True:
+        lock_file = open(path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        # Removed (and maybe recreated) by the previous holder
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
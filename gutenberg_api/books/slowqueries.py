@@ -0,0 +1,197 @@
+"""
+Slow query log.
+
+When SLOW_QUERY_LOG is set, every query of a request that takes longer
+than SLOW_QUERY_THRESHOLD seconds is appended to that file as a JSON line
+with its normalized SQL, the view and its filter parameters. For a
+SLOW_QUERY_EXPLAIN_RATE fraction of slow SELECTs on PostgreSQL the
+estimated plan is captured with a plain EXPLAIN, which plans the query
+without running it again; run EXPLAIN ANALYZE on a logged query by hand
+for actual times.
+
+The log rotates at SLOW_QUERY_LOG_MAX_BYTES, keeping
+SLOW_QUERY_LOG_BACKUPS old files; the slow_queries management command
+ranks filter shapes by the time their slow queries took.
+"""
+
+import fcntl
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections, transaction
+
+from .params import LIST_PARAMS
+
+# Parameters that page through results rather than filter them
+PAGE_PARAMS = ('page', 'page_size')
+
+_explaining = threading.local()
+
+
+def normalize_sql(sql):
+    """
+    Reduce SQL to its shape: placeholder lists, LIMIT/OFFSET values and
+    whitespace are collapsed so the same query with other values matches.
+    """
+    sql = re.sub(r'\(\s*%s(?:\s*,\s*%s)*\s*\)', '(...)', sql)
+    sql = re.sub(r'\b(LIMIT|OFFSET) \d+', r'\1 ?', sql)
+    return ' '.join(sql.split())
+
+
+def filter_shape(params):
+    """
+    Describe which filters a request used, ignoring their values.
+
+    Comma-separated filters are annotated with their number of values,
+    e.g. {'language': 'en,fr', 'topic': 'child'} -> 'language[2],topic'.
+
+    Returns:
+        str: The shape, or '-' for an unfiltered request
+    """
+    shape = []
+    for name in sorted(params):
+        value = params.get(name, '').strip()
+        if not value or name in PAGE_PARAMS:
+            continue
+        if name in LIST_PARAMS:
+            name = f"{name}[{len([v for v in value.split(',') if v.strip()])}]"
+        shape.append(name)
+    return ','.join(shape) or '-'
+
+
+def explain(connection, sql, params):
+    """
+    Run EXPLAIN (without ANALYZE) for a query.
+
+    Returns:
+        str or None: The plan, or None if it could not be captured
+    """
+    _explaining.active = True
+    try:
+        # In a savepoint, so a failing EXPLAIN cannot abort the request's transaction
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN {sql}', params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+    except DatabaseError:
+        return None
+    finally:
+        _explaining.active = False
+
+
+class SlowQueryLog:
+    """
+    Append-only JSON lines file, rotated by size.
+
+    Writes and rotation are serialized across processes with a lock file,
+    so all gunicorn workers can share one log.
+
+    Attributes:
+        path (str): Log file
+        max_bytes (int): Size at which the file is rotated
+        backups (int): Number of rotated files kept (path.1 is the newest)
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, entry):
+        """Append one entry, rotating first if the file would grow too large."""
+        line = json.dumps(entry) + '\n'
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, 'a') as f:
+                    f.write(line)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{number}'):
+                os.replace(f'{self.path}.{number}', f'{self.path}.{number + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def entries(self):
+        """Yield all entries, oldest first."""
+        files = [f'{self.path}.{number}' for number in range(self.backups, 0, -1)] + [self.path]
+        for path in files:
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+
+
+def get_log():
+    """Return the SlowQueryLog configured in settings."""
+    return SlowQueryLog(settings.SLOW_QUERY_LOG, settings.SLOW_QUERY_LOG_MAX_BYTES, settings.SLOW_QUERY_LOG_BACKUPS)
+
+
+class SlowQueryMiddleware:
+    """
+    Log the slow queries of each request (see the module docstring).
+
+    Disabled (removed from the middleware chain) unless SLOW_QUERY_LOG is set.
+    """
+
+    def __init__(self, get_response):
+        if not settings.SLOW_QUERY_LOG:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.log = get_log()
+
+    def __call__(self, request):
+        slow = []
+
+        def time_query(execute, sql, params, many, context):
+            if getattr(_explaining, 'active', False):
+                return execute(sql, params, many, context)
+            start = time.perf_counter()
+            result = execute(sql, params, many, context)
+            duration = time.perf_counter() - start
+            if duration >= settings.SLOW_QUERY_THRESHOLD:
+                connection = context['connection']
+                plan = None
+                if (not many and connection.vendor == 'postgresql'
+                        and sql.lstrip().upper().startswith('SELECT')
+                        and random.random() < settings.SLOW_QUERY_EXPLAIN_RATE):
+                    plan = explain(connection, sql, params)
+                slow.append({
+                    'alias': connection.alias,
+                    'duration': duration,
+                    'sql': normalize_sql(sql),
+                    'plan': plan,
+                })
+            return result
+
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(time_query))
+            response = self.get_response(request)
+
+        if slow:
+            match = request.resolver_match
+            context = {
+                'time': time.time(),
+                'view': match.view_name if match else 'unresolved',
+                'params': request.GET.dict(),
+                'shape': filter_shape(request.GET),
+            }
+            for query in slow:
+                self.log.write({**context, **query})
+        return response
@@ -0,0 +1,284 @@
+"""
+Read-only SQLite snapshots of the catalog for edge read nodes.
+
+The export_snapshot management command copies every catalog model (all
+books models except the download and change logs and the query cache
+generations) from one consistent PostgreSQL transaction into a single
+SQLite file, with the
+denormalized language and bookshelf arrays, the model indexes (GIN indexes
+excepted; see books.denormalized.overlap), and two extra tables:
+
+    snapshot_meta  key/value pairs: ``version`` (the catalog change stamp
+                   the snapshot was taken at, see books.catalog) and
+                   ``exported_at``
+    snapshot_file  name/data of the full-text index files (see
+                   books.textindex), if an index was built
+
+The file is analyzed and VACUUMed, then renamed into place, so readers
+never see a partial snapshot.
+
+With settings.SNAPSHOT_PATH set, the router sends reads of those models to
+the ``snapshot`` alias, which opens the file read-only and immutable with
+memory-mapped I/O. Publishing a new snapshot is another rename: check()
+runs at the start of every request and reopens the connection when the
+file was replaced. Catalog stamps come from the snapshot's own version, so
+lookup tables, the format map and ETags follow the swap.
+
+Edge read nodes need no primary database: downloads are not counted there,
+and views needing the primary (the change feed) are decorated with
+primary_only() and answer 404.
+"""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from functools import wraps
+from itertools import islice
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.utils import ConnectionHandler
+from django.http import Http404
+
+from . import catalog
+from .models import BookChange, DownloadBucket, PendingBookChange, TableGeneration
+
+ALIAS = 'snapshot'
+META_TABLE = 'snapshot_meta'
+FILES_TABLE = 'snapshot_file'
+# Operational logs and state, not served from snapshots
+EXCLUDED_MODELS = (DownloadBucket, BookChange, PendingBookChange, TableGeneration)
+BATCH_SIZE = 10000
+TEXT_INDEX_PREFIX = 'snapshot-'
+
+
+def exported_models():
+    """Return the models copied into snapshots."""
+    return [model for model in apps.get_app_config('books').get_models() if model not in EXCLUDED_MODELS]
+
+
+def serves(model):
+    """
+    Return whether reads of ``model`` are answered from the snapshot.
+
+    Args:
+        model: Model class being queried
+
+    Returns:
+        bool: True in snapshot mode for exported models
+    """
+    return bool(settings.SNAPSHOT_PATH) and model._meta.app_label == 'books' and model not in EXCLUDED_MODELS
+
+
+def primary_only(view):
+    """
+    View decorator answering 404 on edge read nodes, which have no primary database.
+
+    Use ``method_decorator(snapshot.primary_only, name='dispatch')`` on
+    class-based views, outermost so nothing reads the database first.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if settings.SNAPSHOT_PATH:
+            raise Http404('Not served by edge read nodes.')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def export(path, using=DEFAULT_DB_ALIAS):
+    """
+    Write a snapshot of the catalog and move it to ``path`` atomically.
+
+    Args:
+        path: Destination file; an existing snapshot is replaced
+        using: Database alias to copy from
+
+    Returns:
+        dict: Row count per table (including the snapshot tables)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.snapshot-', suffix='.sqlite3', dir=directory)
+    os.close(fd)
+    handler = ConnectionHandler({DEFAULT_DB_ALIAS: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': tmp}})
+    target = handler[DEFAULT_DB_ALIAS]
+    try:
+        counts = _write(target, using)
+        target.close()
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+    except BaseException:
+        target.close()
+        os.unlink(tmp)
+        raise
+    return counts
+
+
+def _write(target, using):
+    """Fill an empty SQLite database with the snapshot."""
+    models = exported_models()
+    with target.cursor() as cursor:
+        # The file is discarded if the export fails, so nothing is journaled
+        cursor.execute('PRAGMA journal_mode = OFF')
+        cursor.execute('PRAGMA synchronous = OFF')
+
+    # Tables first; indexes are built once the rows are in. GIN indexes
+    # would be plain indexes on JSON text here, of no use to overlap()
+    gin = [
+        target.ops.quote_name(index.name)
+        for model in models for index in model._meta.indexes if isinstance(index, GinIndex)
+    ]
+    with target.schema_editor(atomic=False) as editor:
+        for model in models:
+            editor.create_model(model)
+        indexes = [
+            str(statement) for statement in editor.deferred_sql
+            if not any(name in str(statement) for name in gin)
+        ]
+        editor.deferred_sql = []
+    with target.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {META_TABLE} (key text PRIMARY KEY, value text NOT NULL) WITHOUT ROWID')
+        cursor.execute(f'CREATE TABLE {FILES_TABLE} (name text PRIMARY KEY, data blob NOT NULL)')
+
+    # Stamped before reading: changes committed meanwhile bump the origin's
+    # stamp past this one, so the next snapshot is never mistaken for this one
+    version = catalog.last_changed()
+    counts = {}
+    target.set_autocommit(False)
+    source = connections[using]
+    repeatable = source.vendor == 'postgresql' and not source.in_atomic_block
+    with transaction.atomic(using=using):
+        if repeatable:
+            # All tables are read from the same database snapshot
+            with source.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        for model in models:
+            counts[model._meta.db_table] = _copy(model, using, target)
+    counts[FILES_TABLE] = _copy_text_index(target)
+    with target.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {META_TABLE} (key, value) VALUES (%s, %s)',
+            [('version', str(version)), ('exported_at', datetime.now(timezone.utc).isoformat())],
+        )
+        counts[META_TABLE] = 2
+        for sql in indexes:
+            cursor.execute(sql)
+    target.commit()
+    target.set_autocommit(True)
+
+    with target.cursor() as cursor:
+        cursor.execute('ANALYZE')
+        cursor.execute('VACUUM')
+    return counts
+
+
+def _copy(model, using, target):
+    """Copy the rows of one model; returns the number of rows."""
+    fields = model._meta.concrete_fields
+    quote = target.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    rows = (
+        model._base_manager.using(using).order_by('pk')
+        .values_list(*[field.attname for field in fields])
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    count = 0
+    with target.cursor() as cursor:
+        while batch := list(islice(rows, BATCH_SIZE)):
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(value, target) for field, value in zip(fields, row)]
+                for row in batch
+            ])
+            count += len(batch)
+    return count
+
+
+def _copy_text_index(target):
+    """Store the files of the live full-text index; returns their number."""
+    link = os.path.join(settings.TEXT_INDEX_ROOT, 'current')
+    if not os.path.islink(link):
+        return 0
+    path = os.path.realpath(link)
+    names = sorted(os.listdir(path))
+    with target.cursor() as cursor:
+        for name in names:
+            with open(os.path.join(path, name), 'rb') as f:
+                cursor.execute(f'INSERT INTO {FILES_TABLE} (name, data) VALUES (%s, %s)', [name, f.read()])
+    return len(names)
+
+
+def check(**kwargs):
+    """
+    ``request_started`` receiver reopening the snapshot after a swap.
+
+    The file is opened as immutable, so a connection keeps reading the
+    file it opened; a new snapshot is a new file (inode) at the same path.
+    """
+    if not settings.SNAPSHOT_PATH:
+        return
+    try:
+        stat = os.stat(settings.SNAPSHOT_PATH)
+    except OSError:
+        return
+    identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+    connection = connections[ALIAS]
+    # Recorded before the connection (re)opens: if the file is swapped in
+    # between, the next request sees a different identity and reopens again
+    if getattr(connection, 'snapshot_identity', None) != identity:
+        connection.close()
+        connection.snapshot_identity = identity
+
+
+def version():
+    """
+    Return the catalog change stamp the open snapshot was taken at.
+
+    Returns:
+        int: Change stamp in nanoseconds since the epoch
+    """
+    with connections[ALIAS].cursor() as cursor:
+        cursor.execute(f'SELECT value FROM {META_TABLE} WHERE key = %s', ['version'])
+        return int(cursor.fetchone()[0])
+
+
+def text_index():
+    """
+    Unpack the full-text index shipped in the open snapshot.
+
+    Each snapshot version is unpacked once below TEXT_INDEX_ROOT; indexes
+    of older versions are removed (workers still reading them keep their
+    memory maps).
+
+    Returns:
+        str or None: Index directory, or None if the snapshot has no index
+    """
+    root = settings.TEXT_INDEX_ROOT
+    stamp = version()
+    path = os.path.join(root, f'{TEXT_INDEX_PREFIX}{stamp}')
+    if os.path.isdir(path):
+        return path
+    with connections[ALIAS].cursor() as cursor:
+        cursor.execute(f'SELECT name, data FROM {FILES_TABLE}')
+        files = cursor.fetchall()
+    if not files:
+        return None
+
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f'.{TEXT_INDEX_PREFIX}', dir=root)
+    for name, data in files:
+        with open(os.path.join(tmp, os.path.basename(name)), 'wb') as f:
+            f.write(data)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # unpacked by another worker
+    for name in os.listdir(root):
+        if name.startswith(TEXT_INDEX_PREFIX) and int(name[len(TEXT_INDEX_PREFIX):]) < stamp:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return path
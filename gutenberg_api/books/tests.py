@@ -1,7 +1,56 @@
 # books/tests.py
-from rest_framework.test import APITestCase
+import gzip
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from xml.etree import ElementTree
+
+from django.core.management import CommandError, call_command
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from rest_framework.test import APITestCase, APITransactionTestCase
 from rest_framework import status
 
+from gutenberg_api.startup import measure_boot
+from . import (
+    catalog, changes, compression, denormalized, downloads, feeds, formatmap, lookups, metrics, querycache, sampling,
+    schema, singleflight, slowqueries, snapshot, textindex,
+)
+from .downloads import DownloadRecorder
+from .models import (
+    Author, Book, BookAuthor, BookChange, BookLanguage, Bookshelf, DownloadBucket, Format, FormatContent, Language,
+    MimeType, PendingBookChange, RelatedBook, Subject, TableGeneration, UrlTemplate,
+)
+from .routers import ReplicaRouter, on_primary, replica_reads
+from .singleflight import SingleFlight, request_key
+from .views import BookFilter
+from .throttling import TokenBucketStore, request_cost
+
+# Rate limiting is only enabled by ThrottleTests; other tests make many requests
+_throttle_disabled = override_settings(THROTTLE_ENABLED=False)
+
+
+def setUpModule():
+    _throttle_disabled.enable()
+
+
+def tearDownModule():
+    _throttle_disabled.disable()
+
 class BookAPITests(APITestCase):
     """Test the books API endpoints"""
 
@@ -100,3 +149,1982 @@ class BookAPITests(APITestCase):
                 format_info = book['formats'][0]
                 self.assertIn('mime_type', format_info)
                 self.assertIn('url', format_info)
+
+
+@override_settings(DATABASE_REPLICAS=['replica_0', 'replica_1'])
+class ReplicaRouterTests(SimpleTestCase):
+    """Test read/write routing between the primary and replicas"""
+
+    def test_reads_round_robin_over_replicas(self):
+        """Test if reads alternate between healthy replicas"""
+        router = ReplicaRouter()
+        with mock.patch.object(router, 'check', return_value=True), replica_reads():
+            aliases = [router.db_for_read(None) for _ in range(4)]
+        self.assertEqual(aliases, ['replica_0', 'replica_1', 'replica_0', 'replica_1'])
+
+    def test_unhealthy_replica_is_skipped(self):
+        """Test if a replica failing its health check receives no reads"""
+        router = ReplicaRouter()
+        with mock.patch.object(router, 'check', side_effect=lambda alias: alias == 'replica_1'), replica_reads():
+            aliases = {router.db_for_read(None) for _ in range(4)}
+        self.assertEqual(aliases, {'replica_1'})
+
+    def test_falls_back_to_primary(self):
+        """Test if reads use the primary when every replica is down"""
+        router = ReplicaRouter()
+        with mock.patch.object(router, 'check', return_value=False), replica_reads():
+            self.assertEqual(router.db_for_read(None), 'default')
+
+    def test_primary_outside_replica_views(self):
+        """Test if reads outside replica views, or loading in-memory copies in them, use the primary"""
+        router = ReplicaRouter()
+        with mock.patch.object(router, 'check', return_value=True) as check:
+            self.assertEqual(router.db_for_read(None), 'default')
+            with replica_reads(), on_primary():
+                self.assertEqual(router.db_for_read(None), 'default')
+        check.assert_not_called()
+
+    def test_writes_go_to_primary(self):
+        """Test if writes are always routed to the primary"""
+        self.assertEqual(ReplicaRouter().db_for_write(None), 'default')
+
+
+class ReplicaRoutingTests(APITransactionTestCase):
+    """Test where queries land with a real replica alias (a SQLite file holding its own rows)"""
+
+    ALIAS = 'replica_test'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added after the test runner set up the databases, so the replica
+        # is a separate SQLite file rather than a mirror of the primary
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.settings[cls.ALIAS] = connections.configure_settings({
+            DEFAULT_DB_ALIAS: connections.settings[DEFAULT_DB_ALIAS],
+            cls.ALIAS: {'ENGINE': 'django.db.backends.sqlite3',
+                        'NAME': os.path.join(cls.directory.name, 'replica.sqlite3')},
+        })[cls.ALIAS]
+        cls.databases = {DEFAULT_DB_ALIAS, cls.ALIAS}
+        with connections[cls.ALIAS].schema_editor() as editor:
+            for model in snapshot.exported_models():
+                editor.create_model(model)
+            editor.deferred_sql.clear()  # GIN indexes
+
+    @classmethod
+    def _databases_names(cls, include_mirrors=True):
+        # Only the primary is flushed between tests; setUp resets the replica
+        return [DEFAULT_DB_ALIAS]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[cls.ALIAS].close()
+        del connections[cls.ALIAS]
+        del connections.settings[cls.ALIAS]
+        cls.directory.cleanup()
+
+    def setUp(self):
+        caches[settings.QUERY_CACHE].clear()
+        self.emma = Book.objects.create(gutenberg_id=158, title='Emma', media_type='Text', download_count=2)
+        with connections[self.ALIAS].cursor() as cursor:
+            cursor.execute('DELETE FROM books_book')
+            cursor.execute(
+                'INSERT INTO books_book (id, gutenberg_id, download_count, media_type, title, trending_score, '
+                "language_ids, bookshelf_ids) VALUES (%s, 158, 2, 'Text', 'Emma (replica)', 0, '[]', '[]')",
+                [self.emma.id],
+            )
+        self.enterContext(override_settings(
+            DATABASE_REPLICAS=[self.ALIAS], DATABASE_ROUTERS=['books.routers.ReplicaRouter'],
+        ))
+
+    def read(self):
+        """Read the book's title, returning it and the aliases that ran a books_book query."""
+        aliases = []
+        with CaptureQueriesContext(connection) as primary, CaptureQueriesContext(connections[self.ALIAS]) as replica:
+            title = Book.objects.get(pk=self.emma.pk).title
+        for alias, queries in ((DEFAULT_DB_ALIAS, primary), (self.ALIAS, replica)):
+            if any('books_book' in query['sql'] for query in queries):
+                aliases.append(alias)
+        return title, aliases
+
+    def test_read_goes_to_replica(self):
+        """Test if reads of safe-method catalog requests run on the replica, and other reads on the primary"""
+        with replica_reads():
+            self.assertEqual(self.read(), ('Emma (replica)', [self.ALIAS]))
+        self.assertEqual(self.client.get(reverse('book-detail', args=[self.emma.pk])).data['title'], 'Emma (replica)')
+        self.assertEqual(self.read(), ('Emma', [DEFAULT_DB_ALIAS]))
+
+    def test_in_memory_copies_from_primary(self):
+        """Test if the lookup tables are loaded from the primary within a replica request"""
+        Language.objects.create(code='en')
+        with replica_reads(), CaptureQueriesContext(connections[self.ALIAS]) as replica:
+            self.assertEqual(list(lookups.load().languages.values()), ['en'])
+        self.assertFalse(replica.captured_queries)
+
+    def test_failover_to_primary(self):
+        """Test if reads use the primary when the replica cannot be opened"""
+        replica = connections[self.ALIAS]
+        replica.close()
+        self.addCleanup(replica.close)
+        with mock.patch.dict(replica.settings_dict, NAME='/nonexistent/replica.sqlite3'), replica_reads():
+            with CaptureQueriesContext(connection) as primary:
+                self.assertEqual(Book.objects.get(pk=self.emma.pk).title, 'Emma')
+            self.assertTrue(any('books_book' in query['sql'] for query in primary))
+            self.assertIsNone(replica.connection)
+
+    def test_admin_count_on_replica(self):
+        """Test if the admin paginator counts on the database its queryset reads"""
+        from .admin import EstimatedCountPaginator
+
+        with mock.patch.object(EstimatedCountPaginator, 'threshold', -2), replica_reads():
+            with CaptureQueriesContext(connection) as primary:
+                count = EstimatedCountPaginator(Book.objects.order_by('id'), 25).count
+        self.assertEqual(count, 1)  # counted on the replica, which has no planner estimate
+        self.assertFalse(primary.captured_queries)
+
+    def test_read_your_writes_in_transaction(self):
+        """Test if reads inside a transaction on the primary see its writes"""
+        with replica_reads():
+            with transaction.atomic():
+                Book.objects.filter(pk=self.emma.pk).update(title='Emma, revised')
+                self.assertEqual(self.read(), ('Emma, revised', [DEFAULT_DB_ALIAS]))
+            # The replica has not caught up: later reads see its rows again
+            self.assertEqual(self.read(), ('Emma (replica)', [self.ALIAS]))
+
+
+class SingleFlightTests(SimpleTestCase):
+    """Test coalescing of identical concurrent computations"""
+
+    def test_concurrent_calls_share_one_computation(self):
+        """Test if concurrent callers of one key run the function once"""
+        flight = SingleFlight(lock_dir='')
+        calls = []
+        waiting = threading.Semaphore(0)
+        release = threading.Event()
+
+        class WatchedEvent(threading.Event):
+            def wait(self, timeout=None):
+                waiting.release()
+                return super().wait(timeout)
+
+        class WatchedCall(singleflight._Call):
+            def __init__(self):
+                super().__init__()
+                self.event = WatchedEvent()
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return {'count': 1}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+            for _ in range(5)
+        ]
+        with mock.patch('books.singleflight._Call', WatchedCall):
+            for thread in threads:
+                thread.start()
+            # Let the computation finish once the four followers wait on it
+            for _ in range(4):
+                self.assertTrue(waiting.acquire(timeout=5))
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'count': 1}] * 5)
+
+    def test_result_shared_across_processes(self):
+        """Test if a worker waiting on another's computation reuses its result, and later ones do not"""
+        with tempfile.TemporaryDirectory() as lock_dir:
+            worker_a = SingleFlight(lock_dir=lock_dir, result_ttl=5)
+            worker_b = SingleFlight(lock_dir=lock_dir, result_ttl=5)
+            key = f'shared-{time.time()}'
+            with mock.patch('books.singleflight.time') as clock:
+                clock.time.side_effect = [99, 101]  # arrives, finishes
+                self.assertEqual(worker_a.do(key, lambda: 'first'), 'first')
+                clock.time.side_effect = [100]  # arrived while the first computation ran
+                self.assertEqual(worker_b.do(key, lambda: 'second'), 'first')
+                clock.time.side_effect = [102, 103]  # arrives after it finished
+                self.assertEqual(worker_b.do(key, lambda: 'third'), 'third')
+
+            for i in range(200):
+                worker_a.do(f'{key}-{i}', lambda: i)
+            self.assertEqual(os.listdir(lock_dir), [])  # lock files are removed on release
+
+    def test_unrelated_keys_do_not_wait(self):
+        """Test if a computation in flight in one process does not hold up other keys"""
+        with tempfile.TemporaryDirectory() as lock_dir:
+            worker_a = SingleFlight(lock_dir=lock_dir, result_ttl=5)
+            worker_b = SingleFlight(lock_dir=lock_dir, result_ttl=5)
+            started, release = threading.Event(), threading.Event()
+
+            def slow():
+                started.set()
+                release.wait(5)
+                return 'slow'
+
+            thread = threading.Thread(target=worker_a.do, args=('slow', slow))
+            thread.start()
+            self.addCleanup(thread.join)
+            self.addCleanup(release.set)
+            started.wait(5)
+            self.assertEqual(worker_b.do('fast', lambda: 'fast'), 'fast')
+            self.assertFalse(release.is_set())
+
+    def test_request_key_normalization(self):
+        """Test if equivalent list requests map to the same key"""
+        factory = RequestFactory()
+        first = factory.get('/api/books/?topic=fiction,child&language=en&title=')
+        second = factory.get('/api/books/?language=en&topic=child, fiction')
+        self.assertEqual(request_key(first), request_key(second))
+        self.assertNotEqual(
+            request_key(first), request_key(factory.get('/api/books/?topic=child&page=2'))
+        )
+
+
+class RelatedBooksTests(APITestCase):
+    """Test the precomputed related books index and endpoint"""
+
+    @classmethod
+    def setUpTestData(cls):
+        twain = Author.objects.create(name='Twain, Mark')
+        austen = Author.objects.create(name='Austen, Jane')
+        adventure = Subject.objects.create(name='Adventure stories')
+        romance = Subject.objects.create(name='Love stories')
+        shelf = Bookshelf.objects.create(name='Best Books Ever Listings')
+
+        cls.tom = Book.objects.create(gutenberg_id=74, title='Tom Sawyer', media_type='Text', download_count=500)
+        cls.huck = Book.objects.create(gutenberg_id=76, title='Huckleberry Finn', media_type='Text', download_count=900)
+        cls.yankee = Book.objects.create(gutenberg_id=86, title='A Connecticut Yankee', media_type='Text', download_count=100)
+        cls.pride = Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=2000)
+
+        for book in (cls.tom, cls.huck, cls.yankee):
+            book.authors.add(twain)
+        cls.tom.subjects.add(adventure)
+        cls.huck.subjects.add(adventure)
+        cls.huck.bookshelves.add(shelf)
+        cls.pride.authors.add(austen)
+        cls.pride.subjects.add(romance)
+        cls.pride.bookshelves.add(shelf)
+
+        call_command('compute_related_books', top_k=2, stdout=open(os.devnull, 'w'))
+
+    def test_most_similar_book_ranks_first(self):
+        """Test if books sharing author and subject rank above the rest"""
+        response = self.client.get(f'/api/books/{self.tom.id}/related/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([book['gutenberg_id'] for book in response.data], [76, 86])
+        self.assertGreater(response.data[0]['score'], response.data[1]['score'])
+
+    def test_book_is_not_related_to_itself(self):
+        """Test if a book never appears in its own related list"""
+        response = self.client.get(f'/api/books/{self.huck.id}/related/')
+        self.assertNotIn(self.huck.id, [book['id'] for book in response.data])
+
+    def test_unknown_book(self):
+        """Test if related books of a missing book return 404"""
+        response = self.client.get('/api/books/999999/related/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ComputeRelatedBooksTests(APITransactionTestCase):
+    """Test the reads and writes of the related books command"""
+
+    def test_snapshot_read_and_batched_writes(self):
+        """Test if the books and links are read in one snapshot and related books are written per batch"""
+        caches[settings.QUERY_CACHE].clear()
+        adventure = Subject.objects.create(name='Adventure stories')
+        for gutenberg_id in (74, 76, 86):
+            Book.objects.create(gutenberg_id=gutenberg_id, title=str(gutenberg_id), media_type='Text',
+                                download_count=10).subjects.add(adventure)
+        Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=10)
+        with CaptureQueriesContext(connection) as queries:
+            call_command('compute_related_books', batch_size=1, stdout=StringIO())
+        self.assertEqual([query['sql'] for query in queries[:2]], ['BEGIN', 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'])
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "books_related_book"')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(RelatedBook.objects.count(), 6)
+
+
+class TrendingTests(APITestCase):
+    """Test time-bucketed download counting and trending order"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.classic = Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=5000)
+        cls.recent = Book.objects.create(gutenberg_id=84, title='Frankenstein', media_type='Text', download_count=10)
+
+    def test_clicks_are_aggregated_into_one_bucket(self):
+        """Test if buffered clicks become one hourly bucket and one counter update"""
+        recorder = DownloadRecorder(flush_size=100, flush_interval=3600)
+        for _ in range(3):
+            recorder.record(self.recent.id)
+        self.assertFalse(DownloadBucket.objects.exists())
+
+        self.assertEqual(recorder.flush(), 3)
+        bucket = DownloadBucket.objects.get(book=self.recent)
+        self.assertEqual((bucket.granularity, bucket.count), (DownloadBucket.HOUR, 3))
+        self.recent.refresh_from_db()
+        self.assertEqual(self.recent.download_count, 13)
+
+    def test_failed_flush_keeps_clicks(self):
+        """Test if a failed flush requeues the clicks and drops only those of deleted books"""
+        gone = Book.objects.create(gutenberg_id=85, title='Gone', media_type='Text')
+        recorder = DownloadRecorder(flush_size=100, flush_interval=3600)
+        recorder.record(self.recent.id)
+        recorder.record(gone.id)
+        Book.objects.filter(pk=gone.pk).delete()
+        with connection.cursor() as cursor:
+            # Foreign keys are checked at commit; the test transaction never commits
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        with self.assertLogs('books.downloads', 'WARNING'):
+            self.assertEqual(recorder.flush(), 0)
+        self.assertEqual(recorder.flush(), 1)
+        self.assertEqual(DownloadBucket.objects.get().book_id, self.recent.id)
+
+        recorder.record(self.recent.id)
+        with mock.patch('books.downloads.add_to_buckets', side_effect=OperationalError), self.assertLogs('books.downloads'):
+            self.assertEqual(recorder.flush(), 0)
+        self.assertEqual(recorder.flush(), 1)
+
+    def test_idle_buffer_is_flushed_by_timer(self):
+        """Test if pending clicks are flushed after flush_interval without another click"""
+        recorder = DownloadRecorder(flush_size=100, flush_interval=0.01)
+        flushed = threading.Event()
+        with mock.patch.object(recorder, 'flush', side_effect=flushed.set):
+            recorder.record(self.recent.id)
+            self.assertTrue(flushed.wait(5))
+
+    def test_download_view_records_click(self):
+        """Test if the download redirect counts the click"""
+        book_format = Format.objects.create(book=self.recent, mime_type='text/plain', url='https://www.gutenberg.org/ebooks/84.txt.utf-8')
+        with mock.patch('books.views.recorder') as recorder:
+            response = self.client.get(f'/download/{self.recent.id}/{book_format.id}/')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        recorder.record.assert_called_once_with(self.recent.id)
+
+    def test_trending_sort(self):
+        """Test if sort=trending ranks recently downloaded books first"""
+        recorder = DownloadRecorder(flush_size=100, flush_interval=3600)
+        recorder.record(self.recent.id)
+        recorder.flush()
+        call_command('rollup_downloads', stdout=open(os.devnull, 'w'))
+
+        response = self.client.get('/api/books/?sort=trending')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['gutenberg_id'], 84)
+        response = self.client.get('/api/books/')
+        self.assertEqual(response.data['results'][0]['gutenberg_id'], 1342)
+
+    def test_rollup_folds_old_hourly_buckets(self):
+        """Test if hourly buckets past retention are summed into a daily bucket"""
+        old = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=5)
+        for hours in (0, 1):
+            DownloadBucket.objects.create(book=self.classic, granularity=DownloadBucket.HOUR,
+                                          bucket_start=old + timedelta(hours=hours), count=2)
+        call_command('rollup_downloads', stdout=open(os.devnull, 'w'))
+
+        self.assertFalse(DownloadBucket.objects.filter(granularity=DownloadBucket.HOUR).exists())
+        self.assertEqual(DownloadBucket.objects.get(granularity=DownloadBucket.DAY).count, 4)
+
+
+class PersistedSchemaTests(APITestCase):
+    """Test the schema views serving the persisted OpenAPI document"""
+
+    def setUp(self):
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        self.enterContext(override_settings(STATIC_ROOT=static_root.name))
+        schema._artifacts.clear()
+        self.addCleanup(schema._artifacts.clear)
+
+    def test_schema_generated_once(self):
+        """Test if a stale schema is generated in memory only, and a persisted one is read from disk"""
+        with mock.patch.object(schema, 'render_schema', wraps=schema.render_schema) as render:
+            with self.assertLogs('books.schema', 'WARNING'):
+                first = self.client.get('/swagger/?format=openapi')
+            self.assertFalse(os.path.exists(schema.schema_dir()))  # nothing written under STATIC_ROOT
+            call_command('generate_schema', stdout=StringIO())
+            schema._artifacts.clear()
+            second = self.client.get('/swagger/?format=openapi')
+        self.assertEqual(render.call_count, 2)  # in memory, then by the command
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.content, second.content)
+        self.assertIn('/books/', json.loads(first.content)['paths'])
+
+    def test_precompressed_variant(self):
+        """Test if gzip-accepting clients receive the precompressed document"""
+        plain = self.client.get('/swagger/?format=openapi')
+        compressed = self.client.get('/swagger/?format=openapi', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        refused = self.client.get('/swagger/?format=openapi', HTTP_ACCEPT_ENCODING='gzip;q=0, br;q=0')
+        self.assertEqual(refused.content, plain.content)
+
+    def test_ui_pages(self):
+        """Test if the Swagger and ReDoc pages render"""
+        for url in ('/swagger/', '/redoc/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class StartupTests(SimpleTestCase):
+    """Benchmark worker boot and check that heavy components load lazily"""
+
+    def test_worker_boot_time(self):
+        """Test if a fresh worker boots within budget without loading lazy modules"""
+        budget = float(os.getenv('STARTUP_BOOT_BUDGET', '5'))
+        report = measure_boot()
+        self.assertLess(report['phases']['total'], budget)
+        self.assertEqual(report['lazy'], [])
+
+
+class LazyAdminTests(APITestCase):
+    """Test the admin site loaded on first use"""
+
+    def test_admin_reachable(self):
+        """Test if admin pages resolve and reverse after lazy autodiscovery"""
+        response = self.client.get('/admin/login/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(reverse('admin:books_book_changelist'), '/admin/books/book/')
+
+
+class LookupTablesTests(APITestCase):
+    """Test the in-process dimension lookup tables"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(gutenberg_id=17, title='The Book of Mormon', media_type='Text', download_count=1)
+        cls.book.languages.add(Language.objects.create(code='en'))
+        cls.book.bookshelves.add(Bookshelf.objects.create(name='Religion'))
+
+    def test_serialized_from_lookup_tables(self):
+        """Test if languages and bookshelves are served without querying their tables"""
+        lookups.refresh()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/books/')
+        book = response.data['results'][0]
+        self.assertEqual(book['languages'], [{'code': 'en'}])
+        self.assertEqual(book['bookshelves'], [{'name': 'Religion'}])
+        for query in queries:
+            self.assertNotIn('"books_language"', query['sql'])
+            self.assertNotIn('"books_bookshelf"', query['sql'])
+
+    def test_subjects_from_lookup_table(self):
+        """Test if popular subjects are served from the lookup table and others in one query"""
+        for number in range(3):
+            book = Book.objects.create(gutenberg_id=100 + number, title=f'Sermons {number}', media_type='Text')
+            book.subjects.add(Subject.objects.get_or_create(name='Sermons')[0])
+        lookups.refresh()
+        for book in Book.objects.filter(title__startswith='Sermons'):
+            book.subjects.add(Subject.objects.create(name=f'{book.title}, English'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/books/')
+        subjects = {book['title']: book['subjects'] for book in response.data['results']}
+        self.assertEqual(subjects['Sermons 1'], [{'name': 'Sermons'}, {'name': 'Sermons 1, English'}])
+        self.assertEqual(subjects[self.book.title], [])
+        self.assertEqual(len([query for query in queries if '"books_subject"' in query['sql']]), 1)
+
+    def test_new_rows_resolved(self):
+        """Test if rows added after loading are still resolved"""
+        lookups.refresh()
+        french = Language.objects.create(code='fr')
+        self.assertEqual(lookups.lookup('languages', french.id), 'fr')
+
+    @override_settings(LOOKUP_TABLES_CHECK_INTERVAL=0)
+    def test_reload_on_catalog_version_change(self):
+        """Test if tables are reloaded once the catalog version changes"""
+        shelf = Bookshelf.objects.get(name='Religion')
+        tables = lookups.get()
+        Bookshelf.objects.filter(pk=shelf.pk).update(name='Philosophy & Religion')
+        self.assertIs(lookups.get(), tables)
+        catalog.bump_version()
+        self.assertEqual(lookups.get().bookshelves[shelf.pk], 'Philosophy & Religion')
+
+
+class LocalContentTests(APITestCase):
+    """Test serving book files from the local content store"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(gutenberg_id=84, title='Frankenstein', media_type='Text', download_count=0)
+        cls.text = Format.objects.create(
+            book=cls.book, mime_type='text/plain; charset=utf-8',
+            url='https://www.gutenberg.org/ebooks/84.txt.utf-8',
+        )
+        cls.epub = Format.objects.create(
+            book=cls.book, mime_type='application/epub+zip',
+            url='https://www.gutenberg.org/ebooks/84.epub3.images',
+        )
+
+    def setUp(self):
+        store = tempfile.TemporaryDirectory()
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(store.cleanup)
+        self.addCleanup(source.cleanup)
+        self.enterContext(override_settings(CONTENT_STORE_ROOT=store.name, LOOKUP_TABLES_CHECK_INTERVAL=0))
+        self.recorder = self.enterContext(mock.patch('books.views.recorder'))
+        self.body = b'You will rejoice to hear that no disaster has accompanied the commencement. ' * 200
+        with open(os.path.join(source.name, '84.txt.utf-8'), 'wb') as f:
+            f.write(self.body)
+        call_command('import_content', source.name, stdout=open(os.devnull, 'w'))
+        self.url = reverse('download_book', args=[self.book.id, self.text.id])
+
+    def test_import(self):
+        """Test if matching files are imported with a gzip variant"""
+        stored = FormatContent.objects.get(format=self.text)
+        self.assertEqual(stored.size, len(self.body))
+        self.assertLess(stored.gzip_size, stored.size)
+        self.assertFalse(FormatContent.objects.filter(format=self.epub).exists())
+
+    def test_full_download(self):
+        """Test if the whole file is served with an ETag"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['ETag'])
+
+    def test_range_request(self):
+        """Test if a byte range is served as partial content"""
+        response = self.client.get(self.url, HTTP_RANGE='bytes=4-11')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.body[4:12])
+        self.assertEqual(response['Content-Range'], f'bytes 4-11/{len(self.body)}')
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.body)}-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    def test_invalid_range_ignored(self):
+        """Test if a syntactically invalid range is ignored rather than answered with 416"""
+        response = self.client.get(self.url, HTTP_RANGE='bytes=500-100')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+
+    def test_if_range(self):
+        """Test if If-Range serves the range only for the current ETag or Last-Modified date"""
+        full = self.client.get(self.url)
+        for validator, expected in [
+            (full['ETag'], status.HTTP_206_PARTIAL_CONTENT),
+            (full['Last-Modified'], status.HTTP_206_PARTIAL_CONTENT),
+            ('"0000"', status.HTTP_200_OK),
+            (f'W/{full["ETag"]}', status.HTTP_200_OK),
+            ('Thu, 01 Jan 1970 00:00:00 GMT', status.HTTP_200_OK),
+        ]:
+            with self.subTest(validator=validator):
+                response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=validator)
+                self.assertEqual(response.status_code, expected)
+
+    def test_resumed_download_not_counted(self):
+        """Test if only requests starting at the first byte count as downloads"""
+        self.client.get(self.url, HTTP_RANGE='bytes=0-99')
+        self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.recorder.record.assert_called_once_with(self.book.id)
+
+    def test_not_modified(self):
+        """Test if a matching If-None-Match yields 304"""
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_gzip_variant(self):
+        """Test if the precompressed variant is sent to clients accepting gzip, and only to them"""
+        for accepted in ('gzip', 'br, gzip;q=0.5'):
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=accepted)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.body)
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+
+    def test_redirect_without_local_copy(self):
+        """Test if formats without a local copy still redirect"""
+        response = self.client.get(reverse('download_book', args=[self.book.id, self.epub.id]))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response['Location'], self.epub.url)
+
+
+class TextSearchTests(APITestCase):
+    """Test the full-text index over mirrored book texts"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.frankenstein = Book.objects.create(gutenberg_id=84, title='Frankenstein', media_type='Text', download_count=0)
+        cls.frankenstein.authors.add(Author.objects.create(name='Shelley, Mary Wollstonecraft'))
+        cls.dracula = Book.objects.create(gutenberg_id=345, title='Dracula', media_type='Text', download_count=0)
+        for book, name in ((cls.frankenstein, '84-0.txt'), (cls.dracula, '345-0.txt')):
+            Format.objects.create(book=book, mime_type='text/plain; charset=utf-8',
+                                  url=f'https://www.gutenberg.org/files/{book.gutenberg_id}/{name}')
+
+    def setUp(self):
+        store = tempfile.TemporaryDirectory()
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(store.cleanup)
+        self.addCleanup(source.cleanup)
+        self.enterContext(override_settings(
+            CONTENT_STORE_ROOT=store.name, TEXT_INDEX_ROOT=os.path.join(store.name, 'index'),
+        ))
+        filler = 'It was on a dreary night of November. ' * 100
+        texts = {
+            '84-0.txt': filler + 'I beheld the wretch, the miserable monster whom I had created. ' + filler,
+            '345-0.txt': 'Listen to them, the children of the night. What music they make! The monster sleeps.',
+        }
+        for name, text in texts.items():
+            with open(os.path.join(source.name, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+        call_command('import_content', source.name, stdout=open(os.devnull, 'w'))
+        call_command('build_text_index', workers=2, stdout=open(os.devnull, 'w'))
+
+    def search(self, query):
+        response = self.client.get('/api/books/search/', {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results']
+
+    def test_term_search(self):
+        """Test if a term finds every book containing it"""
+        results = self.search('monster')
+        self.assertEqual({r['gutenberg_id'] for r in results}, {84, 345})
+
+    def test_phrase_search(self):
+        """Test if quoted phrases only match adjacent words"""
+        results = self.search('"miserable monster"')
+        self.assertEqual([r['gutenberg_id'] for r in results], [84])
+        self.assertEqual(results[0]['title'], 'Frankenstein')
+        self.assertEqual(results[0]['authors'], [{'name': 'Shelley, Mary Wollstonecraft', 'birth_year': None, 'death_year': None}])
+        self.assertIn('the miserable monster whom I had created', results[0]['snippet'])
+        self.assertEqual(self.search('"monster miserable"'), [])
+
+    def test_all_clauses_required(self):
+        """Test if books must contain every word and phrase"""
+        self.assertEqual([r['gutenberg_id'] for r in self.search('"children of the night" monster')], [345])
+        self.assertEqual(self.search('monster vampire'), [])
+
+    def test_snippet_past_first_checkpoint(self):
+        """Test if snippets are cut correctly deep inside a text"""
+        index = textindex.get_index()
+        match = index.search('wretch')[0]
+        self.assertGreater(match.position, textindex.CHECKPOINT_EVERY)
+        self.assertIn('I beheld the wretch', index.snippet(match))
+
+    def test_built_from_runs(self):
+        """Test if an index merged from many on-disk runs answers like one built in memory"""
+        index = textindex.get_index()
+        expected = {query: index.search(query) for query in ('monster', '"children of the night"', 'november')}
+        call_command('build_text_index', workers=1, run_bytes=1, stdout=open(os.devnull, 'w'))
+        index = textindex.get_index()
+        self.assertEqual({query: index.search(query) for query in expected}, expected)
+        self.assertEqual(index.terms.get('monster')[2], 2)  # document frequency summed over the runs
+        self.assertIsNone(index.terms.get('vampire'))
+        self.assertFalse([name for name in os.listdir(settings.TEXT_INDEX_ROOT) if name.startswith('runs-')])
+        self.assertNotIn('terms.json', os.listdir(index.path))
+
+    def test_query_required(self):
+        """Test if a missing query is rejected"""
+        response = self.client.get('/api/books/search/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AdminQueryBudgetTests(APITestCase):
+    """Test that admin pages run a fixed number of queries"""
+
+    # Session, user and the page's own queries; independent of the row count
+    BUDGET = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        from django.contrib.auth.models import User
+
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        english = Language.objects.create(code='en')
+        author = Author.objects.create(name='Austen, Jane')
+        subject = Subject.objects.create(name='Courtship -- Fiction')
+        for n in range(30):
+            book = Book.objects.create(gutenberg_id=n + 1, title=f'Book {n}', media_type='Text', download_count=n)
+            book.languages.add(english)
+            book.authors.add(author)
+            book.subjects.add(subject)
+            Format.objects.create(book=book, mime_type='text/html', url=f'https://www.gutenberg.org/ebooks/{n}.html')
+        cls.book = book
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assertWithinBudget(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertLessEqual(len(queries), self.BUDGET, '\n'.join(q['sql'] for q in queries))
+        return response
+
+    def test_book_changelist(self):
+        """Test if the book changelist, search and filter stay within budget"""
+        self.assertWithinBudget(reverse('admin:books_book_changelist'))
+        self.assertWithinBudget(reverse('admin:books_book_changelist') + '?q=austen')
+        language = Language.objects.get(code='en')
+        response = self.assertWithinBudget(reverse('admin:books_book_changelist') + f'?languages__id__exact={language.id}')
+        self.assertEqual(response.context['cl'].result_count, 30)
+
+    def test_format_changelist(self):
+        """Test if format rows do not load their book one by one"""
+        self.assertWithinBudget(reverse('admin:books_format_changelist'))
+
+    def test_book_change_form(self):
+        """Test if the book change form with author and subject inlines stays within budget"""
+        response = self.assertWithinBudget(reverse('admin:books_book_change', args=[self.book.id]))
+        self.assertContains(response, 'admin-autocomplete')
+
+    def test_estimated_count(self):
+        """Test if large unfiltered tables are counted from the planner estimate"""
+        from .admin import EstimatedCountPaginator
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE books_book')
+        with mock.patch.object(EstimatedCountPaginator, 'threshold', 10):
+            paginator = EstimatedCountPaginator(Book.objects.order_by('id'), 25)
+            with CaptureQueriesContext(connection) as queries:
+                paginator.count
+        self.assertNotIn('COUNT(', queries[0]['sql'])
+        self.assertEqual(EstimatedCountPaginator(Book.objects.filter(download_count__gt=9), 25).count, 20)
+
+
+class MetricsTests(APITestCase):
+    """Test the Prometheus metrics endpoint"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=1)
+
+    def sample(self, text, name, **labels):
+        """Return the value of a sample in exposition text, or 0 if absent."""
+        from prometheus_client.parser import text_string_to_metric_families
+
+        for family in text_string_to_metric_families(text):
+            for sample in family.samples:
+                if sample.name == name and all(sample.labels.get(k) == v for k, v in labels.items()):
+                    return sample.value
+        return 0
+
+    def test_request_and_query_metrics(self):
+        """Test if view latency and database queries are exposed"""
+        before = self.client.get('/metrics').content.decode()
+        self.client.get('/api/books/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        after = response.content.decode()
+
+        labels = {'view': 'book-list', 'method': 'GET', 'status': '200'}
+        self.assertEqual(
+            self.sample(after, 'http_request_duration_seconds_count', **labels)
+            - self.sample(before, 'http_request_duration_seconds_count', **labels), 1)
+        self.assertGreater(
+            self.sample(after, 'db_query_duration_seconds_count', alias='default')
+            - self.sample(before, 'db_query_duration_seconds_count', alias='default'), 0)
+        self.assertGreater(self.sample(after, 'pagination_page_number_count'), 0)
+
+    def test_unknown_methods_share_a_label(self):
+        """Test if non-standard request methods are labeled 'other'"""
+        before = metrics.render_metrics().decode()
+        self.client.generic('BREW', '/api/books/')
+        after = metrics.render_metrics().decode()
+        self.assertEqual(self.sample(after, 'http_request_duration_seconds_count', method='BREW'), 0)
+        self.assertEqual(
+            self.sample(after, 'http_request_duration_seconds_count', view='book-list', method='other')
+            - self.sample(before, 'http_request_duration_seconds_count', view='book-list', method='other'), 1)
+
+    def test_access_restricted(self):
+        """Test if /metrics only answers allowed addresses or the token"""
+        with override_settings(METRICS_ALLOWED_IPS=['10.0.0.0/8'], METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, status.HTTP_200_OK)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_cache_and_flush_metrics(self):
+        """Test if cache hits/misses and download flush sizes are counted"""
+        from django.core.cache import caches
+
+        before = metrics.render_metrics().decode()
+        caches['default'].set('metrics-test', 1)
+        caches['default'].get('metrics-test')
+        caches['default'].get('metrics-test-missing')
+        recorder = DownloadRecorder(flush_size=100, flush_interval=3600)
+        recorder.record(Book.objects.get().id)
+        recorder.flush()
+        after = metrics.render_metrics().decode()
+
+        for result in ('hit', 'miss'):
+            self.assertEqual(
+                self.sample(after, 'cache_requests_total', cache='default', result=result)
+                - self.sample(before, 'cache_requests_total', cache='default', result=result), 1)
+        self.assertEqual(
+            self.sample(after, 'download_flush_clicks_sum') - self.sample(before, 'download_flush_clicks_sum'), 1)
+
+    def test_multiprocess_aggregation(self):
+        """Test if samples written by several worker processes are summed"""
+        import subprocess
+        import sys
+
+        with tempfile.TemporaryDirectory() as directory:
+            script = 'from books import metrics; metrics.DOWNLOAD_FLUSH_CLICKS.observe(5)'
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory, DJANGO_SETTINGS_MODULE='gutenberg_api.settings')
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', 'import django; django.setup(); ' + script],
+                               check=True, env=env, cwd=os.path.dirname(os.path.dirname(__file__)))
+            text = metrics.render_metrics(directory).decode()
+        self.assertEqual(self.sample(text, 'download_flush_clicks_count'), 2)
+        self.assertEqual(self.sample(text, 'download_flush_clicks_sum'), 10)
+
+
+class ProfilingTests(APITestCase):
+    """Test the sampling profiler for slow requests"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=1)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def slow_request(self):
+        """Request the book list with serialization slowed down."""
+        from .serializers import BookSerializer
+
+        original = BookSerializer.to_representation
+
+        def slow(serializer, instance):
+            time.sleep(0.05)
+            return original(serializer, instance)
+
+        with mock.patch.object(BookSerializer, 'to_representation', slow):
+            self.client.get('/api/books/')
+
+    def test_slow_request_profiled(self):
+        """Test if requests over the threshold are written with their stacks and SQL"""
+        with override_settings(PROFILE_DIR=self.directory, PROFILE_THRESHOLD=0.03, PROFILE_INTERVAL=0.002):
+            self.slow_request()
+            self.client.get('/api/books/1/related/')
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(len(files), 3)
+
+        base = os.path.join(self.directory, files[0].split('.')[0])
+        with open(f'{base}.json') as f:
+            meta = json.load(f)
+        self.assertEqual(meta['view'], 'book-list')
+        self.assertTrue(any('"books_book"' in query['sql'] for query in meta['queries']))
+        with open(f'{base}.collapsed') as f:
+            self.assertIn('books.views.BookViewSet.list', f.read())
+        with open(f'{base}.speedscope.json') as f:
+            self.assertEqual(json.load(f)['profiles'][0]['type'], 'sampled')
+
+    def test_fast_requests_discarded(self):
+        """Test if requests under the threshold are not written"""
+        with override_settings(PROFILE_DIR=self.directory, PROFILE_THRESHOLD=60, PROFILE_SAMPLE_RATE=0):
+            self.client.get('/api/books/')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_aggregate_profiles(self):
+        """Test if profiles are merged into collapsed stacks and a summary"""
+        with override_settings(PROFILE_DIR=self.directory, PROFILE_THRESHOLD=0.03, PROFILE_INTERVAL=0.002):
+            self.slow_request()
+            self.slow_request()
+        output = os.path.join(self.directory, 'merged.collapsed')
+        report = StringIO()
+        call_command('aggregate_profiles', dir=self.directory, view='book-list', output=output, stdout=report)
+        self.assertIn('2 requests', report.getvalue())
+        self.assertIn('SQL by total time', report.getvalue())
+        with open(output) as f:
+            self.assertIn('books.views.BookViewSet.list', f.read())
+
+
+class SlowQueryLogTests(APITestCase):
+    """Test the slow query log"""
+
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=1)
+        book.languages.add(Language.objects.create(code='en'))
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'slow.log')
+
+    def test_slow_queries_logged_with_plan(self):
+        """Test if slow queries are logged with their view, filter shape and plan"""
+        with override_settings(SLOW_QUERY_LOG=self.path, SLOW_QUERY_THRESHOLD=0, SLOW_QUERY_EXPLAIN_RATE=1):
+            self.client.get('/api/books/', {'language': 'en,fr', 'title': 'pride', 'page': '1'})
+            entries = list(slowqueries.get_log().entries())
+        self.assertTrue(entries)
+        self.assertEqual({e['view'] for e in entries}, {'book-list'})
+        self.assertEqual(entries[0]['shape'], 'language[2],title')
+        self.assertEqual(entries[0]['params']['language'], 'en,fr')
+        self.assertTrue(any('IN (...)' in e['sql'] for e in entries))
+        plans = [e['plan'] for e in entries if e['plan']]
+        self.assertTrue(any('cost=' in plan for plan in plans))
+        self.assertFalse(any('Execution Time' in plan for plan in plans))  # not run again
+
+    def test_fast_queries_not_logged(self):
+        """Test if queries under the threshold are not logged"""
+        with override_settings(SLOW_QUERY_LOG=self.path, SLOW_QUERY_THRESHOLD=60):
+            self.client.get('/api/books/')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_rotation(self):
+        """Test if the log rotates by size and keeps its backups readable"""
+        log = slowqueries.SlowQueryLog(self.path, max_bytes=100, backups=2)
+        for n in range(5):
+            log.write({'n': n, 'padding': 'x' * 50})
+        self.assertEqual([e['n'] for e in log.entries()], [2, 3, 4])
+
+    def test_summary(self):
+        """Test if the summary ranks filter shapes by total time"""
+        with override_settings(SLOW_QUERY_LOG=self.path):
+            log = slowqueries.get_log()
+            for shape, duration in (('topic', 0.5), ('topic', 0.7), ('language[1]', 0.9)):
+                log.write({'view': 'book-list', 'shape': shape, 'params': {}, 'duration': duration,
+                           'sql': 'SELECT 1', 'plan': None, 'alias': 'default', 'time': 0})
+            report = StringIO()
+            call_command('slow_queries', stdout=report)
+        lines = report.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('book-list topic: 2 slow queries'))
+        self.assertIn('book-list language[1]: 1 slow queries', report.getvalue())
+
+
+class CompressionTests(APITestCase):
+    """Test compression of dynamic responses"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for n in range(20):
+            Book.objects.create(gutenberg_id=n + 1, title=f'Book {n}', media_type='Text', download_count=n)
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        caches['default'].clear()
+
+    def test_gzip(self):
+        """Test if large JSON responses are gzipped for clients accepting gzip"""
+        plain = self.client.get('/api/books/')
+        response = self.client.get('/api/books/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertNotIn('Content-Encoding', plain)
+
+    def test_brotli_preferred(self):
+        """Test if brotli is used when accepted and installed"""
+        if compression.brotli is None:
+            self.skipTest('brotli is not installed')
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertIn(b'<html', compression.brotli.decompress(response.content).lower())
+
+    def test_negotiation(self):
+        """Test if q-values are honoured"""
+        self.assertEqual(compression.negotiate('gzip;q=1.0, br;q=0'), 'gzip')
+        self.assertEqual(compression.negotiate('identity'), None)
+        self.assertEqual(compression.negotiate('gzip;q=0'), None)
+        self.assertEqual(compression.negotiate(''), None)
+
+    @override_settings(COMPRESSION_MIN_SIZE=10 ** 9)
+    def test_min_size(self):
+        """Test if responses under the threshold are sent uncompressed"""
+        response = self.client.get('/api/books/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_compressed_once(self):
+        """Test if identical responses reuse the cached compressed bytes"""
+        with mock.patch('books.compression.compress', wraps=compression.compress) as compress:
+            first = self.client.get('/api/books/', HTTP_ACCEPT_ENCODING='gzip')
+            second = self.client.get('/api/books/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(first.content, second.content)
+
+    def test_benchmark(self):
+        """Test if the benchmark reports every setting"""
+        report = StringIO()
+        call_command('benchmark_compression', '/api/books/', repeat=1, stdout=report)
+        self.assertIn('gzip', report.getvalue())
+        self.assertIn('Cached', report.getvalue())
+
+
+class ThrottleTests(APITestCase):
+    """Test per-client token bucket rate limiting"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(
+            THROTTLE_ENABLED=True, THROTTLE_RATE=1, THROTTLE_BURST=5,
+            THROTTLE_DB=os.path.join(directory.name, 'throttle.sqlite3'),
+        ))
+
+    def test_api_limited_with_retry_after(self):
+        """Test if a client over its burst gets 429 with Retry-After"""
+        for _ in range(5):
+            self.assertEqual(self.client.get('/api/books/').status_code, status.HTTP_200_OK)
+        response = self.client.get('/api/books/')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+        # Another client has its own bucket
+        response = self.client.get('/api/books/', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_forwarded_for_not_trusted_beyond_proxies(self):
+        """Test if clients cannot get fresh buckets by rotating X-Forwarded-For"""
+        for i in range(6):
+            response = self.client.get('/api/books/', HTTP_X_FORWARDED_FOR=f'10.1.0.{i}')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # Behind one proxy, the address it appended identifies the client
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            for i in range(6):
+                response = self.client.get('/api/books/', HTTP_X_FORWARDED_FOR=f'10.1.0.{i}, 10.2.0.1')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            response = self.client.get('/api/books/', HTTP_X_FORWARDED_FOR='10.1.0.1, 10.2.0.2')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_expensive_requests_cost_more(self):
+        """Test if deep pages, large pages and filters take more tokens"""
+        factory = RequestFactory()
+        plain = request_cost(factory.get('/api/books/'))
+        self.assertEqual(plain, 1)
+        self.assertEqual(request_cost(factory.get('/api/books/', {'page_size': 100})), 4)
+        self.assertEqual(request_cost(factory.get('/api/books/', {'page': 8})), 4)
+        self.assertEqual(request_cost(factory.get('/api/books/', {'topic': 'child', 'language': 'en'})), 2)
+
+        response = self.client.get('/api/books/', {'page_size': 100, 'page': 4, 'topic': 'x'})
+        # 5.5 tokens, capped at the burst; the page itself does not exist
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/api/books/')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_django_views_limited(self):
+        """Test if the home page and downloads share the client's bucket"""
+        for _ in range(5):
+            self.client.get('/')
+        response = self.client.get('/download/1/1/')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+    def test_refill(self):
+        """Test if buckets refill over time"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = TokenBucketStore(os.path.join(directory.name, 'buckets.sqlite3'))
+        self.assertEqual(store.take('ip:1', 2, rate=1, capacity=2, now=100), 0)
+        self.assertEqual(store.take('ip:1', 1, rate=1, capacity=2, now=100), 1)
+        self.assertEqual(store.take('ip:1', 1, rate=1, capacity=2, now=101.5), 0)
+
+
+class FormatMapTests(APITestCase):
+    """Test resolving downloads from the in-process format map"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=0)
+        cls.other = Book.objects.create(gutenberg_id=84, title='Frankenstein', media_type='Text', download_count=0)
+        cls.epub = Format.objects.create(book=cls.book, mime_type='application/epub+zip',
+                                         url='https://www.gutenberg.org/ebooks/1342.epub.images')
+        cls.html = Format.objects.create(book=cls.book, mime_type='text/html',
+                                         url='https://www.gutenberg.org/ebooks/1342.html.images')
+
+    def setUp(self):
+        self.recorder = self.enterContext(mock.patch('books.views.recorder'))
+        with override_settings(LOOKUP_TABLES_CHECK_INTERVAL=0):
+            formatmap.get()  # pick up this class's formats
+
+    def test_redirect_without_queries(self):
+        """Test if a download is redirected without touching the database"""
+        with override_settings(LOOKUP_TABLES_CHECK_INTERVAL=60), self.assertNumQueries(0):
+            response = self.client.get(reverse('download_book', args=[self.book.id, self.html.id]))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response['Location'], self.html.url)
+        self.recorder.record.assert_called_once_with(self.book.id)
+
+    def test_mismatched_pair(self):
+        """Test if a format of another book, or an unknown one, is a 404 without queries up to the map's largest id"""
+        with override_settings(LOOKUP_TABLES_CHECK_INTERVAL=60), self.assertNumQueries(0):
+            response = self.client.get(reverse('download_book', args=[self.other.id, self.epub.id]))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get(reverse('download_book', args=[self.book.id, self.epub.id - 1]))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('download_book', args=[self.book.id, self.html.id + 1000]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.recorder.record.assert_not_called()
+
+    def test_new_format_resolved(self):
+        """Test if formats added after the map was built are found"""
+        with override_settings(LOOKUP_TABLES_CHECK_INTERVAL=60):
+            text = Format.objects.create(book=self.other, mime_type='text/plain', url='https://www.gutenberg.org/ebooks/84.txt.utf-8')
+            self.assertEqual(formatmap.lookup(self.other.id, text.id).url, text.url)
+
+    @override_settings(LOOKUP_TABLES_CHECK_INTERVAL=0)
+    def test_rebuilt_on_catalog_change(self):
+        """Test if the map is rebuilt when the catalog version changes"""
+        mirror = UrlTemplate.objects.create(template='https://mirror.example.org/{id}.epub')
+        Format.objects.filter(pk=self.epub.pk).update(url_template=mirror)
+        catalog.bump_version()
+        self.assertEqual(formatmap.lookup(self.book.id, self.epub.id).url, 'https://mirror.example.org/1342.epub')
+
+    def test_benchmark(self):
+        """Test if the benchmark reports both methods"""
+        report = StringIO()
+        call_command('benchmark_downloads', requests=10, stdout=report)
+        self.assertIn('format map', report.getvalue())
+        self.assertIn('database', report.getvalue())
+
+
+class CatalogVersionTests(APITransactionTestCase):
+    """Test the catalog stamps kept in the database and moved by the writing transaction"""
+
+    def setUp(self):
+        caches[settings.QUERY_CACHE].clear()  # the flush between tests resets the table generations
+        self.book = Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=0)
+        for extension in ('epub.images', 'html.images'):
+            Format.objects.create(book=self.book, mime_type='text/html',
+                                  url=f'https://www.gutenberg.org/ebooks/1342.{extension}')
+
+    def version_bumps(self, queries):
+        return [query for query in queries if query['sql'].startswith('INSERT') and catalog.VERSION in query['sql']]
+
+    def test_stamps_in_database(self):
+        """Test if the stamps are database rows, so bumps from other hosts are seen"""
+        version = catalog.get_version()
+        self.assertEqual(TableGeneration.objects.get(name=catalog.VERSION).generation, version)
+        TableGeneration.objects.filter(name=catalog.CHANGED).update(generation=F('generation') + 10 ** 12)
+        self.assertEqual(catalog.last_changed(), TableGeneration.objects.get(name=catalog.CHANGED).generation)
+        self.assertGreater(catalog.bump_version(), version)
+        self.assertGreater(catalog.get_version(), version)
+
+    def test_moved_with_transaction(self):
+        """Test if the version is moved by the writing transaction and rolled back with it"""
+        version = catalog.get_version()
+        with transaction.atomic():
+            # The bump of a rolled back savepoint is discarded with it
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Format.objects.create(book=self.book, mime_type='text/plain',
+                                      url='https://www.gutenberg.org/ebooks/1342.rtf')
+                raise RuntimeError
+            self.assertEqual(catalog.get_version(), version)
+            Format.objects.create(book=self.book, mime_type='text/plain',
+                                  url='https://www.gutenberg.org/ebooks/1342.txt')
+        self.assertGreater(catalog.get_version(), version)
+
+        version = catalog.get_version()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            Format.objects.create(book=self.book, mime_type='text/plain',
+                                  url='https://www.gutenberg.org/ebooks/1342.azw')
+            raise RuntimeError
+        self.assertEqual(catalog.get_version(), version)
+
+    def test_import_bumps_once(self):
+        """Test if importing files bumps the version once, at the end"""
+        source = self.enterContext(tempfile.TemporaryDirectory())
+        for name in ('1342.epub.images', '1342.html.images'):
+            with open(os.path.join(source, name), 'wb') as f:
+                f.write(b'It is a truth universally acknowledged')
+        with (override_settings(CONTENT_STORE_ROOT=self.enterContext(tempfile.TemporaryDirectory())),
+              CaptureQueriesContext(connection) as queries):
+            call_command('import_content', source, stdout=StringIO())
+        self.assertEqual(FormatContent.objects.filter(format__book=self.book).count(), 2)
+        self.assertEqual(len(self.version_bumps(queries)), 1)
+
+
+class FormatStorageTests(APITestCase):
+    """Test storing formats as MIME type and URL template references"""
+
+    URLS = [
+        'https://www.gutenberg.org/ebooks/11.html.images',
+        'https://www.gutenberg.org/ebooks/11.epub3.images',
+        'https://www.gutenberg.org/files/11/11-0.txt',
+        'https://www.gutenberg.org/cache/epub/11/pg11.cover.medium.jpg',
+        'https://www.gutenberg.org/ebooks/110.txt.utf-8',
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(gutenberg_id=11, title="Alice's Adventures in Wonderland", media_type='Text', download_count=0)
+        cls.other = Book.objects.create(gutenberg_id=1342, title='Pride and Prejudice', media_type='Text', download_count=0)
+        for url in cls.URLS:
+            Format.objects.create(book=cls.book, mime_type='text/html', url=url)
+        Format.objects.create(book=cls.other, mime_type='text/html', url='https://www.gutenberg.org/ebooks/1342.html.images')
+        Format.objects.create(book=cls.other, mime_type='text/plain', url='https://www.gutenberg.org/ebooks/1342.txt.utf-8')
+
+    def test_urls_round_trip(self):
+        """Test if URLs come back exactly as they were stored"""
+        self.assertCountEqual([f.url for f in Format.objects.filter(book=self.book)], self.URLS)
+
+    def test_templates_shared(self):
+        """Test if the same format of different books shares one template and MIME type"""
+        self.assertEqual(UrlTemplate.template_for(self.URLS[2], 11), 'https://www.gutenberg.org/files/{id}/{id}-0.txt')
+        self.assertEqual(UrlTemplate.template_for(self.URLS[4], 11), self.URLS[4])
+        html = Format.objects.filter(url_template__template='https://www.gutenberg.org/ebooks/{id}.html.images')
+        self.assertEqual(html.count(), 2)
+        self.assertEqual(MimeType.objects.count(), 2)
+
+    @override_settings(LOOKUP_TABLES_CHECK_INTERVAL=0)
+    def test_api_unchanged(self):
+        """Test if the API lists the same MIME types and URLs and still filters on them"""
+        response = self.client.get(reverse('book-detail', args=[self.book.id]))
+        self.assertCountEqual([f['url'] for f in response.data['formats']], self.URLS)
+        self.assertEqual({f['mime_type'] for f in response.data['formats']}, {'text/html'})
+        response = self.client.get(reverse('book-list'), {'mime_type': 'text/plain'})
+        self.assertEqual([book['id'] for book in response.data['results']], [self.other.id])
+
+    def test_template_anchored_to_path(self):
+        """Test if only path segments starting with the ID are templated"""
+        book = Book.objects.create(gutenberg_id=8, title='Abraham Lincoln', media_type='Text', download_count=0)
+        Format.objects.create(book=book, mime_type='text/plain', url='https://www.gutenberg.org/ebooks/8.txt.utf-8')
+        self.assertEqual(
+            UrlTemplate.template_for('https://www.gutenberg.org/ebooks/8.txt.utf-8', 8),
+            'https://www.gutenberg.org/ebooks/{id}.txt.utf-8',
+        )
+        self.assertEqual(Format.objects.filter(url_template__template='https://www.gutenberg.org/ebooks/{id}.txt.utf-8').count(), 2)
+        self.assertEqual(Format.objects.get(book=book).url, 'https://www.gutenberg.org/ebooks/8.txt.utf-8')
+        self.assertEqual(UrlTemplate.template_for('https://8.example.org/8/x8/pg8.jpg', 8), 'https://8.example.org/{id}/x8/pg{id}.jpg')
+
+    def test_unsaved_format_writes_nothing(self):
+        """Test if MIME types and templates are only created when the format is saved"""
+        book_format = Format(book=self.book, mime_type='application/pdf', url='https://www.gutenberg.org/ebooks/11.pdf')
+        self.assertEqual(book_format.mime_type, 'application/pdf')
+        self.assertFalse(MimeType.objects.filter(name='application/pdf').exists())
+        self.assertFalse(UrlTemplate.objects.filter(template__endswith='.pdf').exists())
+        book_format.save()
+        self.assertEqual(Format.objects.get(pk=book_format.pk).mime.name, 'application/pdf')
+        self.assertEqual(book_format.url_template.template, 'https://www.gutenberg.org/ebooks/{id}.pdf')
+
+    def test_report(self):
+        """Test if the storage report measures both layouts and the prefetch"""
+        report = StringIO()
+        call_command('format_storage_report', books=2, repeat=1, stdout=report)
+        self.assertIn('books_url_template', report.getvalue())
+        self.assertIn('format_inline_layout', report.getvalue())
+        self.assertRegex(report.getvalue(), r'Previous layout: [\d,]+ bytes')
+        self.assertRegex(report.getvalue(), r'Fetching 7 formats of 2 books: [\d.]+ ms before, [\d.]+ ms after')
+        self.assertIn('Prefetching 7 formats of 2 books', report.getvalue())
+
+
+class BookArraysTests(APITestCase):
+    """Test the language and bookshelf id arrays denormalized on Book"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.english = Language.objects.create(code='en')
+        cls.french = Language.objects.create(code='fr')
+        cls.scifi = Bookshelf.objects.create(name='Science Fiction')
+        cls.book = Book.objects.create(gutenberg_id=35, title='The Time Machine', media_type='Text', download_count=2)
+        cls.other = Book.objects.create(gutenberg_id=17489, title='Les Misérables', media_type='Text', download_count=1)
+        cls.book.languages.add(cls.english)
+        cls.book.bookshelves.add(cls.scifi)
+        BookLanguage.objects.create(book=cls.other, language=cls.french)
+
+    def test_kept_in_sync(self):
+        """Test if through-table writes from either side update the arrays"""
+        self.book.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.book.language_ids, [self.english.id])
+        self.assertEqual(self.book.bookshelf_ids, [self.scifi.id])
+        self.assertEqual(self.other.language_ids, [self.french.id])
+
+        self.french.books.add(self.book)
+        self.scifi.books.clear()
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.language_ids, [self.english.id, self.french.id])
+        self.assertEqual(self.book.bookshelf_ids, [])
+        BookLanguage.objects.filter(book=self.other).delete()
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.language_ids, [])
+
+    def test_filters_use_arrays(self):
+        """Test if language and bookshelf filters match without joining the through tables"""
+        with CaptureQueriesContext(connection) as queries:
+            by_language = self.client.get('/api/books/', {'language': 'fr,de'})
+            by_shelf = self.client.get('/api/books/', {'topic': 'fiction'})
+        self.assertEqual([book['id'] for book in by_language.data['results']], [self.other.id])
+        self.assertEqual([book['id'] for book in by_shelf.data['results']], [self.book.id])
+        for query in queries:
+            self.assertNotIn('"books_book_languages"', query['sql'])
+            self.assertNotIn('"books_book_bookshelves"', query['sql'])
+
+    def test_check_command(self):
+        """Test if the check command reports and fixes books changed behind the ORM's back"""
+        BookLanguage.objects.bulk_create([BookLanguage(book=self.other, language=self.english)])
+        with self.assertRaisesMessage(CommandError, '1 books are out of sync'):
+            call_command('check_book_arrays', stdout=StringIO())
+        call_command('check_book_arrays', fix=True, stdout=StringIO())
+        self.assertEqual(denormalized.mismatches(), [])
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.language_ids, [self.english.id, self.french.id])
+
+
+class RangeFilterTests(APITestCase):
+    """Test the download count and author year range filters"""
+
+    @classmethod
+    def setUpTestData(cls):
+        english = Language.objects.create(code='en')
+        dickens = Author.objects.create(name='Dickens, Charles', birth_year=1812, death_year=1870)
+        austen = Author.objects.create(name='Austen, Jane', birth_year=1775, death_year=1817)
+        homer = Author.objects.create(name='Homer')
+        cls.twist = Book.objects.create(gutenberg_id=730, title='Oliver Twist', media_type='Text', download_count=5000)
+        cls.persuasion = Book.objects.create(gutenberg_id=105, title='Persuasion', media_type='Text', download_count=800)
+        cls.odyssey = Book.objects.create(gutenberg_id=1727, title='The Odyssey', media_type='Text', download_count=3000)
+        cls.twist.authors.add(dickens)
+        cls.persuasion.authors.add(austen)
+        cls.odyssey.authors.add(homer)
+        # Two authors alive in 1815 must not duplicate the book
+        cls.collection = Book.objects.create(gutenberg_id=99999, title='Collected Letters', media_type='Text', download_count=1500)
+        cls.collection.authors.add(dickens, austen)
+        for book in (cls.twist, cls.persuasion, cls.odyssey, cls.collection):
+            book.languages.add(english)
+
+    def ids(self, **params):
+        response = self.client.get('/api/books/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book['id'] for book in response.data['results']]
+
+    def plan(self, queryset, analyze=()):
+        """EXPLAIN a queryset with sequential scans discouraged, after analyzing the given tables."""
+        with connection.cursor() as cursor:
+            for table in analyze:
+                cursor.execute(f'ANALYZE {table}')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def filtered(self, **params):
+        return BookFilter(RequestFactory().get('/api/books/', params).GET, queryset=Book.objects.all()).qs
+
+    def test_download_count_range(self):
+        """Test if download counts are filtered by the given bounds"""
+        self.assertEqual(self.ids(download_count_min=1000), [self.twist.id, self.odyssey.id, self.collection.id])
+        self.assertEqual(self.ids(download_count_min=1000, download_count_max=4000), [self.odyssey.id, self.collection.id])
+        response = self.client.get('/api/books/', {'download_count_min': 'many'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_author_years(self):
+        """Test if author years are matched on one author and unknown years never match"""
+        self.assertEqual(self.ids(author_alive_in=1790), [self.collection.id, self.persuasion.id])
+        self.assertEqual(self.ids(author_alive_in=1850), [self.twist.id, self.collection.id])
+        self.assertEqual(self.ids(author_birth_year_max=1800, author_death_year_min=1850), [])
+        self.assertEqual(self.ids(author_death_year_max=1820), [self.collection.id, self.persuasion.id])
+        self.assertEqual(self.ids(author_birth_year_min=-1000, language='en', download_count_min=2000), [self.twist.id])
+
+    def test_query_plans_use_indexes(self):
+        """Test if the range filters can use their indexes and compose without DISTINCT"""
+        self.assertIn('books_book_downloads_idx', self.plan(self.filtered(download_count_min=1000)))
+        # The partial indexes' conditions are implied by the year comparisons
+        alive = Author.objects.filter(birth_year__lte=1850, death_year__gte=1850)
+        self.assertIn('books_author_lifespan_idx', self.plan(alive))
+        self.assertIn('books_author_death_idx', self.plan(Author.objects.filter(death_year__lte=1820)))
+
+        queryset = self.filtered(download_count_min=1000, author_alive_in=1850, author_death_year_max=1900, language='en')
+        sql = str(queryset.query)
+        self.assertEqual(sql.count('EXISTS'), 1)  # all author conditions in one subquery
+        self.assertNotIn('DISTINCT', sql)
+        # With a catalog-like distribution (many rarely downloaded books by
+        # the same authors) the download count is the selective condition
+        dickens = Author.objects.get(name='Dickens, Charles')
+        books = Book.objects.bulk_create(
+            Book(gutenberg_id=100000 + i, title=f'Pamphlet {i}', media_type='Text', download_count=i % 100)
+            for i in range(2000)
+        )
+        BookAuthor.objects.bulk_create(BookAuthor(book=book, author=dickens) for book in books)
+        plan = self.plan(queryset, analyze=['books_book', 'books_book_authors', 'books_author'])
+        self.assertIn('books_book_downloads_idx', plan)
+
+
+class ConditionalGetTests(APITestCase):
+    """Test answering conditional GETs from the catalog change stamp"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(gutenberg_id=1661, title='The Adventures of Sherlock Holmes', media_type='Text', download_count=10)
+
+    def test_not_modified_without_queries(self):
+        """Test if unchanged list, detail and home pages are answered with 304 from the change stamp alone"""
+        for url in ('/api/books/', f'/api/books/{self.book.id}/', '/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.has_header('Last-Modified'))
+            with self.assertNumQueries(2):  # the table generations, once per request
+                by_etag = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+                by_date = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(by_etag.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(by_date.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_writes_change_etag(self):
+        """Test if catalog writes and flushed downloads invalidate earlier ETags"""
+        etag = self.client.get('/api/books/')['ETag']
+        self.book.title = 'The Adventures of Sherlock Holmes (Illustrated)'
+        self.book.save()
+        response = self.client.get('/api/books/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        etag = response['ETag']
+        self.book.authors.add(Author.objects.create(name='Doyle, Arthur Conan'))
+        self.assertNotEqual(self.client.get('/api/books/')['ETag'], etag)
+
+        etag = self.client.get('/api/books/')['ETag']
+        downloads = DownloadRecorder(flush_size=100, flush_interval=3600)
+        downloads.record(self.book.id)
+        downloads.flush()
+        self.assertNotEqual(self.client.get('/api/books/')['ETag'], etag)
+
+    def test_schema_not_modified(self):
+        """Test if the schema views are revalidated against the schema fingerprint"""
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        self.enterContext(override_settings(STATIC_ROOT=static_root.name))
+        schema._artifacts.clear()
+        self.addCleanup(schema._artifacts.clear)
+        for url in ('/swagger/?format=openapi', '/redoc/'):
+            etag = self.client.get(url)['ETag']
+            self.assertTrue(etag.startswith('W/"schema-'))
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class ChangeFeedTests(APITestCase):
+    """Test the change log and the /api/changes/ feed"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.english = Language.objects.create(code='en')
+
+    def feed(self, **params):
+        response = self.client.get(reverse('change-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_writes_logged(self):
+        """Test if book, relation and dimension writes are logged after commit, in order"""
+        with self.captureOnCommitCallbacks(execute=True):
+            emma = Book.objects.create(gutenberg_id=158, title='Emma', media_type='Text', download_count=0)
+            ulysses = Book.objects.create(gutenberg_id=4300, title='Ulysses', media_type='Text', download_count=0)
+        self.assertEqual(
+            [(entry['book_id'], entry['action']) for entry in self.feed()['results']],
+            [(emma.id, 'upsert'), (ulysses.id, 'upsert')],
+        )
+        since = self.feed()['since']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.english.books.add(emma)
+        ulysses_id = ulysses.id
+        with self.captureOnCommitCallbacks(execute=True):
+            ulysses.delete()
+        self.assertEqual(
+            [(entry['book_id'], entry['action']) for entry in self.feed(since=since)['results']],
+            [(emma.id, 'upsert'), (ulysses_id, 'delete')],
+        )
+        since = self.feed()['since']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.english.code = 'eng'
+            self.english.save()
+        self.assertEqual([entry['book_id'] for entry in self.feed(since=since)['results']], [emma.id])
+
+    def test_pages(self):
+        """Test if pages resume after since and keep each book's latest entry"""
+        BookChange.objects.bulk_create([BookChange(book_id=book_id, action=BookChange.UPSERT) for book_id in (1, 2, 1, 3, 4)])
+        first = self.feed(page_size=3)
+        self.assertEqual([entry['book_id'] for entry in first['results']], [2, 1])
+        self.assertIsNotNone(first['next'])
+        second = self.feed(since=first['since'], page_size=3)
+        self.assertEqual([entry['book_id'] for entry in second['results']], [3, 4])
+        self.assertIsNone(second['next'])
+        self.assertEqual(self.feed(since=second['since'])['results'], [])
+        response = self.client.get(reverse('change-list'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_not_modified(self):
+        """Test if a caught-up mirror is answered with 304 until the next change"""
+        etag = self.client.get(reverse('change-list'))['ETag']
+        response = self.client.get(reverse('change-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        with self.captureOnCommitCallbacks(execute=True):
+            changes.record([1])
+        response = self.client.get(reverse('change-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_staged_until_published(self):
+        """Test if entries are staged by the transaction and kept when publishing fails"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            changes.record([1, 2])
+        self.assertEqual(PendingBookChange.objects.count(), 2)
+        with mock.patch('books.changes.catalog.touch', side_effect=AssertionError), \
+                mock.patch('books.changes.PUBLISH_SQL', 'SELECT * FROM missing_table'), \
+                self.assertLogs('books.changes', 'ERROR'):
+            callbacks[-1]()
+        self.assertFalse(BookChange.objects.exists())
+
+        call_command('compact_changes', stdout=StringIO())
+        self.assertEqual([entry['book_id'] for entry in self.feed()['results']], [1, 2])
+        self.assertFalse(PendingBookChange.objects.exists())
+
+    def test_downloads_logged_at_rollup(self):
+        """Test if download flushes are not logged, and the rollup logs the downloaded books"""
+        book = Book.objects.create(gutenberg_id=158, title='Emma', media_type='Text', download_count=0)
+        PendingBookChange.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            downloads = DownloadRecorder(flush_size=100, flush_interval=3600)
+            downloads.record(book.id)
+            downloads.flush()
+        self.assertFalse(BookChange.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rollup_downloads', stdout=StringIO())
+        self.assertEqual([entry['book_id'] for entry in self.feed()['results']], [book.id])
+
+    def test_compact(self):
+        """Test if compaction keeps only the latest entry of each book"""
+        BookChange.objects.bulk_create([
+            BookChange(book_id=book_id, action=action)
+            for book_id, action in ((1, BookChange.UPSERT), (2, BookChange.UPSERT), (1, BookChange.DELETE))
+        ])
+        call_command('compact_changes', stdout=StringIO())
+        self.assertEqual(
+            list(BookChange.objects.order_by('seq').values_list('book_id', 'action')),
+            [(2, BookChange.UPSERT), (1, BookChange.DELETE)],
+        )
+
+
+class SnapshotTests(APITestCase):
+    """Test exporting the catalog to SQLite and serving from the snapshot"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(gutenberg_id=2701, title='Moby Dick', media_type='Text', download_count=5)
+        cls.book.authors.add(Author.objects.create(name='Melville, Herman', birth_year=1819, death_year=1891))
+        cls.book.languages.add(Language.objects.create(code='en'))
+        cls.book.bookshelves.add(Bookshelf.objects.create(name='Best Books Ever Listings'))
+        cls.book.subjects.add(Subject.objects.create(name='Whaling -- Fiction'))
+        cls.other = Book.objects.create(gutenberg_id=17489, title='Les Misérables', media_type='Text', download_count=1)
+        cls.other.languages.add(Language.objects.create(code='fr'))
+        Format.objects.create(book=cls.book, mime_type='text/plain; charset=us-ascii',
+                              url='https://www.gutenberg.org/files/2701/2701-0.txt')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'catalog.sqlite3')
+        self.enterContext(override_settings(
+            TEXT_INDEX_ROOT=os.path.join(directory.name, 'index'), LOOKUP_TABLES_CHECK_INTERVAL=0,
+        ))
+        self.addCleanup(self.reset_tables)
+
+    def reset_tables(self):
+        lookups._tables = None
+        formatmap._map = None
+
+    def serve(self):
+        """Serve the catalog from the snapshot, as on an edge read node."""
+        connections.settings[snapshot.ALIAS] = connections.configure_settings({
+            'default': connections.settings['default'],
+            snapshot.ALIAS: {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': f'file:{self.path}?mode=ro&immutable=1',
+                'OPTIONS': {'init_command': 'PRAGMA mmap_size=1048576; PRAGMA query_only=1'},
+                'CONN_MAX_AGE': None,
+            },
+        })[snapshot.ALIAS]
+        self.addCleanup(connections.settings.pop, snapshot.ALIAS)
+        self.addCleanup(connections.__delitem__, snapshot.ALIAS)
+        self.addCleanup(lambda: connections[snapshot.ALIAS].close())
+        # The alias did not exist when the test databases were set up
+        self.enterContext(mock.patch.object(type(self), 'databases', {'default', snapshot.ALIAS}))
+        self.enterContext(override_settings(SNAPSHOT_PATH=self.path))
+        self.reset_tables()
+
+    def test_export(self):
+        """Test if the snapshot holds the catalog, its indexes and the change stamp"""
+        call_command('export_snapshot', self.path, stdout=StringIO())
+        self.assertFalse(os.stat(self.path).st_mode & 0o222)
+        with sqlite3.connect(f'file:{self.path}?mode=ro', uri=True) as db:
+            self.assertEqual(db.execute('SELECT title FROM books_book ORDER BY id').fetchall(),
+                             [('Moby Dick',), ('Les Misérables',)])
+            tables = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            indexes = {name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            version, = db.execute("SELECT value FROM snapshot_meta WHERE key = 'version'").fetchone()
+        self.assertIn('books_format', tables)
+        self.assertNotIn('books_book_change', tables)
+        self.assertIn('books_book_downloads_idx', indexes)
+        self.assertNotIn('books_book_language_ids_gin', indexes)
+        self.assertEqual(int(version), catalog.last_changed())
+
+    def test_serves_from_snapshot(self):
+        """Test if the API and home page read the snapshot, not the database"""
+        call_command('export_snapshot', self.path, stdout=StringIO())
+        Book.objects.filter(pk=self.book.pk).update(title='Moby-Dick; or, The Whale')
+        self.serve()
+        with self.assertNumQueries(0):
+            listing = self.client.get('/api/books/', {'language': 'en', 'topic': 'best books'})
+            detail = self.client.get(f'/api/books/{self.book.id}/')
+            home = self.client.get('/', {'language': 'fr'})
+        self.assertEqual([book['title'] for book in listing.data['results']], ['Moby Dick'])
+        self.assertEqual(listing.data['results'][0]['languages'], [{'code': 'en'}])
+        self.assertEqual(detail.data['formats'][0]['url'], 'https://www.gutenberg.org/files/2701/2701-0.txt')
+        self.assertContains(home, 'Les Misérables')
+        self.assertNotContains(home, 'Moby Dick')
+        self.assertEqual(listing['ETag'], f'"catalog-{snapshot.version()}"')
+
+    def test_edge_without_default_database(self):
+        """Test if an edge read node serves the catalog and downloads without touching the default database"""
+        call_command('export_snapshot', self.path, stdout=StringIO())
+        download = reverse('download_book', args=[self.book.id, self.book.formats.get().id])
+        self.serve()
+        default = connections[DEFAULT_DB_ALIAS]
+        for method in ('connect', 'cursor', 'chunked_cursor'):
+            self.enterContext(mock.patch.object(
+                default, method, side_effect=AssertionError('the default database was used'),
+            ))
+        pending = dict(downloads.recorder._pending)
+        self.assertEqual(self.client.get('/api/books/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(f'/api/books/{self.book.id}/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(download).status_code, status.HTTP_302_FOUND)
+        self.assertEqual(dict(downloads.recorder._pending), pending)
+        self.assertEqual(self.client.get(reverse('change-list')).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_swap(self):
+        """Test if a snapshot renamed over the served one is picked up on the next request"""
+        call_command('export_snapshot', self.path, stdout=StringIO())
+        self.serve()
+        etag = self.client.get('/api/books/')['ETag']
+        with override_settings(SNAPSHOT_PATH=''):
+            Book.objects.filter(pk=self.book.pk).update(title='Moby-Dick; or, The Whale')
+            catalog.touch()
+            call_command('export_snapshot', self.path, stdout=StringIO())
+        response = self.client.get('/api/books/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['title'], 'Moby-Dick; or, The Whale')
+
+    def test_search_index_shipped(self):
+        """Test if edge nodes search with the text index stored in the snapshot"""
+        store = tempfile.TemporaryDirectory()
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        with open(os.path.join(source.name, '2701-0.txt'), 'w') as f:
+            f.write('Call me Ishmael. Some years ago, never mind how long precisely.')
+        with override_settings(CONTENT_STORE_ROOT=store.name):
+            call_command('import_content', source.name, stdout=StringIO())
+            call_command('build_text_index', workers=1, stdout=StringIO())
+            call_command('export_snapshot', self.path, stdout=StringIO())
+        store.cleanup()  # texts are not mirrored on edge nodes
+        self.serve()
+        response = self.client.get('/api/books/search/', {'q': 'ishmael'})
+        self.assertEqual([(r['gutenberg_id'], r['snippet']) for r in response.data['results']], [(2701, '')])
+
+
+class RandomBooksTests(APITestCase):
+    """Test uniform random sampling of books"""
+
+    @classmethod
+    def setUpTestData(cls):
+        french = Language.objects.create(code='fr')
+        Book.objects.bulk_create([
+            Book(gutenberg_id=100000 + i, title=f'Synthetic {i}', media_type='Text', download_count=i)
+            for i in range(20000)
+        ])
+        cls.french = Book.objects.create(gutenberg_id=17489, title='Les Misérables', media_type='Text', download_count=1)
+        cls.french.languages.add(french)
+
+    def setUp(self):
+        sampling._book_ids = None
+        self.addCleanup(setattr, sampling, '_book_ids', None)
+
+    def test_endpoint(self):
+        """Test if the endpoint returns distinct books, honours filters and is never cached"""
+        response = self.client.get(reverse('book-random-list'), {'count': 25})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len({book['id'] for book in response.data['results']}), 25)
+        self.assertIn('no-store', response['Cache-Control'])
+        self.assertFalse(response.has_header('ETag'))
+
+        response = self.client.get(reverse('book-random-list'), {'count': 5, 'language': 'fr'})
+        self.assertEqual([book['title'] for book in response.data['results']], ['Les Misérables'])
+        for count in ('0', '101', 'many'):
+            response = self.client.get(reverse('book-random-list'), {'count': count})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def deciles(self, picks, queryset):
+        """Chi-squared statistic of picks counted per tenth of the queryset's ids."""
+        ids = sorted(queryset.values_list('pk', flat=True))
+        bounds = [ids[len(ids) * i // 10] for i in range(1, 10)]
+        spread = [0] * 10
+        for pk in picks:
+            spread[sum(pk >= bound for bound in bounds)] += 1
+        expected = len(picks) / 10
+        return sum((observed - expected) ** 2 / expected for observed in spread)
+
+    def test_uniform(self):
+        """Test if matching books are picked equally often (chi-squared tests, 9 degrees of freedom)"""
+        critical = 27.88  # p = 0.001
+        half = Book.objects.filter(download_count__lt=10000)
+        rare = Book.objects.filter(gutenberg_id__lt=100010)
+        counts = dict.fromkeys(rare.values_list('pk', flat=True), 0)
+        with mock.patch('books.sampling.random', random.Random(48)):
+            unfiltered = [pk for _ in range(400) for pk in sampling.sample(Book.objects.all(), 5)]
+            filtered = [pk for _ in range(400) for pk in sampling.sample(half, 5)]
+            for _ in range(400):
+                for pk in sampling.sample(rare, 5):
+                    counts[pk] += 1
+        self.assertLess(self.deciles(unfiltered, Book.objects.all()), critical)
+        self.assertLess(self.deciles(filtered, half), critical)
+        self.assertTrue(set(filtered) <= set(half.values_list('pk', flat=True)))
+        self.assertLess(sum((observed - 200) ** 2 / 200 for observed in counts.values()), critical)
+
+    @override_settings(LOOKUP_TABLES_CHECK_INTERVAL=0)
+    def test_rebuilt_on_insert_or_delete(self):
+        """Test if the id array is rebuilt when books are added or deleted, not on other changes"""
+        ids = sampling.get()
+        Book.objects.filter(pk=self.french.pk).update(download_count=F('download_count') + 1)
+        catalog.touch()  # e.g. a download flush
+        self.assertIs(sampling.get(), ids)
+        added = Book.objects.create(gutenberg_id=135, title='Les Misérables, Volume 2', media_type='Text')
+        self.assertEqual(sampling.get().ids[-1], added.pk)
+        added.delete()
+        self.assertNotIn(added.pk, sampling.get().ids)
+
+    def test_no_table_sort(self):
+        """Test if a sample is a few primary-key lookups, not a sort of the table"""
+        sampling.get()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(20):
+                self.assertEqual(len(sampling.sample(Book.objects.all(), 10)), 10)
+            seconds = (time.perf_counter() - start) / 20
+        self.assertEqual(len(queries), 20)
+        for query in queries:
+            self.assertNotIn('RANDOM()', query['sql'].upper())
+        self.assertLess(seconds, 0.05)
+
+
+@override_settings(FEEDS_CHUNK_SIZE=10, FEEDS_BASE_URL='https://books.example.org')
+class FeedTests(APITestCase):
+    """Test the sitemap and OPDS feed files"""
+
+    ATOM = '{http://www.w3.org/2005/Atom}'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.emma = Book.objects.create(id=1000001, gutenberg_id=158, title='Emma', media_type='Text', download_count=0)
+        cls.emma.authors.add(Author.objects.create(name='Austen, Jane'))
+        cls.emma.languages.add(Language.objects.create(code='en'))
+        cls.emma.subjects.add(Subject.objects.create(name='Courtship -- Fiction'))
+        cls.emma_text = Format.objects.create(book=cls.emma, mime_type='text/plain; charset=us-ascii',
+                                              url='https://www.gutenberg.org/files/158/158-0.txt')
+        cls.persuasion = Book.objects.create(id=1000002, gutenberg_id=105, title='Persuasion', media_type='Text', download_count=0)
+        cls.ulysses = Book.objects.create(id=1000011, gutenberg_id=4300, title='Ulysses & Co', media_type='Text', download_count=0)
+        # The fixtures never commit, so their entries would be published with the first change of a test
+        PendingBookChange.objects.all().delete()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.enterContext(override_settings(FEEDS_ROOT=self.root, LOOKUP_TABLES_CHECK_INTERVAL=0))
+
+    def parse(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            content = f.read()
+        with gzip.open(os.path.join(self.root, name + '.gz')) as f:
+            self.assertEqual(f.read(), content)
+        return ElementTree.fromstring(content)
+
+    def test_build(self):
+        """Test if the sitemaps and OPDS feeds list every book in chunks"""
+        call_command('build_feeds', stdout=StringIO())
+        index = self.parse('sitemap.xml')
+        self.assertEqual(
+            [loc.text for loc in index.iter('{http://www.sitemaps.org/schemas/sitemap/0.9}loc')],
+            ['https://books.example.org/feeds/sitemaps/100000.xml', 'https://books.example.org/feeds/sitemaps/100001.xml'],
+        )
+        sitemap = self.parse('sitemaps/100000.xml')
+        self.assertEqual(
+            [loc.text for loc in sitemap.iter('{http://www.sitemaps.org/schemas/sitemap/0.9}loc')],
+            ['https://books.example.org/?book_ids=158', 'https://books.example.org/?book_ids=105'],
+        )
+
+        feed = self.parse('opds/100000.xml')
+        emma = feed.find(f'{self.ATOM}entry')
+        self.assertEqual(emma.find(f'{self.ATOM}title').text, 'Emma')
+        self.assertEqual(emma.find(f'{self.ATOM}author/{self.ATOM}name').text, 'Austen, Jane')
+        self.assertEqual(emma.find('{http://purl.org/dc/terms/}language').text, 'en')
+        self.assertEqual(emma.find(f'{self.ATOM}category').get('term'), 'Courtship -- Fiction')
+        acquisition = emma.find(f'{self.ATOM}link[@rel="http://opds-spec.org/acquisition"]')
+        self.assertEqual(acquisition.get('type'), 'text/plain; charset=us-ascii')
+        self.assertEqual(acquisition.get('href'), f'https://books.example.org/download/{self.emma.id}/{self.emma_text.id}/')
+        self.assertEqual(self.parse('opds/100001.xml').find(f'{self.ATOM}entry/{self.ATOM}title').text, 'Ulysses & Co')
+        self.assertEqual(len(self.parse('opds.xml').findall(f'{self.ATOM}entry')), 2)
+
+    def test_incremental(self):
+        """Test if only the chunks of logged changes are rewritten"""
+        feeds.build()
+        untouched = os.stat(os.path.join(self.root, 'opds/100001.xml')).st_ino
+        with self.captureOnCommitCallbacks(execute=True):
+            self.persuasion.title = 'Persuasion (Illustrated)'
+            self.persuasion.save()
+        self.assertEqual(feeds.build()['chunks'], 1)
+        self.assertEqual(os.stat(os.path.join(self.root, 'opds/100001.xml')).st_ino, untouched)
+        titles = [title.text for title in self.parse('opds/100000.xml').iter(f'{self.ATOM}title')]
+        self.assertIn('Persuasion (Illustrated)', titles)
+        self.assertEqual(feeds.build()['chunks'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ulysses.delete()
+        feeds.build()
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'opds/100001.xml')))
+        self.assertEqual(len(self.parse('opds.xml').findall(f'{self.ATOM}entry')), 1)
+
+    def test_served(self):
+        """Test if the files are served precompressed, and rewritten files right away"""
+        feeds.build()
+        response = self.client.get('/feeds/sitemap.xml', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'sitemaps/100001.xml', gzip.decompress(b''.join(response.streaming_content)))
+        response = self.client.get('/feeds/opds/100000.xml')
+        self.assertEqual(response['Content-Type'], feeds.OPDS_ACQUISITION)
+
+        Book.objects.filter(pk=self.emma.pk).update(title='Emma (Annotated)')
+        with self.captureOnCommitCallbacks(execute=True):
+            changes.record([self.emma.pk])
+        feeds.build()
+        response = self.client.get('/feeds/opds/100000.xml')
+        self.assertIn(b'Emma (Annotated)', b''.join(response.streaming_content))
+        self.assertEqual(self.client.get('/feeds/missing.xml').status_code, status.HTTP_404_NOT_FOUND)
+
+
+class QueryCacheTests(APITransactionTestCase):
+    """Test the query result cache and its invalidation on writes"""
+
+    def setUp(self):
+        self.emma = Book.objects.create(gutenberg_id=158, title='Emma', media_type='Text', download_count=2)
+        self.austen = Author.objects.create(name='Austen, Jane')
+        self.emma.authors.add(self.austen)
+        Format.objects.create(book=self.emma, mime_type='text/plain', url='https://example.org/158.txt')
+        caches[settings.QUERY_CACHE].clear()
+
+    def titles(self):
+        return list(Book.objects.order_by('pk').values_list('title', flat=True))
+
+    def hits(self):
+        return REGISTRY.get_sample_value('cache_requests_total', {'cache': 'queries', 'result': 'hit'}) or 0
+
+    def test_repeated_queries(self):
+        """Test if repeated querysets, counts and prefetches only read the table generations"""
+        hits = self.hits()
+        books = list(Book.objects.prefetch_related('authors', 'formats'))
+        self.assertEqual(Book.objects.count(), 1)
+        with self.assertNumQueries(4):
+            cached = list(Book.objects.prefetch_related('authors', 'formats'))
+            self.assertEqual(Book.objects.count(), 1)
+        self.assertEqual(cached, books)
+        self.assertIsNot(cached[0], books[0])
+        self.assertEqual([author.name for author in cached[0].authors.all()], ['Austen, Jane'])
+        self.assertEqual(len(cached[0].formats.all()), 1)
+        self.assertEqual(self.hits() - hits, 4)
+
+        self.client.get('/api/books/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/books/')
+        self.assertEqual(response.data['results'][0]['title'], 'Emma')
+        self.assertFalse([query for query in queries if 'books_book' in query['sql']])
+
+    def test_writes_invalidate(self):
+        """Test if saves, updates, bulk writes, raw SQL and m2m changes drop cached results"""
+        self.assertEqual(self.titles(), ['Emma'])
+        self.emma.title = 'Emma (Illustrated)'
+        self.emma.save()
+        self.assertEqual(self.titles(), ['Emma (Illustrated)'])
+
+        Book.objects.update(title='Emma (Annotated)')
+        self.assertEqual(self.titles(), ['Emma (Annotated)'])
+        Book.objects.bulk_create([Book(gutenberg_id=161, title='Sense and Sensibility', media_type='Text')])
+        self.assertEqual(self.titles(), ['Emma (Annotated)', 'Sense and Sensibility'])
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE books_book SET title = 'Emma' WHERE id = %s", [self.emma.pk])
+        self.assertEqual(self.titles(), ['Emma', 'Sense and Sensibility'])
+
+        self.assertEqual(list(Author.objects.filter(books=self.emma)), [self.austen])
+        self.emma.authors.clear()
+        self.assertEqual(list(Author.objects.filter(books=self.emma)), [])
+
+    def test_transactions(self):
+        """Test if transactions bypass the cache and invalidate it on commit only"""
+        self.assertEqual(self.titles(), ['Emma'])
+        with transaction.atomic():
+            Book.objects.update(title='Emma (Illustrated)')
+            self.assertEqual(self.titles(), ['Emma (Illustrated)'])
+            with self.assertNumQueries(1):
+                self.titles()
+            transaction.set_rollback(True)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.titles(), ['Emma'])
+
+        with transaction.atomic():
+            Book.objects.update(title='Emma (Illustrated)')
+        self.assertEqual(self.titles(), ['Emma (Illustrated)'])
+
+    def test_switches(self):
+        """Test if uncached views and QUERY_CACHE_ENABLED bypass the cache"""
+        uncached_titles = querycache.uncached(self.titles)
+        self.titles()
+        with self.assertNumQueries(2):
+            uncached_titles()
+            uncached_titles()
+        with self.assertNumQueries(1):
+            self.titles()
+        with override_settings(QUERY_CACHE_ENABLED=False), self.assertNumQueries(1):
+            self.titles()
+
+        self.client.get(reverse('book-random-list'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('book-random-list'))
+        self.assertTrue([query for query in queries if 'books_book' in query['sql']])
+
+    def test_large_results_not_cached(self):
+        """Test if results over QUERY_CACHE_MAX_ROWS rows are not stored"""
+        with override_settings(QUERY_CACHE_MAX_ROWS=0):
+            self.titles()
+            with self.assertNumQueries(2):
+                self.titles()
+
+    def test_generations(self):
+        """Test if generations are shared through the database and read once per request"""
+        self.titles()
+        with self.assertNumQueries(1):
+            self.titles()
+        # Written by another instance
+        TableGeneration.objects.filter(name='books_book').update(generation=F('generation') + 1)
+        with self.assertNumQueries(2):
+            self.titles()
+
+        querycache.start_request()
+        self.addCleanup(querycache.finish_request)
+        with self.assertNumQueries(2):
+            self.titles()
+            self.assertEqual(Author.objects.count(), 1)
+        self.emma.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.titles(), ['Emma'])
+
+    def test_replica_reads(self):
+        """Test if reads from replicas are only cached with a replica timeout"""
+        self.titles()
+        with override_settings(DATABASE_REPLICAS=[DEFAULT_DB_ALIAS]):
+            with self.assertNumQueries(2):
+                self.titles()
+                self.titles()
+            with override_settings(QUERY_CACHE_REPLICA_TIMEOUT=60), self.assertNumQueries(1):
+                self.titles()
@@ -0,0 +1,492 @@
+"""
+Full-text index over the locally mirrored book texts.
+
+An index is a directory below TEXT_INDEX_ROOT; the ``current`` symlink
+points at the live one and is swapped atomically after a rebuild:
+
+    docs.json        [[book_id, sha256, first checkpoint, checkpoint count], ...]
+    terms.bin        the UTF-8 terms in byte order, concatenated
+    lexicon.bin      uint64 end offset in terms.bin, postings offset,
+                     postings length and document frequency of every term,
+                     in the same order
+    postings.bin     per term and document: varint document delta, varint
+                     occurrence count, varint byte length of the positions,
+                     then the varint position deltas
+    checkpoints.bin  uint32 byte offset of every CHECKPOINT_EVERY-th token
+
+Positions are token numbers, so phrases match on adjacent positions. The
+checkpoints let a snippet be cut from the stored file without tokenizing
+it from the start. Readers memory-map every file but docs.json and find
+terms by binary search, so workers share the term dictionary through the
+page cache instead of each loading it.
+
+The build keeps at most TEXT_INDEX_RUN_BYTES of postings in memory: full
+buffers are written to disk as runs sorted by term, which are merged into
+postings.bin at the end.
+"""
+
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+from array import array
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .content import object_path
+
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+CHECKPOINT_EVERY = 256
+SNIPPET_CONTEXT = 80  # characters on each side of the match
+
+Match = namedtuple('Match', ['book_id', 'score', 'doc', 'position'])
+
+
+def tokenize(text):
+    """Split text into lowercase word tokens."""
+    return [match.group().lower() for match in TOKEN_RE.finditer(text)]
+
+
+def encode_varint(value, out):
+    """Append ``value`` to the bytearray ``out`` as a LEB128 varint."""
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, offset):
+    """
+    Read one varint from ``data``.
+
+    Returns:
+        tuple: (value, offset of the next byte)
+    """
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def analyze(path):
+    """
+    Tokenize one stored text file (runs in a worker process).
+
+    Args:
+        path: Path of the file in the content store
+
+    Returns:
+        tuple: (dict of term to its encoded occurrence count and positions,
+        list of checkpoint byte offsets)
+    """
+    with open(path, 'rb') as f:
+        # surrogateescape keeps byte offsets exact for files that are not UTF-8
+        text = f.read().decode('utf-8', 'surrogateescape')
+
+    positions = defaultdict(list)
+    checkpoints = []
+    char_offset = byte_offset = 0
+    for number, match in enumerate(TOKEN_RE.finditer(text)):
+        positions[match.group().lower()].append(number)
+        if number % CHECKPOINT_EVERY == 0:
+            byte_offset += len(text[char_offset:match.start()].encode('utf-8', 'surrogateescape'))
+            char_offset = match.start()
+            checkpoints.append(byte_offset)
+
+    terms = {}
+    for term, numbers in positions.items():
+        deltas = bytearray()
+        previous = 0
+        for number in numbers:
+            encode_varint(number - previous, deltas)
+            previous = number
+        encoded = bytearray()
+        encode_varint(len(numbers), encoded)
+        encode_varint(len(deltas), encoded)
+        terms[term] = bytes(encoded + deltas)
+    return terms, checkpoints
+
+
+def _write_run(postings, frequency, path):
+    """
+    Write buffered postings to a run file, sorted by term.
+
+    Each record is the varint length and UTF-8 bytes of the term, then its
+    varint document frequency in the run, the varint length of its
+    postings and the postings.
+    """
+    with open(path, 'wb') as f:
+        for term, key in sorted(((term, term.encode()) for term in postings), key=lambda item: item[1]):
+            data = postings[term]
+            header = bytearray()
+            encode_varint(len(key), header)
+            header += key
+            encode_varint(frequency[term], header)
+            encode_varint(len(data), header)
+            f.write(header)
+            f.write(data)
+
+
+def _read_run(path, run):
+    """Yield (term bytes, run, document frequency, postings) of a run file in term order."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offset = 0
+        while offset < len(data):
+            length, offset = decode_varint(data, offset)
+            term = data[offset:offset + length]
+            frequency, offset = decode_varint(data, offset + length)
+            size, offset = decode_varint(data, offset)
+            yield term, run, frequency, data[offset:offset + size]
+            offset += size
+
+
+def _merge_runs(runs, path):
+    """
+    Merge run files into the postings, term and lexicon files of an index.
+
+    Runs hold consecutive documents and delta-encode each term's first
+    document against its last one in earlier runs, so a term's postings
+    are its chunks concatenated in run order.
+    """
+    streams = [_read_run(run_path, run) for run, run_path in enumerate(runs)]
+    lexicon = array('Q')
+    current = None
+    offset = start = term_end = frequency = 0
+    with (open(os.path.join(path, 'postings.bin'), 'wb') as postings,
+          open(os.path.join(path, 'terms.bin'), 'wb') as terms):
+        for term, _, run_frequency, data in heapq.merge(*streams, key=lambda record: record[:2]):
+            if term != current:
+                if current is not None:
+                    lexicon.extend((term_end, start, offset - start, frequency))
+                terms.write(term)
+                term_end += len(term)
+                current, start, frequency = term, offset, 0
+            postings.write(data)
+            offset += len(data)
+            frequency += run_frequency
+        if current is not None:
+            lexicon.extend((term_end, start, offset - start, frequency))
+    with open(os.path.join(path, 'lexicon.bin'), 'wb') as f:
+        lexicon.tofile(f)
+
+
+def build(documents, workers=None, chunksize=4, run_bytes=None):
+    """
+    Build a new index and make it the live one.
+
+    Texts are tokenized in parallel by a process pool; postings are
+    appended in document order as the results arrive, and written out as a
+    sorted run whenever ``run_bytes`` of them are buffered. The previous
+    index is kept (workers may still be reading it), older ones are removed.
+
+    Args:
+        documents: List of (book_id, sha256) of the texts to index
+        workers: Number of tokenizer processes (default: CPU count)
+        chunksize: Documents sent to a worker at a time
+        run_bytes: Postings buffered before a run is written (default:
+            TEXT_INDEX_RUN_BYTES)
+
+    Returns:
+        str: Directory of the new index
+    """
+    run_bytes = run_bytes or settings.TEXT_INDEX_RUN_BYTES
+    root = settings.TEXT_INDEX_ROOT
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix='index-', dir=root)
+    runs_dir = tempfile.mkdtemp(prefix='runs-', dir=root)
+
+    try:
+        runs = []
+        postings = defaultdict(bytearray)
+        buffered = 0
+        last_doc = {}
+        frequency = Counter()
+        checkpoints = array('I')
+        docs = []
+        paths = [object_path(sha256) for _, sha256 in documents]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(analyze, paths, chunksize=chunksize)
+            for doc, (terms, doc_checkpoints) in enumerate(results):
+                book_id, sha256 = documents[doc]
+                docs.append([book_id, sha256, len(checkpoints), len(doc_checkpoints)])
+                checkpoints.extend(doc_checkpoints)
+                for term, encoded in terms.items():
+                    buf = postings[term]
+                    size = len(buf)
+                    encode_varint(doc - last_doc.get(term, -1), buf)
+                    buf += encoded
+                    buffered += len(buf) - size
+                    last_doc[term] = doc
+                    frequency[term] += 1
+                if buffered >= run_bytes:
+                    runs.append(os.path.join(runs_dir, f'{len(runs)}.run'))
+                    _write_run(postings, frequency, runs[-1])
+                    postings.clear()
+                    frequency.clear()
+                    buffered = 0
+        if postings:
+            runs.append(os.path.join(runs_dir, f'{len(runs)}.run'))
+            _write_run(postings, frequency, runs[-1])
+        del postings
+
+        _merge_runs(runs, path)
+    finally:
+        shutil.rmtree(runs_dir, ignore_errors=True)
+    with open(os.path.join(path, 'checkpoints.bin'), 'wb') as f:
+        checkpoints.tofile(f)
+    with open(os.path.join(path, 'docs.json'), 'w') as f:
+        json.dump(docs, f, separators=(',', ':'))
+
+    link = os.path.join(root, 'current')
+    previous = os.path.realpath(link) if os.path.islink(link) else None
+    tmp_link = f'{link}.{os.getpid()}'
+    os.symlink(os.path.basename(path), tmp_link)
+    os.replace(tmp_link, link)
+    for name in os.listdir(root):
+        old = os.path.join(root, name)
+        if name.startswith('index-') and old not in (path, previous):
+            shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+def _map(path):
+    """Memory-map a file read-only (empty files map to b'')."""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Lexicon:
+    """
+    Memory-mapped term dictionary of an index (terms.bin and lexicon.bin).
+
+    Terms are found by binary search over the sorted terms.
+    """
+
+    FIELDS = 4  # term end, postings offset, postings length, document frequency
+
+    def __init__(self, path):
+        self.terms = _map(os.path.join(path, 'terms.bin'))
+        entries = _map(os.path.join(path, 'lexicon.bin'))
+        self.entries = memoryview(entries).cast('Q') if entries else ()
+
+    def __len__(self):
+        return len(self.entries) // self.FIELDS
+
+    def _term(self, i):
+        start = self.entries[(i - 1) * self.FIELDS] if i else 0
+        return self.terms[start:self.entries[i * self.FIELDS]]
+
+    def get(self, term, default=None):
+        """
+        Look up a term.
+
+        Returns:
+            tuple: (postings offset, postings length, document frequency),
+            or ``default`` if the term is not in the index
+        """
+        key = term.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self) or self._term(lo) != key:
+            return default
+        i = lo * self.FIELDS
+        return tuple(self.entries[i + 1:i + self.FIELDS])
+
+
+class TextIndex:
+    """
+    Read side of an index directory.
+
+    The document table is loaded into memory; the lexicon, postings and
+    checkpoints stay memory-mapped and are decoded per query.
+
+    Attributes:
+        path (str): Index directory
+        docs (list): Document table (see docs.json)
+        terms (Lexicon): Term dictionary
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'docs.json')) as f:
+            self.docs = json.load(f)
+        self.terms = Lexicon(path)
+        self.postings = _map(os.path.join(path, 'postings.bin'))
+        checkpoints = _map(os.path.join(path, 'checkpoints.bin'))
+        self.checkpoints = memoryview(checkpoints).cast('I') if checkpoints else ()
+
+    def _documents(self, term):
+        """Return {doc: (count, offset of positions, end of positions)} for a term."""
+        entry = self.terms.get(term)
+        if entry is None:
+            return {}
+        offset, length, _ = entry
+        end = offset + length
+        documents = {}
+        doc = -1
+        while offset < end:
+            delta, offset = decode_varint(self.postings, offset)
+            count, offset = decode_varint(self.postings, offset)
+            size, offset = decode_varint(self.postings, offset)
+            doc += delta
+            documents[doc] = (count, offset, offset + size)
+            offset += size
+        return documents
+
+    def _positions(self, entry):
+        """Decode the positions of one (count, start, end) postings entry."""
+        _, offset, end = entry
+        positions = []
+        position = 0
+        while offset < end:
+            delta, offset = decode_varint(self.postings, offset)
+            position += delta
+            positions.append(position)
+        return positions
+
+    def _match_clause(self, tokens):
+        """
+        Find the documents containing a phrase.
+
+        Returns:
+            dict: doc -> list of positions where the phrase starts
+        """
+        postings = [self._documents(token) for token in tokens]
+        # Intersect starting with the rarest term
+        candidates = set(min(postings, key=len))
+        for documents in postings:
+            candidates.intersection_update(documents)
+
+        matches = {}
+        for doc in candidates:
+            starts = self._positions(postings[0][doc])
+            if len(tokens) > 1:
+                starts = set(starts)
+                for shift, documents in enumerate(postings[1:], 1):
+                    starts &= {p - shift for p in self._positions(documents[doc])}
+                starts = sorted(starts)
+            if starts:
+                matches[doc] = starts
+        return matches
+
+    def search(self, query):
+        """
+        Find the documents containing every word and "quoted phrase" of a query.
+
+        Returns:
+            list: Match tuples ordered by descending tf-idf score; position
+            is the first occurrence of the query's first clause
+        """
+        clauses = []
+        for phrase, word in QUERY_RE.findall(query):
+            tokens = tokenize(phrase or word)
+            if tokens:
+                clauses.append(tokens)
+        if not clauses:
+            return []
+
+        scores = None
+        first = None
+        for tokens in clauses:
+            matches = self._match_clause(tokens)
+            if first is None:
+                first = matches
+            idf = math.log(1 + len(self.docs) / max(len(matches), 1))
+            clause_scores = {doc: (1 + math.log(len(starts))) * idf for doc, starts in matches.items()}
+            if scores is None:
+                scores = clause_scores
+            else:
+                scores = {doc: score + clause_scores[doc] for doc, score in scores.items() if doc in clause_scores}
+            if not scores:
+                return []
+
+        return sorted(
+            (Match(self.docs[doc][0], round(score, 4), doc, first[doc][0]) for doc, score in scores.items()),
+            key=lambda match: (-match.score, match.doc),
+        )
+
+    def snippet(self, match):
+        """
+        Cut the text around a match from the stored file.
+
+        Args:
+            match: Match returned by search()
+
+        Returns:
+            str: Whitespace-normalized text around the match, or '' if the
+            text is not mirrored on this host (e.g. on edge read nodes)
+        """
+        _, sha256, first_checkpoint, count = self.docs[match.doc]
+        checkpoint = min(match.position // CHECKPOINT_EVERY, count - 1)
+        try:
+            f = open(object_path(sha256), 'rb')
+        except FileNotFoundError:
+            return ''
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = self.checkpoints[first_checkpoint + checkpoint]
+            if checkpoint + 1 < count:
+                stop = self.checkpoints[first_checkpoint + checkpoint + 1]
+            else:
+                stop = len(mapped)
+            margin = SNIPPET_CONTEXT * 4  # a UTF-8 character is at most 4 bytes
+            head = mapped[max(start - margin, 0):start].decode('utf-8', 'surrogateescape')
+            tail = mapped[start:stop + margin].decode('utf-8', 'surrogateescape')
+
+        tokens = TOKEN_RE.finditer(tail)
+        for _ in range(match.position - checkpoint * CHECKPOINT_EVERY):
+            next(tokens)
+        token = next(tokens)
+        text = head + tail
+        start = max(len(head) + token.start() - SNIPPET_CONTEXT, 0)
+        end = len(head) + token.end() + SNIPPET_CONTEXT
+        snippet = text[start:end].encode('utf-8', 'ignore').decode('utf-8', 'ignore')
+        return ' '.join(snippet.split())
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Return the live index, reopening it after a rebuild.
+
+    Edge read nodes use the index shipped in the catalog snapshot.
+
+    Returns:
+        TextIndex or None: None if no index has been built
+    """
+    global _index
+    if settings.SNAPSHOT_PATH:
+        from . import snapshot  # imports the models
+        path = snapshot.text_index()
+        if path is None:
+            return None
+    else:
+        link = os.path.join(settings.TEXT_INDEX_ROOT, 'current')
+        if not os.path.islink(link):
+            return None
+        path = os.path.realpath(link)
+    with _index_lock:
+        if _index is None or _index.path != path:
+            _index = TextIndex(path)
+        return _index
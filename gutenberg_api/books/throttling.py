@@ -0,0 +1,189 @@
+"""
+Per-client rate limiting with token buckets.
+
+Every client (authenticated user, else IP address) has a bucket holding up
+to THROTTLE_BURST tokens, refilled at THROTTLE_RATE tokens per second. A
+request takes tokens according to its expected query expense (see
+request_cost); when the bucket is short, the request is rejected with 429
+and a Retry-After header saying when enough tokens will be available.
+
+Buckets live in a SQLite file (THROTTLE_DB) updated in ``BEGIN IMMEDIATE``
+transactions, so the limits hold across all gunicorn workers on the host.
+The file is in WAL mode with synchronous=NORMAL: commits do not wait for
+fsync, and a crash can at worst forget the latest bucket updates.
+
+Clients are identified by DRF's get_ident, which reads X-Forwarded-For only
+as far as the NUM_PROXIES trusted proxies in front of the app, so a client
+cannot pick a fresh bucket by sending its own header.
+"""
+
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+# Parameters that are not filters
+NON_FILTER_PARAMS = ('page', 'page_size', 'sort', 'format', 'count')
+
+
+def request_cost(request):
+    """
+    Estimate the query expense of a request in tokens.
+
+    A plain request costs 1. Larger pages add proportionally (page_size=100
+    costs 3 more than the default 25), deeper pages add log2 of the page
+    number (OFFSET scans the skipped rows), and every filter adds 0.5.
+
+    Returns:
+        float: Tokens to take
+    """
+    params = request.GET
+
+    def number(name, default):
+        try:
+            return max(int(params.get(name, default)), 1)
+        except ValueError:
+            return default
+
+    page_size = min(number('page_size', 25), 100)
+    page = number('page', 1)
+    filters = sum(1 for name, value in params.items() if value.strip() and name not in NON_FILTER_PARAMS)
+    return 1 + max(page_size - 25, 0) / 25 + math.log2(page) + 0.5 * filters
+
+
+class TokenBucketStore:
+    """
+    Token buckets in a SQLite file shared by the worker processes.
+
+    Attributes:
+        path (str): SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """Connection of this thread, reopened after a fork."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def take(self, key, cost, rate, capacity, now=None):
+        """
+        Take ``cost`` tokens from a bucket if it holds enough.
+
+        Args:
+            key: Bucket key
+            cost: Tokens to take (capped at ``capacity``)
+            rate: Refill rate in tokens per second
+            capacity: Bucket size
+            now: Current time (defaults to time.time())
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds until the
+            bucket will hold enough
+        """
+        now = time.time() if now is None else now
+        cost = min(cost, capacity)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(now - row[1], 0) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            connection.execute(
+                'INSERT INTO bucket (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (key, tokens, now),
+            )
+            if random.random() < 0.001:
+                # Buckets idle long enough to be full again carry no state
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - capacity / rate,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    """Return the TokenBucketStore configured in settings."""
+    with _stores_lock:
+        store = _stores.get(settings.THROTTLE_DB)
+        if store is None:
+            store = _stores[settings.THROTTLE_DB] = TokenBucketStore(settings.THROTTLE_DB)
+        return store
+
+
+def check(request):
+    """
+    Charge a request to its client's bucket.
+
+    Fails open (allows the request) if the store is unavailable.
+
+    Returns:
+        float: 0 if the request may proceed, otherwise seconds to wait
+    """
+    if not settings.THROTTLE_ENABLED:
+        return 0
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        key = f'user:{user.pk}'
+    else:
+        key = f'ip:{BaseThrottle().get_ident(request)}'
+    try:
+        return get_store().take(key, request_cost(request), settings.THROTTLE_RATE, settings.THROTTLE_BURST)
+    except sqlite3.Error:
+        logger.warning('Rate limit store unavailable; request not throttled', exc_info=True)
+        return 0
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """DRF throttle charging requests to the client's token bucket."""
+
+    def allow_request(self, request, view):
+        self.wait_seconds = check(request)
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+
+def throttle(view):
+    """Decorator applying the token bucket limit to a Django view."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        wait = check(request)
+        if wait:
+            response = HttpResponse('Too many requests. Please slow down.', status=429, content_type='text/plain')
+            response['Retry-After'] = str(math.ceil(wait))
+            return response
+        return view(request, *args, **kwargs)
+    return wrapper
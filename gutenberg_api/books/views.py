@@ -1,12 +1,29 @@
-from django.shortcuts import render, get_object_or_404
+import os
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.shortcuts import render
 from django.core.paginator import Paginator
-from django.db.models import Q, F
-from django.http import HttpResponseRedirect
+from django import forms
+from django.db.models import Exists, OuterRef, Q
+from django.http import Http404, HttpResponseRedirect
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import never_cache
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django_filters import rest_framework as filters
-from .models import Book, Format
-from .serializers import BookSerializer
+from . import (
+    catalog, content, denormalized, formatmap, metrics, querycache, routers, sampling, snapshot, textindex,
+)
+from .downloads import recorder
+from .models import Author, Book, BookChange, Bookshelf, Language, RelatedBook
+from .serializers import BookChangeSerializer, BookSerializer, RelatedBookSerializer, SearchResultSerializer
+from .singleflight import SingleFlight, request_key
+from .throttling import TokenBucketThrottle, throttle
 
 class CustomPagination(PageNumberPagination):
     """
@@ -21,6 +38,24 @@ class CustomPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 100
 
+    def paginate_queryset(self, queryset, request, view=None):
+        """Paginate, recording the requested page number in the metrics."""
+        page = super().paginate_queryset(queryset, request, view)
+        metrics.PAGE_DEPTH.observe(self.page.number)
+        return page
+
+class IntegerFilter(filters.NumberFilter):
+    """NumberFilter that accepts whole numbers only."""
+    field_class = forms.IntegerField
+
+# Author year filter -> lookup on Author; applied together (see BookFilter.filter_queryset)
+AUTHOR_YEAR_LOOKUPS = {
+    'author_birth_year_min': 'birth_year__gte',
+    'author_birth_year_max': 'birth_year__lte',
+    'author_death_year_min': 'death_year__gte',
+    'author_death_year_max': 'death_year__lte',
+}
+
 class BookFilter(filters.FilterSet):
     """
     FilterSet for Book model providing various filter options.
@@ -32,6 +67,14 @@ class BookFilter(filters.FilterSet):
         topic: Search in subjects and bookshelves
         author: Search by author name
         title: Search by book title
+        download_count_min, download_count_max: Download count range
+        author_alive_in: Year an author of the book was alive in
+        author_birth_year_min, author_birth_year_max: Author birth year range
+        author_death_year_min, author_death_year_max: Author death year range
+        sort: 'downloads' (all-time, default) or 'trending' (recent downloads)
+    
+    The author filters all apply to the same author, and authors whose
+    years are unknown never match them.
     """
     
     # Filter definitions with descriptions
@@ -49,7 +92,7 @@ class BookFilter(filters.FilterSet):
     )
     
     mime_type = filters.CharFilter(
-        field_name='formats__mime_type',
+        field_name='formats__mime__name',
         label='Mime-type',
         help_text='e.g., text/plain, application/pdf'
     )
@@ -72,6 +115,57 @@ class BookFilter(filters.FilterSet):
         help_text='e.g., Pride and Prejudice'
     )
 
+    download_count_min = IntegerFilter(
+        field_name='download_count',
+        lookup_expr='gte',
+        label='Minimum download count',
+        help_text='e.g., 1000'
+    )
+
+    download_count_max = IntegerFilter(
+        field_name='download_count',
+        lookup_expr='lte',
+        label='Maximum download count',
+        help_text='e.g., 5000'
+    )
+
+    author_alive_in = IntegerFilter(
+        method='filter_author_years',
+        label='Year an author was alive in',
+        help_text='e.g., 1850'
+    )
+
+    author_birth_year_min = IntegerFilter(
+        method='filter_author_years',
+        label='Earliest author birth year',
+        help_text='e.g., 1800'
+    )
+
+    author_birth_year_max = IntegerFilter(
+        method='filter_author_years',
+        label='Latest author birth year',
+        help_text='e.g., 1850'
+    )
+
+    author_death_year_min = IntegerFilter(
+        method='filter_author_years',
+        label='Earliest author death year',
+        help_text='e.g., 1900'
+    )
+
+    author_death_year_max = IntegerFilter(
+        method='filter_author_years',
+        label='Latest author death year',
+        help_text='e.g., 1950'
+    )
+
+    sort = filters.ChoiceFilter(
+        method='filter_sort',
+        choices=[('downloads', 'Most downloaded'), ('trending', 'Trending')],
+        label='Sort order',
+        help_text='downloads or trending'
+    )
+
     def filter_language(self, queryset, name, value):
         """
         Filter books by language code(s).
@@ -86,7 +180,9 @@ class BookFilter(filters.FilterSet):
         """
         if value:
             languages = [lang.strip() for lang in value.split(',')]
-            return queryset.filter(languages__code__in=languages)
+            return queryset.filter(denormalized.overlap(
+                'language_ids', Language.objects.filter(code__in=languages), queryset.db,
+            ))
         return queryset
 
     def filter_mime_type(self, queryset, name, value):
@@ -103,7 +199,7 @@ class BookFilter(filters.FilterSet):
         """
         if value:
             mime_types = [mt.strip() for mt in value.split(',')]
-            return queryset.filter(formats__mime_type__in=mime_types)
+            return queryset.filter(formats__mime__name__in=mime_types)
         return queryset
 
     def filter_topic(self, queryset, name, value):
@@ -121,8 +217,11 @@ class BookFilter(filters.FilterSet):
         if value:
             topics = [topic.strip() for topic in value.split(',')]
             q = Q()
+            shelves = Q()
             for topic in topics:
-                q |= Q(subjects__name__icontains=topic) | Q(bookshelves__name__icontains=topic)
+                q |= Q(subjects__name__icontains=topic)
+                shelves |= Q(name__icontains=topic)
+            q |= denormalized.overlap('bookshelf_ids', Bookshelf.objects.filter(shelves), queryset.db)
             return queryset.filter(q).distinct()
         return queryset
 
@@ -139,54 +238,271 @@ class BookFilter(filters.FilterSet):
             return queryset.filter(gutenberg_id__in=ids)
         return queryset
 
+    def filter_author_years(self, queryset, name, value):
+        """Leave the queryset unchanged; author year filters are combined in filter_queryset."""
+        return queryset
+
+    def filter_queryset(self, queryset):
+        """
+        Apply the filters, combining the author year filters.
+        
+        The year conditions are checked on one author with a single EXISTS
+        subquery, so e.g. a birth year range and a death year range cannot
+        be satisfied by two different authors, and no DISTINCT is needed.
+        
+        Args:
+            queryset: Initial queryset
+            
+        Returns:
+            Filtered queryset
+        """
+        queryset = super().filter_queryset(queryset)
+        data = self.form.cleaned_data
+        conditions = [
+            Q(**{lookup: data[name]}) for name, lookup in AUTHOR_YEAR_LOOKUPS.items() if data.get(name) is not None
+        ]
+        year = data.get('author_alive_in')
+        if year is not None:
+            conditions += [Q(birth_year__lte=year), Q(death_year__gte=year)]
+        if conditions:
+            queryset = queryset.filter(Exists(Author.objects.filter(*conditions, books=OuterRef('pk'))))
+        return queryset
+
+    def filter_sort(self, queryset, name, value):
+        """
+        Order books by recent popularity instead of all-time downloads.
+        
+        Args:
+            queryset: Initial queryset
+            name: Field name (unused)
+            value: 'downloads' or 'trending'
+            
+        Returns:
+            Reordered queryset
+        """
+        if value == 'trending':
+            return queryset.order_by('-trending_score', '-download_count')
+        return queryset
+
     class Meta:
         model = Book
-        fields = ['language', 'mime_type', 'topic', 'author', 'title', 'book_ids']
+        fields = [
+            'language', 'mime_type', 'topic', 'author', 'title', 'book_ids',
+            'download_count_min', 'download_count_max', 'author_alive_in',
+            'author_birth_year_min', 'author_birth_year_max', 'author_death_year_min', 'author_death_year_max',
+            'sort',
+        ]
+
+# Coalesces identical concurrent BookViewSet.list requests in this worker
+list_flight = SingleFlight()
 
+@method_decorator(routers.replica_view, name='dispatch')
+@method_decorator(catalog.conditional, name='dispatch')
 class BookViewSet(viewsets.ReadOnlyModelViewSet):
     """
     ViewSet for viewing books.
     
-    Provides 'list' and 'retrieve' actions.
+    Provides 'list', 'retrieve', 'related' and 'search' actions.
     Supports filtering, pagination, and ordering by download count.
+    Identical concurrent list requests are coalesced into one query.
+    Requests are rate limited per client, weighted by their expense.
+    Conditional GETs are answered with 304 Not Modified while the catalog
+    is unchanged, before throttling or any query.
     """
+    lookup_value_regex = r'\d+'
     queryset = Book.objects.all().order_by('-download_count')
     serializer_class = BookSerializer
     pagination_class = CustomPagination
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_class = BookFilter
+    throttle_classes = [TokenBucketThrottle]
 
     def get_queryset(self):
         """
         Get the queryset for the viewset.
         Optimizes database queries using prefetch_related.
+        Languages and bookshelves are not prefetched: their ids are stored
+        on the book and resolved from the in-process lookup tables. Only
+        the BookSubject rows of subjects are, for the same tables.
         """
-        return super().get_queryset().prefetch_related(
-            'authors', 'languages', 'subjects', 'bookshelves', 'formats'
+        return super().get_queryset().prefetch_related('authors', 'booksubject_set', 'formats')
+
+    def list(self, request, *args, **kwargs):
+        """
+        List books, sharing one computation among identical concurrent requests.
+
+        Requests with the same normalized filters and page wait on the
+        in-flight computation instead of running the same query again.
+        """
+        data = list_flight.do(
+            request_key(request),
+            lambda: super(BookViewSet, self).list(request, *args, **kwargs).data,
         )
+        return Response(data)
+
+    @action(detail=True)
+    def related(self, request, pk=None):
+        """
+        List books similar to this one ("more like this").
+        
+        Reads the precomputed RelatedBook rows for the book in rank order
+        (see the compute_related_books management command).
+        """
+        related = RelatedBook.objects.filter(book_id=pk).select_related('related')
+        if not related and not Book.objects.filter(pk=pk).exists():
+            raise Http404
+        return Response(RelatedBookSerializer(related, many=True).data)
+
+    @action(detail=False, filter_backends=[], serializer_class=SearchResultSerializer)
+    def search(self, request):
+        """
+        Search inside the mirrored book texts.
+        
+        The ``q`` parameter holds words and "quoted phrases"; books must
+        contain all of them. Results are ranked by relevance and carry a
+        snippet around the first match (see the build_text_index
+        management command).
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'This parameter is required.'})
+        index = textindex.get_index()
+        matches = self.paginate_queryset(index.search(query) if index else [])
+
+        books = Book.objects.prefetch_related('authors').in_bulk([match.book_id for match in matches])
+        results = []
+        for match in matches:
+            book = books.get(match.book_id)
+            if book is None:
+                continue  # deleted since the index was built
+            book.score = match.score
+            book.snippet = index.snippet(match)
+            results.append(book)
+        return self.get_paginated_response(self.get_serializer(results, many=True).data)
+
+@method_decorator(routers.replica_view, name='dispatch')
+@method_decorator(never_cache, name='dispatch')
+@method_decorator(querycache.uncached, name='dispatch')
+class RandomBookViewSet(viewsets.GenericViewSet):
+    """
+    Random books.
+    
+    ``GET /api/books/random/?count=<n>`` returns ``n`` (default 1, at most
+    100) books picked uniformly at random, in random order. The filters of
+    /api/books/ apply. Books are drawn from an in-process id array instead
+    of sorting the table by random() (see books.sampling). Responses are
+    never cached or revalidated, and the queries of random draws, which
+    hardly ever repeat, bypass the query result cache.
+    """
+    queryset = Book.objects.all()
+    serializer_class = BookSerializer
+    filter_backends = (filters.DjangoFilterBackend,)
+    filterset_class = BookFilter
+    throttle_classes = [TokenBucketThrottle]
+    max_count = 100
+
+    def list(self, request):
+        """Return the random books."""
+        try:
+            count = int(request.query_params.get('count', 1))
+        except ValueError:
+            raise ValidationError({'count': 'count must be an integer.'})
+        if not 1 <= count <= self.max_count:
+            raise ValidationError({'count': f'count must be between 1 and {self.max_count}.'})
+
+        ids = sampling.sample(self.filter_queryset(self.get_queryset()), count)
+        books = Book.objects.prefetch_related('authors', 'booksubject_set', 'formats').in_bulk(ids)
+        results = [books[pk] for pk in ids if pk in books]
+        return Response({'results': self.get_serializer(results, many=True).data})
+
+@method_decorator(snapshot.primary_only, name='dispatch')
+@method_decorator(catalog.conditional, name='dispatch')
+class ChangeViewSet(viewsets.GenericViewSet):
+    """
+    Change feed for incremental catalog mirroring.
+    
+    ``GET /api/changes/?since=<seq>`` lists the books created, changed or
+    deleted after entry ``seq``, in sequence order (see books.changes).
+    A mirror starts from since=0, which replays an entry for every book,
+    then keeps passing the returned ``since``. Each page holds at most
+    ``page_size`` entries (default 1000, at most 10000) and only the
+    latest entry of each book on it; ``next`` is null once the mirror is
+    caught up. Edge read nodes do not serve the feed.
+    """
+    queryset = BookChange.objects.order_by('seq')
+    serializer_class = BookChangeSerializer
+    throttle_classes = [TokenBucketThrottle]
+    page_size = 1000
+    max_page_size = 10000
+
+    def list(self, request):
+        """Return the entries after ``since``."""
+        try:
+            since = int(request.query_params.get('since', 0))
+            page_size = int(request.query_params.get('page_size', self.page_size))
+        except ValueError:
+            raise ValidationError({'since': 'since and page_size must be integers.'})
+        if since < 0 or page_size < 1:
+            raise ValidationError({'since': 'since must be >= 0 and page_size >= 1.'})
+        page_size = min(page_size, self.max_page_size)
+
+        entries = list(self.get_queryset().filter(seq__gt=since).only('seq', 'book_id', 'action')[:page_size + 1])
+        has_more = len(entries) > page_size
+        entries = entries[:page_size]
+        if entries:
+            since = entries[-1].seq
+        latest = {entry.book_id: entry for entry in entries}
+        results = sorted(latest.values(), key=lambda entry: entry.seq)
+        next_url = replace_query_param(request.build_absolute_uri(), 'since', since) if has_more else None
+        return Response({
+            'since': since,
+            'next': next_url,
+            'results': self.get_serializer(results, many=True).data,
+        })
 
+@throttle
 def download_book(request, book_id, format_id):
     """
     Handle book download and increment download counter.
     
+    The format is resolved from the in-process format map, so a download
+    normally runs no query at all (the counter is written in batches).
+    Serves the locally mirrored file when there is one (see import_content),
+    with Range, ETag and gzip support; otherwise redirects to the format URL.
+    Requests resuming a download (Range not starting at 0), and downloads
+    from edge read nodes, are not counted.
+    
     Args:
         request: HTTP request
         book_id: ID of the book
         format_id: ID of the format
         
     Returns:
-        Redirect to the actual download URL
+        The file, or a redirect to the actual download URL
+        
+    Raises:
+        Http404: If the format does not exist or belongs to another book
     """
-    # Get book and format or return 404
-    book = get_object_or_404(Book, id=book_id)
-    book_format = get_object_or_404(Format, id=format_id)
+    entry = formatmap.lookup(book_id, format_id)
+    if entry is None:
+        raise Http404('No such format for this book.')
+    
+    # Count the download (buffered, written in batches); edge read nodes
+    # have no database to write the counts to
+    if not settings.SNAPSHOT_PATH and request.META.get('HTTP_RANGE', 'bytes=0-').startswith('bytes=0-'):
+        recorder.record(book_id)
     
-    # Increment download count atomically
-    Book.objects.filter(id=book_id).update(download_count=F('download_count') + 1)
+    # Serve the local copy if there is one
+    if entry.content is not None:
+        filename = os.path.basename(urlparse(entry.url).path)
+        return content.serve(request, entry.content, entry.mime_type, filename)
     
     # Redirect to download URL
-    return HttpResponseRedirect(book_format.url)
+    return HttpResponseRedirect(entry.url)
 
+@routers.replica_view
+@catalog.conditional
+@throttle
 def home(request):
     """
     Home page view showing book list with filters.
@@ -219,12 +535,14 @@ def home(request):
     if topic:
         queryset = queryset.filter(
             Q(subjects__name__icontains=topic) | 
-            Q(bookshelves__name__icontains=topic)
+            denormalized.overlap('bookshelf_ids', Bookshelf.objects.filter(name__icontains=topic), queryset.db)
         ).distinct()
     if language:
-        queryset = queryset.filter(languages__code=language)
+        queryset = queryset.filter(denormalized.overlap(
+            'language_ids', Language.objects.filter(code=language), queryset.db,
+        ))
     if mime_type:
-        queryset = queryset.filter(formats__mime_type=mime_type)
+        queryset = queryset.filter(formats__mime__name=mime_type)
     if book_ids:
         try:
             ids = [int(x.strip()) for x in book_ids.split(',')]
@@ -0,0 +1,40 @@
+"""
+Gunicorn settings shared by every start command (read from the working directory).
+
+Sets up prometheus_client multiprocess mode: workers write their samples to
+PROMETHEUS_MULTIPROC_DIR and /metrics aggregates them (see books.metrics).
+The variable must be set, and the directory exist, before prometheus_client
+is first imported: with --preload the application is loaded before any
+server hook runs, so this is done when the config is read. Samples left over
+from a previous run are dropped in on_starting, which runs once in the
+master; the config is read again on reload (HUP), while workers are live.
+"""
+
+import os
+import shutil
+import tempfile
+
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'gutenberg_api_metrics'),
+)
+os.makedirs(metrics_dir, exist_ok=True)
+
+
+def on_starting(server):
+    """Drop the samples left over from a previous run, before any worker starts."""
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    """Discard the live samples of a worker that exited."""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    """Write the download clicks still buffered by the exiting worker (see books.downloads)."""
+    from books.downloads import recorder
+
+    recorder.flush()
@@ -11,11 +11,14 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 import dj_database_url
 from dotenv import load_dotenv
 
-load_dotenv()
+# Railway injects the environment directly; only look for a .env file elsewhere
+if not os.getenv('RAILWAY_ENVIRONMENT'):
+    load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -40,7 +43,8 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'django-insecure-remg5$azdu9==9#1gmihp@rzft
 # Application definition
 
 INSTALLED_APPS = [
-    "django.contrib.admin",
+    # Admin modules are discovered on first use (see gutenberg_api.startup.LazyAdminURLs)
+    "django.contrib.admin.apps.SimpleAdminConfig",
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "django.contrib.sessions",
@@ -54,8 +58,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "books.metrics.MetricsMiddleware",
+    "books.profiling.ProfilingMiddleware",
+    "books.slowqueries.SlowQueryMiddleware",
+    "books.compression.CompressionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    "books.feeds.FeedFilesMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -139,6 +148,54 @@ else:
     SECURE_HSTS_PRELOAD = False
     SECURE_HSTS_INCLUDE_SUBDOMAINS = False
 
+# Read replicas
+# DATABASE_REPLICA_URLS is a comma-separated list of database URLs. Each one
+# becomes a `replica_<n>` alias that books.routers.ReplicaRouter sends the reads of
+# safe-method requests to the catalog views to.
+for index, url in enumerate(filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(','))):
+    DATABASES[f'replica_{index}'] = dj_database_url.parse(
+        url.strip(),
+        conn_max_age=600,
+        conn_health_checks=True,
+    )
+    DATABASES[f'replica_{index}']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_REPLICA_HEALTH_CHECK_INTERVAL = int(os.getenv('DATABASE_REPLICA_HEALTH_CHECK_INTERVAL', '30'))
+DATABASE_ROUTERS = ['books.routers.ReplicaRouter']
+
+# Connection pooling (requires psycopg 3)
+# Setting DB_POOL_MAX_SIZE enables a client-side pool per PostgreSQL alias.
+# Pooled connections replace persistent ones, so CONN_MAX_AGE is reset to 0.
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '0'))
+if DB_POOL_MAX_SIZE:
+    for db in DATABASES.values():
+        if db['ENGINE'] == 'django.db.backends.postgresql':
+            db.setdefault('OPTIONS', {})['pool'] = {
+                'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+                'max_size': DB_POOL_MAX_SIZE,
+                'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+            }
+            db['CONN_MAX_AGE'] = 0
+            db['CONN_HEALTH_CHECKS'] = False
+
+# Read-only catalog snapshot (books.snapshot)
+# Setting SNAPSHOT_PATH makes this an edge read node: the book API and home page
+# read the catalog from the SQLite file written by the export_snapshot command.
+# Replace the file with a rename to publish a new snapshot; it is reopened on
+# the next request. SNAPSHOT_MMAP_SIZE bytes of it are memory-mapped. Edge nodes
+# need no default database: downloads are not counted and /api/changes/ is not served.
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', '')
+SNAPSHOT_MMAP_SIZE = int(os.getenv('SNAPSHOT_MMAP_SIZE', str(1024 ** 3)))
+if SNAPSHOT_PATH:
+    DATABASES['snapshot'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': Path(os.path.abspath(SNAPSHOT_PATH)).as_uri() + '?mode=ro&immutable=1',
+        'OPTIONS': {'init_command': f'PRAGMA mmap_size={SNAPSHOT_MMAP_SIZE}; PRAGMA query_only=1'},
+        'CONN_MAX_AGE': None,
+        'TEST': {'MIRROR': 'default'},
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -178,10 +235,9 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_DIRS = [
-    os.path.join(BASE_DIR, 'static'),
+    path for path in [os.path.join(BASE_DIR, 'static')] if os.path.isdir(path)
 ]
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
-os.makedirs(os.path.join(BASE_DIR, 'static'), exist_ok=True)
 
 # CORS settings
 CORS_ALLOWED_ORIGINS = os.getenv('CORS_ALLOWED_ORIGINS', 'http://localhost:3000').split(',')
@@ -193,11 +249,118 @@ CORS_ALLOW_CREDENTIALS = True
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
+# Caches
+# 'shared' lives on the local filesystem, so every gunicorn worker on the host sees it.
+# The metered backends count hits and misses for /metrics (books.metrics).
+CACHES = {
+    'default': {
+        'BACKEND': 'books.metrics.MeteredLocMemCache',
+        'OPTIONS': {'METRICS_NAME': 'default'},
+    },
+    'shared': {
+        'BACKEND': 'books.metrics.MeteredFileBasedCache',
+        'LOCATION': os.getenv('SHARED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'gutenberg_api_cache')),
+        'OPTIONS': {'METRICS_NAME': 'shared'},
+    },
+    'queries': {
+        'BACKEND': 'books.metrics.MeteredLocMemCache',
+        'OPTIONS': {
+            'METRICS_NAME': 'queries',
+            'MAX_ENTRIES': int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '5000')),
+        },
+    },
+}
+
+# Single-flight for identical concurrent list requests (books.singleflight)
+# Set SINGLE_FLIGHT_LOCK_DIR to coalesce requests across worker processes (without it,
+# only threads of one gthread worker are coalesced; sync workers get nothing).
+# Finished results are kept SINGLE_FLIGHT_RESULT_TTL seconds for workers that were
+# waiting on them; later requests never get them.
+SINGLE_FLIGHT_LOCK_DIR = os.getenv('SINGLE_FLIGHT_LOCK_DIR')
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '2'))
+SINGLE_FLIGHT_CACHE = 'shared'
+
+
+# In-process lookup tables (books.lookups)
+LOOKUP_POPULAR_SUBJECTS = int(os.getenv('LOOKUP_POPULAR_SUBJECTS', '1000'))
+LOOKUP_TABLES_CHECK_INTERVAL = int(os.getenv('LOOKUP_TABLES_CHECK_INTERVAL', '30'))
+
+# Download counting (books.downloads)
+# Clicks are buffered per worker and written once either limit is reached.
+DOWNLOAD_FLUSH_SIZE = int(os.getenv('DOWNLOAD_FLUSH_SIZE', '50'))
+DOWNLOAD_FLUSH_INTERVAL = float(os.getenv('DOWNLOAD_FLUSH_INTERVAL', '10'))
+
+# Local mirror of book files (books.content)
+CONTENT_STORE_ROOT = os.getenv('CONTENT_STORE_ROOT', os.path.join(BASE_DIR, 'content'))
+
+# Full-text index over the mirrored texts (books.textindex)
+# The build buffers TEXT_INDEX_RUN_BYTES of postings before writing a sorted run to disk.
+TEXT_INDEX_ROOT = os.getenv('TEXT_INDEX_ROOT', os.path.join(CONTENT_STORE_ROOT, 'index'))
+TEXT_INDEX_RUN_BYTES = int(os.getenv('TEXT_INDEX_RUN_BYTES', str(64 * 1024 * 1024)))
+
+# Sitemaps and OPDS feeds (books.feeds), written by the build_feeds command and
+# served at FEEDS_URL. FEEDS_BASE_URL is the public URL of the site they link to.
+FEEDS_ROOT = os.getenv('FEEDS_ROOT', os.path.join(BASE_DIR, 'feeds'))
+FEEDS_URL = '/feeds/'
+FEEDS_BASE_URL = os.getenv('FEEDS_BASE_URL', 'http://localhost:8000')
+FEEDS_CHUNK_SIZE = int(os.getenv('FEEDS_CHUNK_SIZE', '10000'))  # book ids per file; sitemaps allow 50,000 URLs
+FEEDS_MAX_AGE = int(os.getenv('FEEDS_MAX_AGE', '3600'))
+
+# Sampling profiler for slow requests (books.profiling), enabled by PROFILE_DIR
+PROFILE_DIR = os.getenv('PROFILE_DIR')
+PROFILE_THRESHOLD = float(os.getenv('PROFILE_THRESHOLD', '1.0'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+
+# Slow query log (books.slowqueries), enabled by SLOW_QUERY_LOG
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG')
+SLOW_QUERY_THRESHOLD = float(os.getenv('SLOW_QUERY_THRESHOLD', '0.2'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0.1'))
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv('SLOW_QUERY_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv('SLOW_QUERY_LOG_BACKUPS', '5'))
+
+# Compression of dynamic responses (books.compression)
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '5'))
+COMPRESSION_CACHE = 'default'
+COMPRESSION_CACHE_TIMEOUT = int(os.getenv('COMPRESSION_CACHE_TIMEOUT', '300'))
+
+# Per-client rate limiting (books.throttling), off unless THROTTLE_ENABLED is set
+# Each client may burst THROTTLE_BURST tokens, refilled at THROTTLE_RATE per second.
+# Clients are told apart by the address NUM_PROXIES hops back in X-Forwarded-For
+# (Railway's edge proxy is one hop); with 0, the header is ignored for REMOTE_ADDR.
+THROTTLE_ENABLED = os.getenv('THROTTLE_ENABLED', 'false').lower() == 'true'
+NUM_PROXIES = int(os.getenv('NUM_PROXIES', '1' if IS_RAILWAY else '0'))
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '2'))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '60'))
+THROTTLE_DB = os.getenv('THROTTLE_DB', os.path.join(tempfile.gettempdir(), 'gutenberg_api_throttle.sqlite3'))
+
+# Prometheus metrics endpoint (books.metrics)
+# /metrics answers clients whose address (found as for throttling, see NUM_PROXIES)
+# is in METRICS_ALLOWED_IPS (comma-separated addresses or networks), or that send
+# "Authorization: Bearer <METRICS_TOKEN>" when a token is set; others get 403.
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()]
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Query result cache (books.querycache)
+# Results of read querysets of the catalog models are cached per worker and dropped
+# when a table they read is written (table generations live in the primary database).
+# Reads from replicas are cached for QUERY_CACHE_REPLICA_TIMEOUT seconds at most; keep
+# it below the replication lag you accept (0 disables caching them).
+QUERY_CACHE_ENABLED = os.getenv('QUERY_CACHE_ENABLED', 'true').lower() == 'true'
+QUERY_CACHE = 'queries'
+QUERY_CACHE_TIMEOUT = int(os.getenv('QUERY_CACHE_TIMEOUT', '300'))
+QUERY_CACHE_REPLICA_TIMEOUT = int(os.getenv('QUERY_CACHE_REPLICA_TIMEOUT', '0'))
+QUERY_CACHE_MAX_ROWS = int(os.getenv('QUERY_CACHE_MAX_ROWS', '1000'))
+
+
 # Rest Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 25,
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'NUM_PROXIES': NUM_PROXIES,
 }
 
 # Swagger settings
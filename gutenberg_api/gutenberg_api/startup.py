@@ -0,0 +1,174 @@
+"""
+Worker cold-start helpers.
+
+Provides startup instrumentation (boot phase timings and per-module import
+times) and helpers that defer loading rarely used components (schema views,
+admin) until their first request.
+
+Set STARTUP_PROFILE=1 to log boot phase timings when a worker starts
+(see wsgi.py), or run ``manage.py profile_startup`` for a per-module report.
+"""
+
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Modules that should only be imported on first use, not at worker boot
+LAZY_MODULES = ['drf_yasg.generators', 'books.schema', 'books.admin']
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def preload():
+    """
+    Load the format map and lookup tables (see wsgi.py).
+
+    With ``gunicorn --preload`` this runs once in the master process and
+    workers share the result copy-on-write.
+    """
+    from books import formatmap, lookups
+
+    formatmap.preload()
+    lookups.preload()  # last: closes the connections opened for loading
+
+
+def boot():
+    """
+    Boot the WSGI application as a worker does, timing each phase.
+
+    Phases are Django setup (settings and app registry ready), WSGI handler
+    creation (middleware loading), URLconf import and the preloading of the
+    in-memory catalog copies.
+
+    Returns:
+        tuple: (application, dict of phase name to seconds)
+    """
+    import django
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.urls import get_resolver
+
+    timings = {}
+    start = time.perf_counter()
+    django.setup(set_prefix=False)
+    timings['apps_ready'] = time.perf_counter() - start
+
+    phase = time.perf_counter()
+    application = WSGIHandler()
+    timings['middleware'] = time.perf_counter() - phase
+
+    phase = time.perf_counter()
+    get_resolver().url_patterns
+    timings['urlconf'] = time.perf_counter() - phase
+
+    phase = time.perf_counter()
+    preload()
+    timings['preload'] = time.perf_counter() - phase
+
+    timings['total'] = time.perf_counter() - start
+    return application, timings
+
+
+def log_boot(timings):
+    """Log boot phase timings in milliseconds."""
+    logger.info(
+        'Worker %d booted in %.0f ms (%s)',
+        os.getpid(),
+        timings['total'] * 1000,
+        ', '.join(f'{phase} {seconds * 1000:.0f} ms' for phase, seconds in timings.items() if phase != 'total'),
+    )
+
+
+def parse_importtime(output):
+    """
+    Parse the stderr output of ``python -X importtime``.
+
+    Args:
+        output: Captured stderr text
+
+    Returns:
+        list: (module, self seconds, cumulative seconds) for every imported module
+    """
+    modules = []
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, _, module = match.groups()
+            modules.append((module, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return modules
+
+
+def measure_boot():
+    """
+    Boot a fresh interpreter and report where its startup time went.
+
+    Returns:
+        dict: 'wall' (seconds for the whole interpreter), 'phases' (see boot),
+        'imports' (see parse_importtime) and 'lazy' (LAZY_MODULES that were
+        imported during boot)
+    """
+    script = (
+        'import json, sys\n'
+        'from gutenberg_api.startup import LAZY_MODULES, boot\n'
+        '_, timings = boot()\n'
+        'print(json.dumps({"phases": timings, '
+        '"lazy": [m for m in LAZY_MODULES if m in sys.modules]}))\n'
+    )
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'gutenberg_api.settings')
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script],
+        capture_output=True, text=True, check=True, env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['wall'] = time.perf_counter() - start
+    report['imports'] = parse_importtime(result.stderr)
+    return report
+
+
+def lazy_view(dotted_path):
+    """
+    Return a view that imports ``dotted_path`` on its first request.
+
+    Args:
+        dotted_path: Import path of the real view callable
+
+    Returns:
+        function: View delegating to the real view
+    """
+    view = None
+
+    def wrapper(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(dotted_path)
+        return view(request, *args, **kwargs)
+
+    return wrapper
+
+
+class LazyAdminURLs:
+    """
+    URLconf for the admin site that registers ModelAdmins on first use.
+
+    Used with ``SimpleAdminConfig``: admin autodiscovery (importing every
+    app's admin module) and building the admin URL patterns are deferred
+    until a request is routed to /admin/ or an admin URL is reversed.
+    """
+
+    @cached_property
+    def urlpatterns(self):
+        from django.contrib import admin
+
+        admin.autodiscover()
+        return admin.site.get_urls()
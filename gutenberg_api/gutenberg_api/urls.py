@@ -15,36 +15,29 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
-from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from books.views import BookViewSet
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-from rest_framework import permissions
-from books.views import BookViewSet, home ,download_book
+from books.metrics import metrics_view
+from books.views import BookViewSet, ChangeViewSet, RandomBookViewSet, home ,download_book
+from gutenberg_api.startup import LazyAdminURLs, lazy_view
 
 router = DefaultRouter()
 router.register(r'books', BookViewSet)
+router.register(r'books/random', RandomBookViewSet, basename='book-random')
+router.register(r'changes', ChangeViewSet, basename='change')
 
-schema_view = get_schema_view(
-   openapi.Info(
-      title="Gutenberg API",
-      default_version='v1',
-      description="API for Project Gutenberg books",
-   ),
-   public=True,
-   permission_classes=(permissions.AllowAny,),
-)
+# Rarely used components are loaded on first request to keep worker boot fast.
+# The schema views serve the document persisted by `manage.py generate_schema`.
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
+    path('admin/', (LazyAdminURLs(), 'admin', 'admin')),
     path('', home, name='home'),
     path('api/', include(router.urls)),
-    path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), 
+    path('swagger/', lazy_view('books.schema.swagger_ui_view'), 
          name='schema-swagger-ui'),
-    path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), 
+    path('redoc/', lazy_view('books.schema.redoc_view'), 
          name='schema-redoc'),
      path('download/<int:book_id>/<int:format_id>/', download_book, name='download_book'),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
@@ -13,4 +13,16 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gutenberg_api.settings")
 
-application = get_wsgi_application()
+if os.getenv("STARTUP_PROFILE"):
+    # Log how long each boot phase took (see gutenberg_api.startup)
+    from gutenberg_api.startup import boot, log_boot
+
+    application, timings = boot()
+    log_boot(timings)
+else:
+    from gutenberg_api.startup import preload
+
+    application = get_wsgi_application()
+    # Load lookup tables and the format map now so that, with
+    # `gunicorn --preload`, workers share them
+    preload()